@@ -0,0 +1,189 @@
+"""In-process stand-ins for reddit and a Matrix homeserver"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from nio import RoomSendError, RoomSendResponse
+
+# When the first fake challenge was posted to reddit
+FIRST_CHALLENGE_TIMESTAMP = 1500000000
+
+# How far apart fake challenges were posted to reddit
+CHALLENGE_INTERVAL_SECONDS = 60 * 60 * 24 * 14
+
+
+def challenge_id(index: int) -> str:
+    """The reddit ID of the fake challenge with the given index"""
+    # Reddit IDs are base 36
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    index += 36 ** 4
+    while index:
+        index, remainder = divmod(index, 36)
+        result = digits[remainder] + result
+    return result
+
+
+class FakeSubmission(object):
+    """A reddit submission with everything the bot reads already fetched"""
+
+    def __init__(self, index: int):
+        self.id = challenge_id(index)
+        self.created_utc = (
+            FIRST_CHALLENGE_TIMESTAMP + index * CHALLENGE_INTERVAL_SECONDS
+        )
+        self.title = f"Drawing Challenge #{index}"
+        self.selftext = "Draw something!\nTake your time.\n" * 5
+        self.url = (
+            f"https://www.reddit.com/r/MLPDrawingSchool/comments/{self.id}/"
+            f"drawing_challenge_{index}/"
+        )
+
+
+class FakeWikiPage(object):
+    """A wiki page listing challenges, one per line"""
+
+    def __init__(self, reddit: "FakeReddit", name: str):
+        self._reddit = reddit
+        self.name = name
+
+    @property
+    def content_html(self) -> str:
+        self._reddit._request("wiki_page")
+        lines = ['<div class="md wiki">', "<h1>Biweekly challenges</h1>", "<ul>"]
+        for index, submission in enumerate(self._reddit.submissions):
+            lines.append(
+                f'<li><a href="{submission.url}">Drawing Challenge #{index}</a></li>'
+            )
+        lines.extend(["</ul>", "</div>"])
+        return "\n".join(lines)
+
+    def revisions(self, limit: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        self._reddit._request("wiki_revisions")
+        return iter([{"id": f"revision-{self._reddit.revision}"}])
+
+    def __str__(self):
+        return f"fake/{self.name}"
+
+
+class FakeWiki(object):
+    def __init__(self, reddit: "FakeReddit"):
+        self._reddit = reddit
+
+    def __getitem__(self, name: str) -> FakeWikiPage:
+        return FakeWikiPage(self._reddit, name)
+
+
+class FakeSubreddit(object):
+    def __init__(self, reddit: "FakeReddit"):
+        self.wiki = FakeWiki(reddit)
+
+
+class FakeReddit(object):
+    """Stands in for a praw Reddit instance
+
+    Args:
+        challenge_count: How many challenges are listed on the wiki
+        latency: How long each request takes, in seconds. Requests block, like praw's
+    """
+
+    def __init__(self, challenge_count: int, latency: float = 0.0):
+        self.latency = latency
+        self.revision = 0
+        self.submissions: List[FakeSubmission] = []
+        self._submissions_by_id: Dict[str, FakeSubmission] = {}
+        self.add_challenges(challenge_count)
+
+        # How many requests of each type have been made
+        self.requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_challenges(self, count: int):
+        """Post new challenges and list them on the wiki"""
+        start = len(self.submissions)
+        for index in range(start, start + count):
+            submission = FakeSubmission(index)
+            self.submissions.append(submission)
+            self._submissions_by_id[submission.id] = submission
+        self.revision += 1
+
+    def _request(self, kind: str):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def request_count(self) -> int:
+        return sum(self.requests.values())
+
+    def subreddit(self, display_name: str) -> FakeSubreddit:
+        return FakeSubreddit(self)
+
+    def info(self, fullnames: List[str]) -> Iterator[FakeSubmission]:
+        self._request("info")
+        for fullname in fullnames:
+            submission = self._submissions_by_id.get(fullname[len("t3_") :])
+            if submission is not None:
+                yield submission
+
+
+class FakeAsyncClient(object):
+    """Stands in for a nio AsyncClient that sends messages to rooms
+
+    Args:
+        latency: How long each send takes, in seconds
+        rate_limit_every: If set, every Nth send is rate limited
+        retry_after_ms: How long the homeserver asks us to wait when rate limited
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        rate_limit_every: Optional[int] = None,
+        retry_after_ms: int = 100,
+    ):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+
+        self.user = "@bot:example.com"
+        self.rooms = {}
+
+        self.send_attempts = 0
+        self.sent = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def room_send(
+        self, room_id, message_type, content, ignore_unverified_devices=False
+    ):
+        # Other sends run while this one waits, so which attempt this is has to be
+        # noted before waiting
+        self.send_attempts += 1
+        attempt = self.send_attempts
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            else:
+                await asyncio.sleep(0)
+        finally:
+            self.in_flight -= 1
+
+        if self.rate_limit_every and attempt % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return RoomSendError(
+                "Too Many Requests",
+                "M_LIMIT_EXCEEDED",
+                self.retry_after_ms,
+                False,
+                room_id,
+            )
+
+        self.sent += 1
+        return RoomSendResponse(f"$event{self.sent}", room_id)
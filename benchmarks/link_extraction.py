@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Benchmark extracting challenge links from wiki pages
+
+Compares the single-pass link tokenizer used by the Scraper with the line-by-line regex
+that it replaced, over large synthetic wiki pages, and prints the results as JSON.
+
+Usage:
+    python -m benchmarks.link_extraction [--links 100 10000] [--output out.json]
+"""
+
+import argparse
+import json
+import platform
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from benchmarks.fakes import FakeSubmission
+from drawing_challenge_bot import __version__
+from drawing_challenge_bot.challenge_links import iter_challenge_links
+
+DEFAULT_LINK_COUNTS = [100, 1000, 10000]
+
+# The regex that the Scraper used to match challenge links, one line at a time
+LEGACY_CHALLENGE_REGEX = re.compile(r'.*href="(http[^"]+)".*>.*Drawing Challenge.*<')
+
+# The longest line the legacy regex is run on. On a line of links that doesn't end in
+# a challenge link, its greedy groups backtrack over every combination of positions,
+# so a 50KB line takes over a minute
+LEGACY_MAX_LINE_LENGTH = 20000
+
+
+def extract_with_tokenizer(html: str) -> List[str]:
+    """Extract challenge links the way the Scraper does"""
+    return list(iter_challenge_links(html))
+
+
+def extract_with_regex(html: str) -> List[str]:
+    """Extract challenge links the way the Scraper used to"""
+    urls = []
+    for line in html.split("\n"):
+        match = LEGACY_CHALLENGE_REGEX.match(line)
+        if match:
+            urls.append(match.group(1))
+    return urls
+
+
+def make_page(link_count: int, layout: str) -> str:
+    """Generate the HTML of a wiki page listing challenges
+
+    Args:
+        link_count: How many challenge links to include
+        layout: "lines" for one list item per line, "single_line" for the whole page
+            on one line, "wrapped" for links whose text is broken over lines and that
+            are surrounded by other links and formatting, or "other_links" for a
+            single line of links that aren't to challenges
+    """
+    items = []
+    for index in range(link_count):
+        url = FakeSubmission(index).url
+        if layout == "other_links":
+            items.append(f'<li><a href="https://example.com/{index}">Link</a></li>')
+        elif layout == "wrapped":
+            items.append(
+                f'<li><a href="https://www.reddit.com/user/artist{index}">artist{index}'
+                f'</a> hosted <a href="{url}">\n<strong>Drawing\nChallenge</strong>'
+                f" #{index}</a>\n&mdash; <em>theme {index}</em></li>"
+            )
+        else:
+            items.append(f'<li><a href="{url}">Drawing Challenge #{index}</a></li>')
+
+    separator = "" if layout in ("single_line", "other_links") else "\n"
+    return separator.join(
+        ['<div class="md wiki">', "<h1>Biweekly challenges</h1>", "<ul>"]
+        + items
+        + ["</ul>", "</div>"]
+    )
+
+
+def measure(extract: Callable[[str], List[str]], html: str, repeat: int):
+    """Time the best of `repeat` runs of an extractor over a page"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        links = extract(html)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {
+        "seconds": round(best, 6),
+        "links_found": len(links),
+        "mib_per_second": round(len(html) / best / 2 ** 20, 2) if best else None,
+    }
+
+
+def run(link_counts: List[int], repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for layout in ("lines", "single_line", "wrapped", "other_links"):
+        for link_count in link_counts:
+            html = make_page(link_count, layout)
+            result = {
+                "layout": layout,
+                "links": link_count,
+                "page_bytes": len(html),
+                "tokenizer": measure(extract_with_tokenizer, html, repeat),
+            }
+
+            longest_line = max(len(line) for line in html.split("\n"))
+            if longest_line <= LEGACY_MAX_LINE_LENGTH:
+                result["regex"] = measure(extract_with_regex, html, repeat)
+            else:
+                result["regex"] = {"skipped": f"{longest_line} character line"}
+
+            print(
+                f"{layout:>11} {link_count:>6} links: tokenizer "
+                f"{result['tokenizer']['seconds']:.4f}s, regex "
+                f"{result['regex'].get('seconds', 'skipped')}",
+                file=sys.stderr,
+            )
+            results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--links",
+        type=int,
+        nargs="+",
+        default=DEFAULT_LINK_COUNTS,
+        help="The number of challenge links on each page",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="How many times to time each page"
+    )
+    parser.add_argument("-o", "--output", help="Write the results to this file")
+    args = parser.parse_args()
+
+    output = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "results": run(args.links, args.repeat),
+    }
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
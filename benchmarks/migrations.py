@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Benchmark migrating a large database from the first schema version
+
+Creates a database at schema version 0 filled with synthetic rooms, then runs each
+migration against it with an in-process fake reddit, and prints how long each took
+as JSON.
+
+Usage:
+    python -m benchmarks.migrations [--rooms 100000] [--challenges 1000]
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from benchmarks.fakes import FakeReddit, challenge_id
+from benchmarks.run import DatabaseTimer, database_url, peak_rss_kib, write_config
+from drawing_challenge_bot import __version__
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.storage import MIGRATIONS, Storage
+
+# How many rooms to insert into the database at a time when seeding it
+SEED_BATCH_SIZE = 5000
+
+# When the synthetic rooms were last posted to
+POSTED_TIMESTAMP = 1600000000
+
+
+def seed_v0_database(store: Storage, room_count: int, challenge_count: int):
+    """Make a function that creates the version 0 schema and fills it with rooms,
+    given a cursor
+
+    Every room but one in ten has been posted one of the challenges, spread evenly.
+    """
+
+    def seed(cursor):
+        store._initial_db_setup(cursor)
+
+        for start in range(0, room_count, SEED_BATCH_SIZE):
+            rows = []
+            for index in range(start, min(start + SEED_BATCH_SIZE, room_count)):
+                if index % 10 == 0:
+                    rows.append((f"!room{index}:example.com", None, None))
+                else:
+                    rows.append(
+                        (
+                            f"!room{index}:example.com",
+                            challenge_id(index % challenge_count),
+                            POSTED_TIMESTAMP,
+                        )
+                    )
+
+            store._execute_values(
+                cursor,
+                """
+                INSERT INTO room_post (room_id, last_challenge_id, posted_timestamp)
+                VALUES {}
+            """,
+                rows,
+            )
+
+    return seed
+
+
+async def run_scenario(
+    room_count: int, challenge_count: int, options: Dict[str, Any]
+) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        with database_url(directory, options["postgres"]) as database:
+            config = write_config(directory, database, options)
+
+            fake_reddit = FakeReddit(challenge_count, latency=options["reddit_latency"])
+            reddit = AsyncReddit(fake_reddit, max_workers=config.reddit_max_workers)
+
+            store = Storage(config, reddit)
+            try:
+                await store.db.write(
+                    seed_v0_database(store, room_count, challenge_count),
+                    transaction=True,
+                )
+
+                timer = DatabaseTimer(store)
+                migrations = {}
+                for migration in MIGRATIONS:
+                    timer.reset()
+                    requests_before = fake_reddit.request_count
+
+                    start = time.perf_counter()
+                    await store._run_db_migration(migration)
+
+                    migrations[f"v{migration.version}"] = {
+                        "description": migration.description,
+                        "wall_time": time.perf_counter() - start,
+                        "db_time": timer.elapsed,
+                        "reddit_requests": fake_reddit.request_count - requests_before,
+                    }
+            finally:
+                store.close()
+
+    return {
+        "backend": "postgres" if options["postgres"] else "sqlite",
+        "rooms": room_count,
+        "challenges": challenge_count,
+        "migrations": migrations,
+        "total_wall_time": sum(m["wall_time"] for m in migrations.values()),
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--rooms", type=int, default=100000, help="The number of rooms to migrate"
+    )
+    parser.add_argument(
+        "--challenges",
+        type=int,
+        default=1000,
+        help="The number of distinct challenges that have been posted to rooms",
+    )
+    parser.add_argument(
+        "--postgres",
+        metavar="CONNECTION_STRING",
+        help="Also benchmark against this Postgres database. Tables are created in a "
+        "temporary schema",
+    )
+    parser.add_argument(
+        "--reddit-latency",
+        type=float,
+        default=0.0,
+        help="Seconds that each reddit request takes",
+    )
+    parser.add_argument(
+        "--log-level", default="WARNING", help="The bot's logging level"
+    )
+    parser.add_argument(
+        "--output", "-o", help="Write results to this file rather than stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+
+    backends = [None]
+    if args.postgres:
+        backends.append(args.postgres)
+
+    results = []
+    for postgres in backends:
+        options = {
+            "postgres": postgres,
+            "reddit_latency": args.reddit_latency,
+            "concurrency": 10,
+            "max_rate_limit_retries": 5,
+            "log_level": args.log_level,
+        }
+
+        print(
+            f"Migrating {args.rooms} rooms on {'postgres' if postgres else 'sqlite'}...",
+            file=sys.stderr,
+        )
+        loop = asyncio.get_event_loop()
+        results.append(
+            loop.run_until_complete(run_scenario(args.rooms, args.challenges, options))
+        )
+
+    output = json.dumps(
+        {
+            "version": __version__,
+            "python": platform.python_version(),
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
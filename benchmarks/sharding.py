@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""Check that several bot instances share rooms through one Postgres database
+
+Starts several instances of the bot in separate processes, each with its own fake
+homeserver, all sharing one Postgres database full of rooms that are due a challenge.
+One instance's fake homeserver never answers, and that instance is killed once it has
+claimed some rooms. The remaining instances must take over its rooms, every room must
+be posted to exactly once, and a late instance must be given an equal share of the
+rooms. By then the rooms are caught up as if they had been sent the newest challenge
+long ago, so that they're idle but still due. The results
+are printed as JSON, and the exit code is non-zero on failure.
+
+Usage:
+    python -m benchmarks.sharding --postgres CONNECTION_STRING [--instances 3]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import platform
+import queue
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List
+
+from nio import RoomSendResponse
+
+from benchmarks.fakes import FakeAsyncClient, FakeReddit, FakeSubmission
+from benchmarks.run import add_rooms, database_url, write_config
+from drawing_challenge_bot import __version__
+from drawing_challenge_bot.challenge_poster import ChallengePoster
+from drawing_challenge_bot.config import Config
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.scheduler import Scheduler
+from drawing_challenge_bot.storage import ONE_WEEK_IN_SECONDS, Storage
+
+# How many challenges are on the fake wiki
+CHALLENGE_COUNT = 10
+
+# How often instances send heartbeats, and how long until they're considered stopped,
+# in seconds. Much shorter than the defaults, so that the check runs quickly
+HEARTBEAT_INTERVAL = 0.5
+INSTANCE_TIMEOUT = 3
+
+# How long a hung send takes, in seconds. Longer than the check can run for
+HUNG_SEND_LATENCY = 3600
+
+# How often to check the database for progress, in seconds
+POLL_INTERVAL = 0.1
+
+
+class RecordingClient(FakeAsyncClient):
+    """A fake client that reports every message it sends successfully"""
+
+    def __init__(self, instance_id: str, sends: multiprocessing.Queue, **kwargs):
+        super().__init__(**kwargs)
+        self.instance_id = instance_id
+        self.sends = sends
+
+    async def room_send(
+        self, room_id, message_type, content, ignore_unverified_devices=False
+    ):
+        response = await super().room_send(
+            room_id, message_type, content, ignore_unverified_devices
+        )
+        if isinstance(response, RoomSendResponse):
+            self.sends.put((self.instance_id, room_id))
+        return response
+
+
+def instance_config(
+    directory: str, database: str, instance_id: str, options: Dict[str, Any]
+) -> Config:
+    """Load the config of an instance that shares rooms with the others"""
+    config = write_config(directory, database, options)
+    config.sharding_enabled = True
+    config.sharding_instance_id = instance_id
+    config.sharding_heartbeat_interval = HEARTBEAT_INTERVAL
+    config.sharding_instance_timeout = INSTANCE_TIMEOUT
+    config.session_preshare_window = 0
+    return config
+
+
+async def run_instance_async(
+    instance_id: str,
+    database: str,
+    send_latency: float,
+    sends: multiprocessing.Queue,
+    options: Dict[str, Any],
+):
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        config = instance_config(directory, database, instance_id, options)
+
+        reddit = AsyncReddit(FakeReddit(CHALLENGE_COUNT), max_workers=1)
+        client = RecordingClient(instance_id, sends, latency=send_latency)
+
+        store = Storage(config, reddit)
+        await store.setup()
+
+        poster = ChallengePoster(client, config, store, reddit)
+        scheduler = Scheduler()
+        poster.add_jobs(scheduler, start_at=time.time())
+        scheduler.start()
+
+        # Run until killed
+        await asyncio.Event().wait()
+
+
+def run_instance(*args):
+    """Run an instance of the bot. Called in a fresh process"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(run_instance_async(*args))
+
+
+def query(store: Storage, sql: str, args=()) -> List[tuple]:
+    """Run a query against the shared database from the checking process"""
+
+    def read(cursor):
+        store._execute(cursor, sql, args)
+        return cursor.fetchall()
+
+    return asyncio.get_event_loop().run_until_complete(store.db.read(read))
+
+
+def execute(store: Storage, sql: str, args=()):
+    """Run a statement against the shared database from the checking process"""
+    return asyncio.get_event_loop().run_until_complete(
+        store.db.write(lambda cursor: store._execute(cursor, sql, args))
+    )
+
+
+def wait_for(condition: Callable[[], bool], timeout: float) -> float:
+    """Wait until a condition is true
+
+    Returns:
+        How long it took, in seconds
+
+    Raises:
+        TimeoutError: If the condition isn't true within the timeout
+    """
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError
+        time.sleep(POLL_INTERVAL)
+    return time.perf_counter() - start
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    options = {
+        "concurrency": 10,
+        "max_rate_limit_retries": 5,
+        "log_level": args.log_level,
+    }
+    context = multiprocessing.get_context("spawn")
+    sends = context.Queue()
+    processes: Dict[str, multiprocessing.Process] = {}
+
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        with database_url(directory, args.postgres) as database:
+            config = instance_config(directory, database, "checker", options)
+            store = Storage(config, AsyncReddit(FakeReddit(0), max_workers=1))
+
+            def start(instance_id: str, send_latency: float):
+                process = context.Process(
+                    target=run_instance,
+                    args=(instance_id, database, send_latency, sends, options),
+                    daemon=True,
+                )
+                process.start()
+                processes[instance_id] = process
+
+            def owned_rooms() -> Dict[str, int]:
+                return dict(
+                    query(
+                        store,
+                        """
+                        SELECT lease_owner, COUNT(*) FROM room
+                        WHERE lease_owner IS NOT NULL GROUP BY lease_owner
+                    """,
+                    )
+                )
+
+            def instance_count() -> int:
+                return query(store, "SELECT COUNT(*) FROM bot_instance")[0][0]
+
+            def posted_rooms() -> int:
+                return query(
+                    store,
+                    "SELECT COUNT(*) FROM room_post WHERE last_challenge_id IS NOT NULL",
+                )[0][0]
+
+            def balanced(instance_ids: List[str]) -> bool:
+                owned = owned_rooms()
+                counts = [owned.get(instance_id, 0) for instance_id in instance_ids]
+                share = math.ceil(args.rooms / len(instance_ids))
+                return sum(counts) == args.rooms and max(counts) <= share
+
+            try:
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(store.setup())
+                loop.run_until_complete(
+                    add_rooms(
+                        store,
+                        config.sources[0].name,
+                        [
+                            (f"!room{index}:example.com", None)
+                            for index in range(args.rooms)
+                        ],
+                    )
+                )
+
+                # The first instance hangs on every send, and is killed once it has
+                # claimed some rooms
+                hung_instance_id = "instance0"
+                start(hung_instance_id, HUNG_SEND_LATENCY)
+                for index in range(1, args.instances):
+                    start(f"instance{index}", args.send_latency)
+
+                wait_for(
+                    lambda: instance_count() == args.instances
+                    and owned_rooms().get(hung_instance_id, 0) > 0,
+                    args.timeout,
+                )
+                stranded_rooms = owned_rooms().get(hung_instance_id, 0)
+                processes.pop(hung_instance_id).kill()
+
+                print(
+                    f"Killed {hung_instance_id} holding {stranded_rooms} rooms",
+                    file=sys.stderr,
+                )
+                takeover_time = wait_for(
+                    lambda: posted_rooms() == args.rooms, args.timeout
+                )
+
+                # Catch every room up, as if it had been sent the newest challenge
+                # over a week ago. The rooms stay due until a newer challenge is
+                # posted, but there's nothing to send them. A new instance should still
+                # be given its share of them
+                newest = FakeSubmission(CHALLENGE_COUNT - 1)
+                execute(
+                    store,
+                    """
+                    UPDATE room_post SET last_challenge_id = ?,
+                        reddit_posted_timestamp = ?, next_due_timestamp = ?
+                """,
+                    (
+                        newest.id,
+                        newest.created_utc,
+                        int(time.time()) - ONE_WEEK_IN_SECONDS,
+                    ),
+                )
+
+                late_instance_id = f"instance{args.instances}"
+                start(late_instance_id, args.send_latency)
+                rebalance_time = wait_for(
+                    lambda: balanced(list(processes)), args.timeout
+                )
+                final_owned_rooms = owned_rooms()
+
+                # Count every message sent by every instance. Nothing is being sent
+                # any more, so the queue only needs to be drained
+                sent_to = Counter()
+                sent_by = Counter()
+                while True:
+                    try:
+                        instance_id, room_id = sends.get(timeout=1)
+                    except queue.Empty:
+                        break
+                    sent_to[room_id] += 1
+                    sent_by[instance_id] += 1
+            finally:
+                for process in processes.values():
+                    process.kill()
+                store.close()
+
+    double_posted = sum(1 for count in sent_to.values() if count > 1)
+    missed = args.rooms - len(sent_to)
+
+    return {
+        "instances": args.instances,
+        "rooms": args.rooms,
+        "rooms_held_by_killed_instance": stranded_rooms,
+        "takeover_seconds": round(takeover_time, 2),
+        "rebalance_seconds": round(rebalance_time, 2),
+        "messages_sent_by_instance": dict(sorted(sent_by.items())),
+        "final_rooms_by_instance": dict(sorted(final_owned_rooms.items())),
+        "double_posted_rooms": double_posted,
+        "missed_rooms": missed,
+        "passed": double_posted == 0 and missed == 0,
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--postgres",
+        metavar="CONNECTION_STRING",
+        required=True,
+        help="The Postgres database to share. Tables are created in a temporary "
+        "schema",
+    )
+    parser.add_argument(
+        "--instances",
+        type=int,
+        default=3,
+        help="How many instances to start with, including the one that is killed",
+    )
+    parser.add_argument(
+        "--rooms", type=int, default=3000, help="How many rooms to share"
+    )
+    parser.add_argument(
+        "--send-latency",
+        type=float,
+        default=0.001,
+        help="Seconds that each message send takes",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="How long to wait for rooms to be taken over or rebalanced, in seconds",
+    )
+    parser.add_argument(
+        "--log-level", default="WARNING", help="The bot's logging level"
+    )
+    parser.add_argument(
+        "--output", "-o", help="Write results to this file rather than stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+    if args.instances < 2:
+        sys.exit("--instances must be at least 2, so that one can be killed")
+
+    result = run(args)
+
+    output = json.dumps(
+        {
+            "version": __version__,
+            "python": platform.python_version(),
+            "result": result,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if not result["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Benchmark the per-call overhead of the statements the bot runs most often
+
+Runs each of the hot read statements many times through Storage against a database
+of synthetic rooms, and prints the mean time per call as JSON. Postgres is measured
+with and without prepared statements.
+
+Usage:
+    python -m benchmarks.statements [--calls 2000] [--postgres CONNECTION_STRING]
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from benchmarks.fakes import FakeReddit
+from benchmarks.run import add_rooms, database_url, write_config
+from drawing_challenge_bot import __version__
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.storage import Storage
+
+# How many rooms to fill the database with
+ROOM_COUNT = 10000
+
+
+async def seed(store: Storage, source: str):
+    await add_rooms(
+        store,
+        source,
+        [(f"!room{index}:example.com", None) for index in range(ROOM_COUNT)],
+    )
+
+    # A long-running database would have gathered statistics about the rooms by
+    # now, which the query planner relies on
+    await store.db.write(
+        lambda cursor: store._execute(cursor, "ANALYZE"), transaction=True
+    )
+
+
+def hot_calls(store: Storage, source: str) -> Dict[str, Callable[[], Awaitable[Any]]]:
+    """The calls to measure, by name"""
+    challenge_ids = [f"challenge{index}" for index in range(10)]
+
+    async def due_rooms_page():
+        async for _ in store.get_due_rooms(source, 0, limit=10):
+            break
+
+    return {
+        "get_next_due_timestamp": lambda: store.get_next_due_timestamp(
+            [source], after=0
+        ),
+        "get_room_count": store.get_room_count,
+        "get_due_rooms": due_rooms_page,
+        "get_challenges": lambda: store.get_challenges(challenge_ids),
+    }
+
+
+async def run_scenario(
+    postgres: Optional[str], prepared_statements: bool, calls: int
+) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        with database_url(directory, postgres) as database:
+            options = {
+                "concurrency": 10,
+                "max_rate_limit_retries": 5,
+                "log_level": "WARNING",
+            }
+            config = write_config(directory, database, options)
+            config.database["prepared_statements"] = prepared_statements
+
+            reddit = AsyncReddit(FakeReddit(0), max_workers=1)
+            store = Storage(config, reddit)
+            try:
+                await store.setup()
+                source = config.sources[0].name
+                await seed(store, source)
+
+                results = {}
+                for name, call in hot_calls(store, source).items():
+                    # Warm up connections and caches
+                    for _ in range(10):
+                        await call()
+
+                    start = time.perf_counter()
+                    for _ in range(calls):
+                        await call()
+                    elapsed = time.perf_counter() - start
+
+                    results[name] = {"us_per_call": round(elapsed / calls * 1e6, 1)}
+            finally:
+                store.close()
+
+    return {
+        "backend": "postgres" if postgres else "sqlite",
+        "prepared_statements": prepared_statements if postgres else None,
+        "calls": results,
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--calls", type=int, default=2000, help="How many times to make each call"
+    )
+    parser.add_argument(
+        "--postgres",
+        metavar="CONNECTION_STRING",
+        help="Also benchmark against this Postgres database. Tables are created in a "
+        "temporary schema",
+    )
+    parser.add_argument(
+        "--output", "-o", help="Write results to this file rather than stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = parse_args(argv)
+
+    scenarios = [(None, False)]
+    if args.postgres:
+        scenarios += [(args.postgres, False), (args.postgres, True)]
+
+    loop = asyncio.get_event_loop()
+    results = [
+        loop.run_until_complete(run_scenario(postgres, prepared, args.calls))
+        for postgres, prepared in scenarios
+    ]
+
+    output = json.dumps(
+        {
+            "version": __version__,
+            "python": platform.python_version(),
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
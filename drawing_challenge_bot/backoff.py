@@ -0,0 +1,32 @@
+import random
+
+
+class Backoff(object):
+    """Exponential backoff with jitter, for retrying something that keeps failing
+
+    Each delay is picked at random between half of an upper bound and the upper bound
+    itself. The upper bound doubles with each consecutive failure. Randomising the
+    delay stops many clients that failed at the same time from retrying in lockstep.
+
+    Args:
+        initial: The upper bound of the first delay, in seconds
+        maximum: The largest upper bound a delay can have, in seconds
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 300.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+
+    def next_delay(self) -> float:
+        """Record a failure and get how long to wait before trying again, in seconds"""
+        bound = min(self.maximum, self.initial * 2 ** self.failures)
+
+        # Stop counting once the maximum has been reached, so the bound can't overflow
+        if bound < self.maximum:
+            self.failures += 1
+        return random.uniform(bound / 2, bound)
+
+    def reset(self):
+        """Record a success, so that the next failure is retried quickly"""
+        self.failures = 0
@@ -3,8 +3,13 @@ import logging
 from nio import AsyncClient, MatrixRoom
 from nio.events.room_events import RoomMessageText
 
+from drawing_challenge_bot.challenge_poster import POST_CHALLENGES_JOB
 from drawing_challenge_bot.chat_functions import send_text_to_room
 from drawing_challenge_bot.config import Config
+from drawing_challenge_bot.errors import CommandError
+from drawing_challenge_bot.scheduler import Scheduler
+from drawing_challenge_bot.source import Source
+from drawing_challenge_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +18,9 @@ class Command(object):
     def __init__(
         self,
         client: AsyncClient,
+        store: Storage,
         config: Config,
+        scheduler: Scheduler,
         command: str,
         room: MatrixRoom,
         event: RoomMessageText,
@@ -22,13 +29,17 @@ class Command(object):
 
         Args:
             client: The client to communicate to matrix with
+            store: Bot storage
             config: Bot configuration parameters
+            scheduler: Scheduler running the bot's jobs
             command: The command and arguments
             room: The room the command was sent in
             event: The event describing the command
         """
         self.client = client
+        self.store = store
         self.config = config
+        self.scheduler = scheduler
         self.room = room
         self.event = event
 
@@ -46,6 +57,12 @@ class Command(object):
         """Process the command"""
         if self.command == "help":
             await self._help()
+        elif self.command == "sources":
+            await self._sources()
+        elif self.command == "subscribe":
+            await self._subscribe()
+        elif self.command == "unsubscribe":
+            await self._unsubscribe()
 
     async def _help(self):
         """Show the help text"""
@@ -59,13 +76,72 @@ class Command(object):
         topic = self.args[0]
         if topic == "commands":
             text = """
-I post about weekly drawing challenges from /r/MLPDrawingSchool!
+I post about weekly drawing challenges from subreddits!
+
+`sources` - list the subreddits I can post challenges from
+`subscribe <source>` - post challenges from a source in this room
+`unsubscribe <source>` - stop posting challenges from a source in this room
 """
         else:
             text = "Unknown help topic!"
 
         await send_text_to_room(self.client, self.room.room_id, text)
 
+    async def _sources(self):
+        """List the sources that rooms can subscribe to"""
+        subscriptions = await self.store.get_subscriptions(self.room.room_id)
+
+        lines = ["Sources I can post challenges from:"]
+        for source in self.config.sources:
+            line = f"`{source.name}` - /r/{source.subreddit}"
+            if source.name in subscriptions:
+                line += " (subscribed)"
+            lines.append(line)
+
+        await send_text_to_room(self.client, self.room.room_id, "\n".join(lines))
+
+    async def _subscribe(self):
+        """Subscribe the room to a source"""
+        source = self._get_source()
+
+        if not await self.store.subscribe(self.room.room_id, source.name):
+            text = f"This room is already subscribed to `{source.name}`."
+            await send_text_to_room(self.client, self.room.room_id, text)
+            return
+
+        text = f"Subscribed to `{source.name}`! I'll post its first challenge shortly."
+        await send_text_to_room(self.client, self.room.room_id, text)
+
+        # Post the source's first challenge to the room straight away
+        self.scheduler.wake(POST_CHALLENGES_JOB)
+
+    async def _unsubscribe(self):
+        """Unsubscribe the room from a source"""
+        source = self._get_source()
+
+        if await self.store.unsubscribe(self.room.room_id, source.name):
+            text = f"Unsubscribed from `{source.name}`."
+        else:
+            text = f"This room isn't subscribed to `{source.name}`."
+        await send_text_to_room(self.client, self.room.room_id, text)
+
+    def _get_source(self) -> Source:
+        """Get the source named by the command's argument
+
+        Raises:
+            CommandError: If no source was named, or there is no source with the name
+        """
+        if not self.args:
+            raise CommandError(f"Usage: {self.command} <source>")
+
+        for source in self.config.sources:
+            if source.name == self.args[0]:
+                return source
+
+        raise CommandError(
+            f"Unknown source '{self.args[0]}'. Use `sources` to list the sources."
+        )
+
     async def _unknown_command(self):
         """Computer says 'no'."""
         await send_text_to_room(
@@ -3,10 +3,14 @@ import logging
 from nio import AsyncClient, InviteMemberEvent, JoinError, MatrixRoom, RoomMemberEvent
 
 from drawing_challenge_bot.bot_commands import Command
+from drawing_challenge_bot.challenge_poster import POST_CHALLENGES_JOB
 from drawing_challenge_bot.chat_functions import send_text_to_room
 from drawing_challenge_bot.config import Config
 from drawing_challenge_bot.errors import CommandError
+from drawing_challenge_bot.scheduler import Scheduler
+from drawing_challenge_bot.source import Source
 from drawing_challenge_bot.storage import Storage
+from drawing_challenge_bot.sync_filter import SYNC_FILTER
 
 logger = logging.getLogger(__name__)
 
@@ -18,14 +22,16 @@ class Callbacks(object):
         client: nio client used to interact with matrix
         store: Bot storage
         config: Bot configuration parameters
+        scheduler: Scheduler running the bot's jobs
     """
 
     def __init__(
-        self, client: AsyncClient, store: Storage, config: Config,
+        self, client: AsyncClient, store: Storage, config: Config, scheduler: Scheduler,
     ):
         self.client = client
         self.store = store
         self.config = config
+        self.scheduler = scheduler
         self.command_prefix = config.command_prefix
 
         # A little hack to work around the fact that matrix-nio calls invite() twice when
@@ -52,10 +58,16 @@ class Callbacks(object):
         if not msg.startswith(self.command_prefix):
             return
 
+        # When sharding, only the instance handling the room responds
+        if not await self.store.owns_room(room.room_id):
+            return
+
         logger.debug("Command received: %s", msg)
 
         # Assume this is a command and attempt to process
-        command = Command(self.client, self.config, msg, room, event,)
+        command = Command(
+            self.client, self.store, self.config, self.scheduler, msg, room, event,
+        )
 
         try:
             await command.process()
@@ -102,22 +114,31 @@ class Callbacks(object):
 
         # Note that we've joined this room
         self.joined_rooms[room.room_id] = True
-        self.store.upsert_challenge_for_room(room.room_id, challenge=None)
+        # New rooms are subscribed to the first source
+        source = self.config.sources[0]
+        if not await self.store.add_room(room.room_id, source.name):
+            logger.info("Room %s is handled by another instance", room.room_id)
+            return
 
         # Wait for the room state to sync
-        await self.client.sync()
+        await self.client.sync(sync_filter=SYNC_FILTER)
 
         # Greet the room with a friendly message
-        await self._greet_room(room.room_id)
+        await self._greet_room(room.room_id, source)
 
-    async def _greet_room(self, room_id: str):
-        """Say hello to a new room"""
-        text = """
-Hello! I'm a bot that posts weekly art challenges from /r/MLPDrawingSchool!
+        # Post the first challenge to the room straight away
+        self.scheduler.wake(POST_CHALLENGES_JOB)
+
+    async def _greet_room(self, room_id: str, source: Source):
+        """Say hello to a new room, which has been subscribed to a source"""
+        text = f"""
+Hello! I'm a bot that posts weekly art challenges from /r/{source.subreddit}!
 
 In a moment, I'll post the first one. Then, a week later I'll post another one.
 I'll keep doing this until I run out of challenges. But fear not, as more are
-posted to /r/MLPDrawingSchool, I'll continue to post them here!
+posted to /r/{source.subreddit}, I'll continue to post them here!
+
+Use `{self.command_prefix} sources` to see the other subreddits I can post from.
 
 Have fun, and happy drawing /)^3^(\\\\!
         """
@@ -135,8 +156,8 @@ Have fun, and happy drawing /)^3^(\\\\!
                 event.membership,
                 room.room_id,
             )
-            self._kick_or_ban(room.room_id)
+            await self._kick_or_ban(room.room_id)
 
-    def _kick_or_ban(self, room_id: str):
+    async def _kick_or_ban(self, room_id: str):
         """When we're kicked or banned, delete the entry for the room"""
-        self.store.delete_room_entry(room_id)
+        await self.store.delete_room_entry(room_id)
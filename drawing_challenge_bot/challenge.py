@@ -0,0 +1,46 @@
+from praw.reddit import Submission
+
+
+class Challenge(object):
+    """A drawing challenge that was posted to reddit
+
+    Holds the handful of submission attributes the bot needs, so that challenges can
+    be cached in the database instead of being fetched from reddit every time.
+
+    Args:
+        challenge_id: The reddit ID of the challenge submission
+        created_utc: When the submission was posted to reddit
+        title: The title of the submission
+        selftext: The body of the submission
+        url: The URL of the submission
+    """
+
+    def __init__(
+        self,
+        challenge_id: str,
+        created_utc: float,
+        title: str,
+        selftext: str,
+        url: str,
+    ):
+        self.id = challenge_id
+        self.created_utc = created_utc
+        self.title = title
+        self.selftext = selftext
+        self.url = url
+
+    @classmethod
+    def from_submission(cls, submission: Submission) -> "Challenge":
+        """Create a Challenge from a praw Submission. Fetches the submission if it
+        hasn't been already
+        """
+        return cls(
+            submission.id,
+            submission.created_utc,
+            submission.title,
+            submission.selftext,
+            submission.url,
+        )
+
+    def __repr__(self):
+        return f"<Challenge {self.id} created_utc={self.created_utc}>"
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from typing import Dict, List, Set
+
+from drawing_challenge_bot.challenge import Challenge
+from drawing_challenge_bot.metrics import CACHE_LOOKUPS
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ChallengeCache(object):
+    """Looks up challenges for the scrapers of every source
+
+    Challenges are read from the database cache, and only fetched from reddit if they
+    aren't cached. Sources are scraped concurrently and may link to the same
+    challenges, so a challenge that is already being looked up for one scraper is
+    waited for by any other scraper that wants it, rather than being fetched twice.
+
+    Args:
+        store: The storage to cache challenges in
+        reddit: The reddit instance to fetch challenges with
+    """
+
+    def __init__(self, store: Storage, reddit: AsyncReddit):
+        self.store = store
+        self.reddit = reddit
+
+        # The lookups in progress, by the ID of each challenge being looked up. Each
+        # resolves to the challenges it found
+        self._pending: Dict[str, "asyncio.Future[Dict[str, Challenge]]"] = {}
+
+    async def get_challenges(self, challenge_ids: List[str]) -> List[Challenge]:
+        """Get challenges from the database cache, or from reddit if they aren't
+        cached
+
+        Args:
+            challenge_ids: The IDs of the challenges to get
+
+        Returns:
+            The challenges that could be found. Challenges that have been deleted from
+            reddit are omitted
+        """
+        if not challenge_ids:
+            return []
+
+        challenge_ids = list(dict.fromkeys(challenge_ids))
+
+        # Wait for challenges that are already being looked up
+        waiting: Set[asyncio.Future] = set()
+        missing = []
+        for challenge_id in challenge_ids:
+            future = self._pending.get(challenge_id)
+            if future is not None:
+                waiting.add(future)
+            else:
+                missing.append(challenge_id)
+
+        challenges: Dict[str, Challenge] = {}
+        if missing:
+            future = asyncio.get_event_loop().create_future()
+            for challenge_id in missing:
+                self._pending[challenge_id] = future
+
+            loaded: Dict[str, Challenge] = {}
+            try:
+                loaded = await self._load_challenges(missing)
+            finally:
+                for challenge_id in missing:
+                    del self._pending[challenge_id]
+
+                # Anyone waiting on a lookup that failed finds nothing, and tries again
+                # on their next scrape
+                future.set_result(loaded)
+
+            challenges.update(loaded)
+
+        if waiting:
+            await asyncio.wait(waiting)
+            for future in waiting:
+                challenges.update(future.result())
+
+        return [
+            challenges[challenge_id]
+            for challenge_id in challenge_ids
+            if challenge_id in challenges
+        ]
+
+    async def _load_challenges(self, challenge_ids: List[str]) -> Dict[str, Challenge]:
+        """Look up challenges in the database, and fetch any that aren't there from
+        reddit
+        """
+        # Look up the challenges we already know about
+        challenges = await self.store.get_challenges(challenge_ids)
+        CACHE_LOOKUPS.labels("challenge", "hit").inc(len(challenges))
+        CACHE_LOOKUPS.labels("challenge", "miss").inc(
+            len(challenge_ids) - len(challenges)
+        )
+
+        # Fetch any new challenges from reddit in batches and cache them
+        submissions = await self.reddit.fetch_submissions(
+            [
+                challenge_id
+                for challenge_id in challenge_ids
+                if challenge_id not in challenges
+            ],
+        )
+        new_challenges = [
+            Challenge.from_submission(submission) for submission in submissions.values()
+        ]
+
+        if new_challenges:
+            logger.info("Found %d new challenges", len(new_challenges))
+            await self.store.store_challenges(new_challenges)
+
+        challenges.update((challenge.id, challenge) for challenge in new_challenges)
+        return challenges
@@ -0,0 +1,108 @@
+import html
+import re
+from typing import Iterator, List, Pattern
+
+# The text that a link must contain to be a link to a challenge, by default
+CHALLENGE_LINK_TEXT = "Drawing Challenge"
+CHALLENGE_LINK_PATTERN = re.escape(CHALLENGE_LINK_TEXT)
+CHALLENGE_LINK_REGEX = re.compile(CHALLENGE_LINK_PATTERN)
+
+# Matches the opening and closing tags of links. Attributes are matched with a
+# negated character class, which can't backtrack past the end of the tag
+LINK_TAG_REGEX = re.compile(r"<(/?)a\b([^>]*)>", re.IGNORECASE)
+
+# Matches the href attribute of a link's opening tag, quoted or not
+HREF_REGEX = re.compile(
+    r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.IGNORECASE
+)
+
+# Matches any tag, for removing formatting from the text of a link
+TAG_REGEX = re.compile(r"<[^>]*>")
+
+
+def iter_challenge_links(
+    wiki_html: str, link_pattern: Pattern[str] = CHALLENGE_LINK_REGEX
+) -> Iterator[str]:
+    """Find the URLs of links to challenges in a HTML document
+
+    A link is a challenge link if it points to an http(s) URL and its text matches
+    `link_pattern`. The document is tokenized in a single pass over its link tags, so
+    links are found wherever they are, including links that span multiple lines or
+    share a line with other links.
+
+    Args:
+        wiki_html: The HTML to search
+        link_pattern: A regex that is searched for in the text of each link, with
+            whitespace collapsed to single spaces. Defaults to CHALLENGE_LINK_TEXT
+
+    Returns:
+        An iterator of the URLs of challenge links, in the order they appear
+    """
+    # The URL of the link that we're currently inside, and where its text starts
+    href = None
+    text_start = 0
+
+    for match in LINK_TAG_REGEX.finditer(wiki_html):
+        # Links can't be nested, so any tag ends the open link
+        if href is not None:
+            text = html.unescape(
+                TAG_REGEX.sub("", wiki_html[text_start : match.start()])
+            )
+
+            # Collapse whitespace, so that text broken over lines still matches
+            if link_pattern.search(" ".join(text.split())):
+                yield href
+            href = None
+
+        is_closing_tag, attributes = match.groups()
+        if is_closing_tag:
+            continue
+
+        href_match = HREF_REGEX.search(attributes)
+        if href_match:
+            url = html.unescape(
+                next(group for group in href_match.groups() if group is not None)
+            )
+            if url.startswith("http"):
+                href = url
+                text_start = match.end()
+
+
+def iter_link_segments(wiki_html: str) -> Iterator[str]:
+    """Split a HTML document into segments that can be searched for challenge links
+    independently
+
+    Each segment is a line, unless a link is still open at the end of the line, in
+    which case the following lines are joined on until the link is closed. A link
+    found by `iter_challenge_links` in the whole document is therefore always found
+    in exactly one segment. Lines that don't change between two versions of a
+    document give the same segments, so documents can be compared segment by segment.
+
+    Args:
+        wiki_html: The HTML to split
+
+    Returns:
+        An iterator of the segments of the document, in order
+    """
+    # The lines of the current segment, when a link is open
+    pending: List[str] = []
+    link_open = False
+
+    for line in wiki_html.split("\n"):
+        tags = LINK_TAG_REGEX.findall(line)
+        if tags:
+            # The link is open if the last link tag on the line is an opening tag
+            is_closing_tag, _ = tags[-1]
+            link_open = not is_closing_tag
+
+        if link_open:
+            pending.append(line)
+        elif pending:
+            pending.append(line)
+            yield "\n".join(pending)
+            pending = []
+        else:
+            yield line
+
+    if pending:
+        yield "\n".join(pending)
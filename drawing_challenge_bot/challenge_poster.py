@@ -1,88 +1,559 @@
+import bisect
+import functools
 import logging
-from datetime import datetime
-from typing import List
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from nio import AsyncClient
-from praw import Reddit
-from praw.reddit import Submission
+from nio import AsyncClient, ErrorResponse, Response, ShareGroupSessionResponse
 
-from drawing_challenge_bot.chat_functions import send_text_to_room
+from drawing_challenge_bot.challenge import Challenge
+from drawing_challenge_bot.challenge_cache import ChallengeCache
+from drawing_challenge_bot.chat_functions import make_text_content, send_content_to_room
 from drawing_challenge_bot.config import Config
+from drawing_challenge_bot.fan_out import FanOut, FanOutResult
+from drawing_challenge_bot.metrics import (
+    CACHE_LOOKUPS,
+    DUE_ROOMS,
+    GROUP_SESSION_PRESHARE_DURATION,
+    KNOWN_ROOMS,
+    OWNED_ROOMS,
+    SHARD_INSTANCES,
+    UPDATE_ROOMS_DURATION,
+    timed,
+)
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.scheduler import Scheduler
 from drawing_challenge_bot.scraper import Scraper
 from drawing_challenge_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
 
-ONE_WEEK_IN_SECONDS = 60 * 60 * 24 * 7
+# The names of the scheduler jobs that check a source for new challenges, suffixed
+# with the name of the source, and that post challenges
+CHECK_FOR_CHALLENGES_JOB = "check_for_challenges"
+POST_CHALLENGES_JOB = "post_challenges"
+
+# The name of the scheduler job that shares encryption sessions with encrypted rooms
+# before they're due a challenge
+PRESHARE_SESSIONS_JOB = "preshare_sessions"
+
+# The name of the scheduler job that keeps this instance's claim on its rooms alive,
+# when sharing rooms with other instances
+SHARD_HEARTBEAT_JOB = "shard_heartbeat"
+
+# The name of the scheduler job that counts the rooms for the known_rooms metric, and
+# how often it runs. Counting scans every room, so it isn't done on every posting round
+ROOM_COUNT_JOB = "room_count"
+ROOM_COUNT_INTERVAL_SECONDS = 60
+
+# How long to wait before trying rooms that we were rate limited in again
+RATE_LIMITED_RETRY_SECONDS = 60
+
+# How many due rooms to fetch from the database at a time
+DUE_ROOMS_PAGE_SIZE = 1000
+
+# Bump this whenever the challenge message template changes, so that challenges
+# rendered with an older template aren't reused
+CHALLENGE_TEMPLATE_VERSION = 1
+
+# How many rooms to mark as posted to in a single database transaction
+ROOM_STATE_FLUSH_SIZE = 500
+
+
+class PostingPlan(object):
+    """The rooms to post each challenge to"""
+
+    def __init__(self):
+        self._challenges: Dict[str, Challenge] = {}
+        self._room_ids: Dict[str, List[str]] = {}
+
+    def add(self, challenge: Challenge, room_ids: List[str]):
+        """Plan to post a challenge to the given rooms"""
+        self._challenges[challenge.id] = challenge
+        self._room_ids.setdefault(challenge.id, []).extend(room_ids)
+
+    def __iter__(self) -> Iterator[Tuple[Challenge, List[str]]]:
+        for challenge_id, challenge in self._challenges.items():
+            yield challenge, self._room_ids[challenge_id]
 
 
 class ChallengePoster:
     """"""
 
     def __init__(
-        self, client: AsyncClient, config: Config, store: Storage, reddit: Reddit
+        self, client: AsyncClient, config: Config, store: Storage, reddit: AsyncReddit
     ):
         self.client = client
         self.config = config
         self.store = store
         self.reddit = reddit
 
-        self.scraper = Scraper(config, store, reddit)
+        # Every source is scraped through the same reddit client and challenge cache,
+        # so that sources linking to the same challenges don't fetch them twice
+        self.challenge_cache = ChallengeCache(store, reddit)
+        self.scrapers = {
+            source.name: Scraper(config, source, reddit, self.challenge_cache)
+            for source in config.sources
+        }
+
+        # The latest scraped challenges of each source, sorted from oldest post date
+        # to newest
+        self.challenges: Dict[str, List[Challenge]] = {
+            source.name: [] for source in config.sources
+        }
+
+        # The scheduler running our jobs, if any
+        self.scheduler: Optional[Scheduler] = None
+
+        # Whether we've registered with the other instances sharing the rooms
+        self.shard_registered = False
 
-    async def scrape_and_post(self):
-        """Scrapes the latest challenge posts and updates any rooms if necessary"""
-        # Scrape latest challenge posts
-        challenges = self.scraper.scrape()
-        await self._update_rooms(challenges)
+        # Whether we're in the middle of posting challenges to rooms
+        self.posting = False
 
-    async def _update_rooms(self, challenges: List[Submission]):
-        """Posts the next challenge in a room if necessary
+        # Rendered challenge messages, keyed by challenge ID and template version
+        self._rendered_challenges: Dict[Tuple[str, int], Dict[str, str]] = {}
+
+        self.fan_out = FanOut(
+            concurrency=config.posting_concurrency,
+            max_retries=config.posting_max_rate_limit_retries,
+        )
+        self.preshare_fan_out = FanOut(
+            concurrency=config.session_preshare_concurrency,
+            max_retries=config.posting_max_rate_limit_retries,
+        )
+
+    def add_jobs(self, scheduler: Scheduler, start_at: float):
+        """Schedule checking for new challenges and posting them to rooms, and
+        claiming rooms from other instances when sharding
 
         Args:
-            challenges: A list of challenge submissions
+            scheduler: The scheduler to add jobs to
+            start_at: The timestamp at which to first run the jobs
+        """
+        self.scheduler = scheduler
+
+        # Each source is checked on its own schedule, so sources are scraped
+        # concurrently
+        for source in self.config.sources:
+            scheduler.add_job(
+                f"{CHECK_FOR_CHALLENGES_JOB}:{source.name}",
+                functools.partial(self.check_for_challenges, source.name),
+                run_at=start_at,
+                interval=source.poll_interval,
+            )
+        scheduler.add_job(
+            POST_CHALLENGES_JOB, self.post_due_challenges, run_at=start_at
+        )
+
+        if self.config.session_preshare_window > 0:
+            # Run at least once per window, to catch rooms whose due time has changed
+            scheduler.add_job(
+                PRESHARE_SESSIONS_JOB,
+                self.preshare_sessions,
+                run_at=start_at,
+                interval=self.config.session_preshare_window,
+            )
 
+        if self.config.sharding_enabled:
+            scheduler.add_job(
+                SHARD_HEARTBEAT_JOB,
+                self.shard_heartbeat,
+                run_at=start_at,
+                interval=self.config.sharding_heartbeat_interval,
+            )
+
+        if self.config.metrics_enabled:
+            scheduler.add_job(
+                ROOM_COUNT_JOB,
+                self.update_room_count,
+                run_at=start_at,
+                interval=ROOM_COUNT_INTERVAL_SECONDS,
+            )
+
+    async def check_for_challenges(self, source_name: str):
+        """Scrapes the latest challenge posts of a source. If they've changed, rooms are
+        checked for any challenges to post straight away
+
+        Args:
+            source_name: The name of the source to scrape
         """
-        rooms = self.store.get_rooms()
-        now_ts = datetime.utcnow().timestamp()
+        challenges = await self.scrapers[source_name].scrape()
 
-        logger.debug("Updating rooms...")
+        previous = self.challenges[source_name]
+        changed = [c.id for c in challenges] != [c.id for c in previous]
+        self.challenges[source_name] = challenges
 
-        for room_id, last_challenge_dict in rooms.items():
-            logger.debug("Checking room %s: %s", room_id, last_challenge_dict)
-
-            last_post_timestamp = last_challenge_dict["posted_timestamp"]
-            last_post_reddit_timestamp = last_challenge_dict["reddit_posted_timestamp"]
-
-            if (
-                last_post_timestamp is not None
-                and last_post_timestamp + ONE_WEEK_IN_SECONDS > now_ts
-            ):
-                # It hasn't been a week since we last posted in this room. Skip this room
-                continue
-
-            logger.debug("Time to post again in %s!", room_id)
-
-            # Iterate through each challenge in order of date
-            # Once we find a post that's newer than our last post
-            # (and it's been at least 1 week since our last post in the room)
-            # then post that challenge!
-            for challenge in challenges:
-                if (
-                    last_post_timestamp is not None
-                    and challenge.created_utc <= last_post_reddit_timestamp
+        if changed and self.scheduler:
+            logger.debug("Challenges of %s have changed, checking rooms", source_name)
+            self.scheduler.wake(POST_CHALLENGES_JOB)
+
+    async def post_due_challenges(self) -> Optional[float]:
+        """Posts challenges to any rooms that are due one
+
+        Returns:
+            The time.time() timestamp at which the next room is due a challenge, if any
+        """
+        rate_limited = await self._update_rooms()
+
+        now_ts = time.time()
+        next_due = await self.store.get_next_due_timestamp(
+            self.challenges, after=now_ts
+        )
+
+        if rate_limited:
+            # Try rooms that we were rate limited in again soon
+            retry_at = now_ts + RATE_LIMITED_RETRY_SECONDS
+            if next_due is None or retry_at < next_due:
+                next_due = retry_at
+
+        return next_due
+
+    async def update_room_count(self):
+        """Update the known_rooms metric with the number of rooms"""
+        KNOWN_ROOMS.set(await self.store.get_room_count())
+
+    async def shard_heartbeat(self):
+        """Keep this instance registered with the others sharing the rooms, and claim
+        or give up rooms so that every live instance has an equal share
+
+        Rooms are only claimed from the second heartbeat on, so that instances started
+        at the same time see each other before dividing the rooms between them.
+        Posting is checked again whenever rooms are claimed, as they may be due.
+        """
+        # Rooms aren't released while we're posting, as the rooms being posted to
+        # could otherwise be claimed and posted to by another instance too
+        state = await self.store.heartbeat(
+            claim=self.shard_registered, release=not self.posting
+        )
+        self.shard_registered = True
+
+        SHARD_INSTANCES.set(state.instances)
+        OWNED_ROOMS.set(state.owned)
+
+        if state.stopped_instance_ids:
+            logger.warning(
+                "Instances %s have stopped, releasing their %d rooms",
+                ", ".join(state.stopped_instance_ids),
+                state.orphaned,
+            )
+
+        if state.claimed or state.released:
+            logger.info(
+                "Claimed %d and released %d rooms. Now handling %d of %d rooms, "
+                "shared between %d instances",
+                state.claimed,
+                state.released,
+                state.owned,
+                state.rooms,
+                state.instances,
+            )
+
+        if state.claimed and self.scheduler:
+            self.scheduler.wake(POST_CHALLENGES_JOB)
+            if self.config.session_preshare_window > 0:
+                self.scheduler.wake(PRESHARE_SESSIONS_JOB)
+
+    async def leave_shard(self):
+        """Give up our rooms to the other instances sharing them, when stopping. Jobs
+        must have been stopped first
+
+        If a posting round is still running, the rooms are kept until our heartbeat
+        times out instead, so that the rooms being posted to aren't claimed and
+        posted to by another instance too.
+        """
+        if self.posting:
+            logger.warning(
+                "Still posting challenges, so not giving up our rooms. Other "
+                "instances will take them over once our heartbeat times out"
+            )
+            return
+
+        released = await self.store.leave_shard()
+        logger.info("Gave up %d rooms to the other instances", released)
+
+    async def preshare_sessions(self) -> Optional[float]:
+        """Share encryption sessions with encrypted rooms that will soon be due a
+        challenge
+
+        The first message sent to an encrypted room after its encryption session has
+        rotated has to share a new session with every device in the room first. Doing
+        that ahead of time means that posting a challenge only needs to encrypt and
+        send it, rather than every room doing the expensive part at the same moment.
+
+        Returns:
+            The time.time() timestamp at which the next room will be due a challenge
+            soon enough to share a session with, if any
+        """
+        window = self.config.session_preshare_window
+
+        now_ts = time.time()
+
+        if self.client.olm:
+            # Only look at rooms that will be posted to when they become due. A room
+            # may be due challenges from more than one source
+            room_ids: Dict[str, None] = {}
+            for source_name, challenges in self.challenges.items():
+                if not challenges:
+                    continue
+
+                async for rooms in self.store.get_due_rooms(
+                    source_name,
+                    now_ts + window,
+                    limit=DUE_ROOMS_PAGE_SIZE,
+                    newer_than=challenges[-1].created_utc,
                 ):
-                    # We've already posted this one
+                    room_ids.update(
+                        (room_id, None)
+                        for room_id in rooms
+                        if self._needs_group_session(room_id)
+                    )
+
+            if room_ids:
+                await self._preshare_sessions(list(room_ids))
+
+        next_due = await self.store.get_next_due_timestamp(
+            self.challenges, after=now_ts + window
+        )
+        if next_due is None:
+            return None
+
+        return next_due - window
+
+    def _needs_group_session(self, room_id: str) -> bool:
+        """Whether a room is encrypted and needs a new encryption session to be shared
+        with it before we can send to it
+        """
+        room = self.client.rooms.get(room_id)
+        return (
+            room is not None
+            and room.encrypted
+            and room_id not in self.client.sharing_session
+            and self.client.olm.should_share_group_session(room_id)
+        )
+
+    async def _preshare_sessions(self, room_ids: List[str]):
+        """Share encryption sessions with the given encrypted rooms"""
+        logger.info("Sharing encryption sessions with %d rooms", len(room_ids))
+
+        # How long each room took to share a session with, including loading its
+        # members, in seconds
+        durations: Dict[str, float] = {}
+
+        async def load_members(room_id: str) -> Optional[Response]:
+            start = time.perf_counter()
+            response = await self.client.joined_members(room_id)
+            durations[room_id] = durations.get(room_id, 0.0) + (
+                time.perf_counter() - start
+            )
+            return response
+
+        # Members are lazy-loaded, so the member lists of rooms we haven't sent to yet
+        # need to be fetched to know who to share with
+        unsynced_room_ids = [
+            room_id
+            for room_id in room_ids
+            if not self.client.rooms[room_id].members_synced
+        ]
+        result = await self.preshare_fan_out.run(
+            unsynced_room_ids, load_members, description="member list requests"
+        )
+
+        # Fetch the device keys of any new members
+        if self.client.should_query_keys:
+            response = await self.client.keys_query()
+            if isinstance(response, ErrorResponse):
+                logger.warning("Unable to query device keys: %s", response)
+
+        async def share(room_id: str) -> Optional[Response]:
+            # A challenge may have been posted to the room in the meantime, which
+            # shares a session itself
+            if not self._needs_group_session(room_id):
+                return ShareGroupSessionResponse(room_id, set())
+
+            start = time.perf_counter()
+            response = await self.client.share_group_session(
+                room_id, ignore_unverified_devices=True
+            )
+            durations[room_id] = durations.get(room_id, 0.0) + (
+                time.perf_counter() - start
+            )
+            return response
+
+        # Skip rooms whose members couldn't be loaded
+        room_ids = [
+            room_id
+            for room_id in room_ids
+            if room_id not in result.failed and room_id not in result.rate_limited
+        ]
+        result = await self.preshare_fan_out.run(
+            room_ids, share, description="encryption sessions"
+        )
+
+        for room_id in result.succeeded:
+            GROUP_SESSION_PRESHARE_DURATION.observe(durations[room_id])
+
+        if result.succeeded:
+            logger.info(
+                "Shared encryption sessions with %d rooms, taking %.1fms per room on "
+                "average. Posting to these rooms will only need to encrypt and send",
+                len(result.succeeded),
+                1000
+                * sum(durations[room_id] for room_id in result.succeeded)
+                / len(result.succeeded),
+            )
+
+    @timed(UPDATE_ROOMS_DURATION)
+    async def _update_rooms(self) -> int:
+        """Posts the next challenge of each source in a room if necessary
+
+        Returns:
+            The number of rooms that couldn't be posted to due to rate limiting
+        """
+        rate_limited = 0
+        due_rooms = 0
+
+        now_ts = time.time()
+
+        logger.debug("Updating rooms...")
+
+        self.posting = True
+        try:
+            # Posts are planned separately for each source, as a room is due each
+            # source's challenges on its own schedule
+            for source_name, challenges in self.challenges.items():
+                if not challenges:
                     continue
 
-                # Found a new challenge to post!
-                await self._post_challenge(room_id, challenge)
+                # Post dates of each challenge, for finding the next challenge for a
+                # room
+                created_utcs = [challenge.created_utc for challenge in challenges]
+
+                # Only look at rooms that are due a challenge, and that haven't
+                # already been sent the newest one
+                async for rooms in self.store.get_due_rooms(
+                    source_name,
+                    now_ts,
+                    limit=DUE_ROOMS_PAGE_SIZE,
+                    newer_than=challenges[-1].created_utc,
+                ):
+                    due_rooms += len(rooms)
+                    plan = self._plan_posts(rooms, challenges, created_utcs)
+
+                    for challenge, room_ids in plan:
+                        result = await self._post_challenge(
+                            source_name, challenge, room_ids
+                        )
+                        rate_limited += len(result.rate_limited)
+        finally:
+            self.posting = False
+
+        DUE_ROOMS.set(due_rooms)
 
-                # No need to keep searching through challenges for this room
-                break
+        return rate_limited
+
+    def _plan_posts(
+        self,
+        rooms: Dict[str, Dict[str, Union[str, int, int]]],
+        challenges: List[Challenge],
+        created_utcs: List[float],
+    ) -> "PostingPlan":
+        """Work out which challenge to post to each of the given rooms
+
+        Each room is sent the oldest challenge that is newer than the last one posted
+        to it. Rooms that were last sent the same challenge are looked up together.
+
+        Args:
+            rooms: The last post information of rooms that are due a challenge
+            challenges: A list of challenges sorted from oldest post date to newest
+            created_utcs: The post date of each challenge in `challenges`
+
+        Returns:
+            The challenges to post, and which rooms to post each of them to
+        """
+        # Group rooms by when their last challenge was posted to reddit
+        rooms_by_timestamp: Dict[Optional[float], List[str]] = {}
+        for room_id, last_challenge_dict in rooms.items():
+            logger.debug("Time to post again in %s: %s", room_id, last_challenge_dict)
+            rooms_by_timestamp.setdefault(
+                last_challenge_dict["reddit_posted_timestamp"], []
+            ).append(room_id)
+
+        plan = PostingPlan()
+        for last_post_reddit_timestamp, room_ids in rooms_by_timestamp.items():
+            if last_post_reddit_timestamp is None:
+                # We haven't posted in these rooms yet. Start with the oldest challenge
+                index = 0
+            else:
+                # Find the first challenge posted after the last one in these rooms
+                index = bisect.bisect_right(created_utcs, last_post_reddit_timestamp)
+
+            if index < len(challenges):
+                plan.add(challenges[index], room_ids)
+
+        return plan
+
+    async def _post_challenge(
+        self, source_name: str, challenge: Challenge, room_ids: List[str]
+    ) -> FanOutResult:
+        """Post a given challenge from a source to the given rooms"""
+        content = self._render_challenge(challenge)
+
+        logger.info("Posting challenge %s to %d rooms", challenge.id, len(room_ids))
+
+        async def send(room_id: str) -> Optional[Response]:
+            logger.debug("Posting challenge %s to room: %s", challenge.id, room_id)
+            return await send_content_to_room(self.client, room_id, content)
+
+        # Rooms that have been posted to, but not yet marked as such
+        pending_room_ids = []
+
+        async def flush():
+            batch = pending_room_ids[:]
+            pending_room_ids.clear()
+
+            await self.store.upsert_challenges_for_rooms(
+                source_name, [(room_id, challenge) for room_id in batch]
+            )
+
+        async def on_finished(room_id: str, succeeded: bool):
+            # Mark that we've posted this challenge. Rooms that we failed to post to
+            # are marked too, so that a broken room isn't retried every minute. Rooms
+            # that we were rate limited in are tried again on the next run
+            pending_room_ids.append(room_id)
+            if len(pending_room_ids) >= ROOM_STATE_FLUSH_SIZE:
+                await flush()
+
+        result = await self.fan_out.run(
+            room_ids,
+            send,
+            description=f"challenge {challenge.id}",
+            on_finished=on_finished,
+        )
+
+        if pending_room_ids:
+            await flush()
+
+        return result
+
+    def _render_challenge(self, challenge: Challenge) -> Dict[str, str]:
+        """Render the message content announcing a challenge
+
+        The content is the same for every room, so it is only rendered once per
+        challenge and template version.
+
+        Returns:
+            The content of the m.room.message event to send
+        """
+        cache_key = (challenge.id, CHALLENGE_TEMPLATE_VERSION)
+        content = self._rendered_challenges.get(cache_key)
+        if content is not None:
+            CACHE_LOOKUPS.labels("rendered_challenge", "hit").inc()
+            return content
+
+        CACHE_LOOKUPS.labels("rendered_challenge", "miss").inc()
 
-    async def _post_challenge(self, room_id: str, challenge: Submission):
-        """Post a given challenge to a given room"""
         # Replace single newlines with double newlines for Matrix
         selftext = challenge.selftext.replace("\n", "\n\n")
 
@@ -95,14 +566,7 @@ class ChallengePoster:
 
 [Link to original post]({challenge.url})"""
 
-        logger.info("Posting challenge %s to room: %s", challenge.id, room_id)
-
-        try:
-            await send_text_to_room(self.client, room_id, text)
-        except Exception as e:
-            logger.error(
-                "Unable to post challenge %s to room %s: %s", challenge.id, room_id, e
-            )
+        content = make_text_content(text)
+        self._rendered_challenges[cache_key] = content
 
-        # Mark that we've posted this challenge
-        self.store.upsert_challenge_for_room(room_id, challenge)
+        return content
@@ -1,7 +1,9 @@
 import logging
 
 from markdown import markdown
-from nio import SendRetryError
+from nio import ErrorResponse, SendRetryError
+
+from drawing_challenge_bot.metrics import MESSAGE_SEND_DURATION, MESSAGES_SENT
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +25,31 @@ async def send_text_to_room(
 
         markdown_convert (bool): Whether to convert the message content to markdown.
             Defaults to true.
+
+    Returns:
+        nio.RoomSendResponse|nio.RoomSendError|None: The response from the homeserver,
+            or None if the message could not be sent
+    """
+    content = make_text_content(message, notice, markdown_convert)
+    return await send_content_to_room(client, room_id, content)
+
+
+def make_text_content(message, notice=True, markdown_convert=True):
+    """Render text into the content of an m.room.message event
+
+    The result can be sent to any number of rooms with `send_content_to_room`.
+
+    Args:
+        message (str): The message content
+
+        notice (bool): Whether the message should be sent with an "m.notice" message type
+            (will not ping users)
+
+        markdown_convert (bool): Whether to convert the message content to markdown.
+            Defaults to true.
+
+    Returns:
+        dict: The event content
     """
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
@@ -36,9 +63,44 @@ async def send_text_to_room(
     if markdown_convert:
         content["formatted_body"] = markdown(message)
 
+    return content
+
+
+async def send_content_to_room(client, room_id, content):
+    """Send pre-rendered m.room.message content to a matrix room
+
+    Args:
+        client (nio.AsyncClient): The client to communicate to matrix with
+
+        room_id (str): The ID of the room to send the message to
+
+        content (dict): The event content, as made by `make_text_content`. It is
+            not modified
+
+    Returns:
+        nio.RoomSendResponse|nio.RoomSendError|None: The response from the homeserver,
+            or None if the message could not be sent
+    """
+    response = None
     try:
-        await client.room_send(
-            room_id, "m.room.message", content, ignore_unverified_devices=True,
-        )
+        with MESSAGE_SEND_DURATION.time():
+            response = await client.room_send(
+                room_id,
+                "m.room.message",
+                dict(content),
+                ignore_unverified_devices=True,
+            )
     except SendRetryError:
         logger.exception(f"Unable to send message response to {room_id}")
+
+    if response is None:
+        MESSAGES_SENT.labels("failed").inc()
+    elif isinstance(response, ErrorResponse):
+        if response.status_code == "M_LIMIT_EXCEEDED":
+            MESSAGES_SENT.labels("rate_limited").inc()
+        else:
+            MESSAGES_SENT.labels("failed").inc()
+    else:
+        MESSAGES_SENT.labels("success").inc()
+
+    return response
@@ -2,11 +2,14 @@ import logging
 import os
 import re
 import sys
-from typing import Any, List
+from typing import Any, Dict, List
 
 import yaml
 
+from drawing_challenge_bot.challenge_links import CHALLENGE_LINK_PATTERN
+from drawing_challenge_bot.database import DEFAULT_SQLITE_PRAGMAS
 from drawing_challenge_bot.errors import ConfigError
+from drawing_challenge_bot.source import Source
 
 logger = logging.getLogger()
 logging.getLogger("peewee").setLevel(
@@ -20,6 +23,14 @@ logging.getLogger("urllib3.connectionpool").setLevel(
 )  # Prevent debug messages from peewee lib
 
 
+# The source the bot was written for, used if no sources are configured
+DEFAULT_SOURCE = {
+    "name": "mlpdrawingschool",
+    "subreddit": "mlpdrawingschool",
+    "wiki_page": "biweekly",
+}
+
+
 class Config(object):
     def __init__(self, filepath):
         """
@@ -71,9 +82,51 @@ class Config(object):
             self.database = {
                 "type": "sqlite",
                 "connection_string": database_path[len(sqlite_scheme) :],
+                # Writes are made on a single connection. Reads are spread over a pool
+                "read_connections": self._get_cfg(
+                    ["storage", "sqlite", "read_connections"], default=4, required=False
+                ),
+                # The pragmas to apply to each connection
+                "pragmas": {
+                    name: self._get_cfg(
+                        ["storage", "sqlite", name], default=default, required=False
+                    )
+                    for name, default in DEFAULT_SQLITE_PRAGMAS.items()
+                },
+                # How often to checkpoint the write-ahead log, and to let SQLite update
+                # its query planner statistics, in seconds. 0 disables
+                "checkpoint_interval": self._get_cfg(
+                    ["storage", "sqlite", "checkpoint_interval"],
+                    default=300,
+                    required=False,
+                ),
+                "optimize_interval": self._get_cfg(
+                    ["storage", "sqlite", "optimize_interval"],
+                    default=60 * 60,
+                    required=False,
+                ),
             }
         elif database_path.startswith(postgres_scheme):
-            self.database = {"type": "postgres", "connection_string": database_path}
+            self.database = {
+                "type": "postgres",
+                "connection_string": database_path,
+                "min_connections": self._get_cfg(
+                    ["storage", "postgres", "min_connections"],
+                    default=1,
+                    required=False,
+                ),
+                "max_connections": self._get_cfg(
+                    ["storage", "postgres", "max_connections"],
+                    default=4,
+                    required=False,
+                ),
+                # Whether to prepare frequently run statements on the server
+                "prepared_statements": self._get_cfg(
+                    ["storage", "postgres", "prepared_statements"],
+                    default=True,
+                    required=False,
+                ),
+            }
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
@@ -102,11 +155,152 @@ class Config(object):
 
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c")
 
+        # Whether to share rooms between several instances of the bot that use the
+        # same Postgres database
+        self.sharding_enabled = self._get_cfg(
+            ["sharding", "enabled"], default=False, required=False
+        )
+        if self.sharding_enabled and self.database["type"] != "postgres":
+            raise ConfigError("sharding requires a postgres storage.database")
+
+        # The name that this instance registers itself under. Each instance needs its
+        # own device, so the device ID is unique already
+        self.sharding_instance_id = self._get_cfg(
+            ["sharding", "instance_id"], default=self.device_id, required=False
+        )
+        # How often to tell the other instances that this one is still alive, and how
+        # long after its last heartbeat an instance's rooms are given to the others,
+        # in seconds
+        self.sharding_heartbeat_interval = self._get_cfg(
+            ["sharding", "heartbeat_interval"], default=10, required=False
+        )
+        self.sharding_instance_timeout = self._get_cfg(
+            ["sharding", "instance_timeout"], default=60, required=False
+        )
+        if self.sharding_instance_timeout <= self.sharding_heartbeat_interval:
+            raise ConfigError(
+                "sharding.instance_timeout must be longer than "
+                "sharding.heartbeat_interval"
+            )
+
+        # The maximum number of rooms to post a challenge to at once
+        self.posting_concurrency = self._get_cfg(
+            ["posting", "max_concurrency"], default=10, required=False
+        )
+        # How many times to retry posting to a room when rate limited by the homeserver
+        self.posting_max_rate_limit_retries = self._get_cfg(
+            ["posting", "max_rate_limit_retries"], default=5, required=False
+        )
+        # How long before an encrypted room is due a challenge to share an encryption
+        # session with it, in seconds. 0 disables sharing sessions ahead of time
+        self.session_preshare_window = self._get_cfg(
+            ["posting", "session_preshare_window"], default=600, required=False
+        )
+        # The maximum number of rooms to share encryption sessions with at once
+        self.session_preshare_concurrency = self._get_cfg(
+            ["posting", "session_preshare_concurrency"], default=5, required=False
+        )
+
         self.client_id = self._get_cfg(["reddit", "client_id"])
         self.client_secret = self._get_cfg(["reddit", "client_secret"])
         self.user_agent = self._get_cfg(
             ["reddit", "user_agent"], default="weekly challenge bot"
         )
+        # How often to check the wiki for new challenges, in seconds
+        self.reddit_poll_interval = self._get_cfg(
+            ["reddit", "poll_interval"], default=60, required=False
+        )
+        # The maximum number of concurrent reddit requests. praw is not thread safe,
+        # so this should usually be left at 1
+        self.reddit_max_workers = self._get_cfg(
+            ["reddit", "max_workers"], default=1, required=False
+        )
+
+        # The wiki pages to scrape challenges from. Rooms are subscribed to the first
+        # one when the bot joins them
+        self.sources = [
+            self._parse_source(source)
+            for source in self._get_cfg(
+                ["sources"], default=[DEFAULT_SOURCE], required=False
+            )
+        ]
+        if not self.sources:
+            raise ConfigError("sources must contain at least one source")
+
+        source_names = [source.name for source in self.sources]
+        for name in source_names:
+            if source_names.count(name) > 1:
+                raise ConfigError(f"sources contains more than one source named {name}")
+
+        # Whether to serve metrics in the Prometheus text format over HTTP
+        self.metrics_enabled = self._get_cfg(
+            ["metrics", "enabled"], default=False, required=False
+        )
+        self.metrics_bind_address = self._get_cfg(
+            ["metrics", "bind_address"], default="127.0.0.1", required=False
+        )
+        self.metrics_port = self._get_cfg(
+            ["metrics", "port"], default=9090, required=False
+        )
+
+        # Whether to log code that blocks the event loop, and for how long the loop
+        # may be blocked before it is logged
+        self.loop_watchdog_enabled = self._get_cfg(
+            ["loop_watchdog", "enabled"], default=False, required=False
+        )
+        self.loop_watchdog_threshold = self._get_cfg(
+            ["loop_watchdog", "threshold"], default=0.5, required=False
+        )
+
+        # Profiling of scheduled jobs, event callbacks and database queries
+        self.profiling_enabled = self._get_cfg(
+            ["profiling", "enabled"], default=False, required=False
+        )
+        self.profiling_mode = self._get_cfg(
+            ["profiling", "mode"], default="timing", required=False
+        )
+        self.profiling_sample_every = self._get_cfg(
+            ["profiling", "sample_every"], default=10, required=False
+        )
+        self.profiling_directory = self._get_cfg(
+            ["profiling", "directory"],
+            default=os.path.join(self.store_path, "profiles"),
+            required=False,
+        )
+        self.profiling_max_files = self._get_cfg(
+            ["profiling", "max_files"], default=100, required=False
+        )
+
+    def _parse_source(self, source: Dict[str, Any]) -> Source:
+        """Parse an entry of the sources list
+
+        Raises:
+            ConfigError: If the entry is missing an option or has an invalid one
+        """
+        if not isinstance(source, dict):
+            raise ConfigError("Each entry of sources must be a mapping")
+
+        for option in ("name", "subreddit", "wiki_page"):
+            if not source.get(option):
+                raise ConfigError(f"Each entry of sources must have a {option}")
+
+        name = str(source["name"])
+        if not re.match(r"^\S+$", name):
+            raise ConfigError(f"Source name '{name}' must not contain whitespace")
+
+        link_pattern = source.get("link_pattern", CHALLENGE_LINK_PATTERN)
+        try:
+            link_regex = re.compile(link_pattern)
+        except re.error as e:
+            raise ConfigError(f"Invalid link_pattern for source {name}: {e}")
+
+        return Source(
+            name,
+            subreddit=source["subreddit"],
+            wiki_page=source["wiki_page"],
+            poll_interval=source.get("poll_interval", self.reddit_poll_interval),
+            link_pattern=link_regex,
+        )
 
     def _get_cfg(
         self, path: List[str], default: Any = None, required: bool = True,
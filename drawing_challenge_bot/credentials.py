@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+from drawing_challenge_bot.config import Config
+
+logger = logging.getLogger(__name__)
+
+# The name of the file in the store directory that our login is saved to
+CREDENTIALS_FILENAME = "credentials.json"
+
+
+def _credentials_path(config: Config) -> str:
+    return os.path.join(config.store_path, CREDENTIALS_FILENAME)
+
+
+def load_credentials(config: Config) -> Optional[Dict[str, str]]:
+    """Load the login saved by `save_credentials`
+
+    Args:
+        config: The bot config
+
+    Returns:
+        A dictionary with user_id, device_id and access_token keys, or None if there
+        is no saved login for the configured account
+    """
+    path = _credentials_path(config)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            credentials = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Unable to read saved login from %s: %s", path, e)
+        return None
+
+    # Ignore logins to a different account or device than the one configured
+    if (
+        credentials.get("homeserver_url") != config.homeserver_url
+        or credentials.get("user_id") != config.user_id
+        or credentials.get("device_id") != config.device_id
+        or not credentials.get("access_token")
+    ):
+        logger.info("Saved login does not match the configured account, ignoring it")
+        return None
+
+    return credentials
+
+
+def save_credentials(config: Config, user_id: str, device_id: str, access_token: str):
+    """Save a login, so that it can be restored with `load_credentials` rather than
+    logging in again
+
+    Args:
+        config: The bot config
+        user_id: The user ID that we're logged in as
+        device_id: The ID of our device
+        access_token: Our access token
+    """
+    path = _credentials_path(config)
+    credentials = {
+        "homeserver_url": config.homeserver_url,
+        "user_id": user_id,
+        "device_id": device_id,
+        "access_token": access_token,
+    }
+
+    # The access token is a secret, so only allow ourselves to read it. The login is
+    # written to a new file, which mkstemp only lets us read, and then moved over any
+    # existing one. Opening the existing file would keep whatever mode it already has
+    fd, temp_path = tempfile.mkstemp(
+        prefix=f".{CREDENTIALS_FILENAME}.", dir=os.path.dirname(path)
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(credentials, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def delete_credentials(config: Config):
+    """Delete any saved login"""
+    try:
+        os.remove(_credentials_path(config))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,517 @@
+import asyncio
+import logging
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple, TypeVar
+
+from drawing_challenge_bot.errors import ConfigError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The pragmas applied to each SQLite connection by default, in the order they're
+# applied. The busy timeout is set first, so that changing the journal mode waits for
+# other connections rather than failing. WAL mode lets reads run alongside the writer,
+# and with synchronous=NORMAL commits don't wait for an fsync, at the risk of losing
+# the last few commits (but not corrupting the database) if the machine loses power
+DEFAULT_SQLITE_PRAGMAS = {
+    # How long to wait for a lock held by another connection, in milliseconds
+    "busy_timeout": 5000,
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    # How much of the database file to memory map, in bytes
+    "mmap_size": 256 * 1024 * 1024,
+    # The size of each connection's page cache. Negative values are in KiB
+    "cache_size": -64 * 1024,
+    # Keep temporary tables and indexes in memory
+    "temp_store": "memory",
+}
+
+# The values allowed for SQLite pragmas that take a keyword, in the order of the
+# numbers SQLite reports them as. Other pragmas take an integer
+SQLITE_PRAGMA_KEYWORDS = {
+    "journal_mode": ("delete", "truncate", "persist", "memory", "wal", "off"),
+    "synchronous": ("off", "normal", "full", "extra"),
+    "temp_store": ("default", "file", "memory"),
+}
+
+# The number of statements each SQLite connection keeps compiled. Large enough to hold
+# every statement the bot runs, so that none are compiled more than once
+SQLITE_STATEMENT_CACHE_SIZE = 256
+
+# How many times a statement must be run before it is prepared on the Postgres server.
+# Statements that only run a few times, such as migrations, aren't worth preparing
+PREPARE_THRESHOLD = 5
+
+# The Postgres types to declare a prepared statement's parameters as, for each type of
+# argument. Every integer column is compared with bigint without a cast, so indexes on
+# them can be used. There is deliberately no type for floats: a double precision
+# parameter would make Postgres cast the integer column instead, row by row. Timestamps
+# are bound as ints for that reason
+POSTGRES_PARAMETER_TYPES = {
+    bool: "boolean",
+    int: "bigint",
+    str: "text",
+}
+
+
+class Database(ABC):
+    """A pool of database connections that run queries on background threads
+
+    Queries are passed in as functions that take a database cursor. Each function is
+    run on a pooled thread with a connection of its own, so that queries neither
+    block the event loop nor interleave on a shared cursor.
+    """
+
+    @abstractmethod
+    async def read(self, func: Callable[[Any], T]) -> T:
+        """Run a function that only reads from the database
+
+        Args:
+            func: A function that takes a cursor
+
+        Returns:
+            The return value of the function
+        """
+
+    @abstractmethod
+    async def write(self, func: Callable[[Any], T], transaction: bool = False) -> T:
+        """Run a function that writes to the database
+
+        Args:
+            func: A function that takes a cursor
+            transaction: Whether to run the function inside a single transaction,
+                rather than committing each statement as it is executed
+
+        Returns:
+            The return value of the function
+        """
+
+    @abstractmethod
+    def execute(self, cursor, sql: str, args: Sequence[Any] = ()):
+        """Run a statement on a cursor from this database
+
+        Args:
+            cursor: The cursor to run the statement with
+            sql: The statement, with ? placeholders for its arguments. The statement is
+                translated for the database once, and the translation reused for every
+                call with the same text
+            args: The arguments of the statement
+        """
+
+    @abstractmethod
+    def execute_many(self, cursor, sql: str, rows: Sequence[Sequence[Any]]):
+        """Run a statement once for each of many rows of arguments
+
+        Args:
+            cursor: The cursor to run the statement with
+            sql: The statement, with ? placeholders for its arguments
+            rows: The arguments of each run of the statement
+        """
+
+    @abstractmethod
+    def close(self):
+        """Close all connections in the pool"""
+
+
+class SqliteDatabase(Database):
+    """A SQLite database with a single writer thread and a pool of reader threads
+
+    SQLite only allows a single writer at a time, so all writes are serialised on one
+    connection. Reads are spread over a pool of connections of their own.
+
+    Args:
+        path: The path to the database file
+        read_connections: The number of connections to read from the database with.
+            If 0, reads are made on the writer connection
+        pragmas: The pragmas to apply to each connection, as a dictionary of pragma
+            name to value. Defaults to DEFAULT_SQLITE_PRAGMAS
+    """
+
+    def __init__(
+        self,
+        path: str,
+        read_connections: int = 4,
+        pragmas: Optional[Dict[str, Any]] = None,
+    ):
+        self.path = path
+        self.pragmas = self._check_pragmas(
+            DEFAULT_SQLITE_PRAGMAS if pragmas is None else pragmas
+        )
+
+        # An in-memory database is private to the connection that created it
+        if path == ":memory:":
+            read_connections = 0
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sqlite-writer"
+        )
+        self._readers = None
+        if read_connections > 0:
+            self._readers = ThreadPoolExecutor(
+                max_workers=read_connections, thread_name_prefix="sqlite-reader"
+            )
+
+    @staticmethod
+    def _check_pragmas(pragmas: Dict[str, Any]) -> Dict[str, Any]:
+        """Check that pragma values are valid, as they're formatted into statements
+
+        Returns:
+            The pragmas, with keywords in lower case
+
+        Raises:
+            ConfigError: If a value isn't valid
+        """
+        checked = {}
+        for name, value in pragmas.items():
+            if name in SQLITE_PRAGMA_KEYWORDS:
+                value = str(value).lower()
+                if value not in SQLITE_PRAGMA_KEYWORDS[name]:
+                    raise ConfigError(
+                        f"storage.sqlite.{name} must be one of "
+                        f"{', '.join(SQLITE_PRAGMA_KEYWORDS[name])}"
+                    )
+            elif not isinstance(value, int) or isinstance(value, bool):
+                raise ConfigError(f"storage.sqlite.{name} must be an integer")
+
+            checked[name] = value
+
+        return checked
+
+    def _get_connection(self):
+        """Get the connection belonging to the current thread, opening it if necessary"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            import sqlite3
+
+            # Initialize a connection to the database, with autocommit on. Each
+            # connection is only used by the thread that opened it, but may be closed
+            # from another thread once the pool has shut down
+            conn = sqlite3.connect(
+                self.path,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+            )
+            for name, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+
+            self._local.conn = conn
+
+            with self._connections_lock:
+                first_connection = not self._connections
+                self._connections.append(conn)
+
+            if first_connection:
+                self._log_pragmas(conn)
+
+        return conn
+
+    def _log_pragmas(self, conn):
+        """Log the values of the pragmas as SQLite has applied them, so that they can
+        be checked. SQLite ignores some values, such as WAL mode for an in-memory
+        database
+        """
+        applied = []
+        for name in self.pragmas:
+            row = conn.execute(f"PRAGMA {name}").fetchone()
+            value = row[0] if row else None
+
+            # Some keywords are reported by their index
+            if isinstance(value, int) and name in SQLITE_PRAGMA_KEYWORDS:
+                value = SQLITE_PRAGMA_KEYWORDS[name][value]
+            applied.append(f"{name}={value}")
+
+        logger.info("Applied SQLite pragmas: %s", ", ".join(applied))
+
+    def _call(self, func: Callable[[Any], T], transaction: bool = False) -> T:
+        cursor = self._get_connection().cursor()
+        try:
+            if not transaction:
+                return func(cursor)
+
+            cursor.execute("BEGIN")
+            try:
+                result = func(cursor)
+            except BaseException:
+                # Including interruptions, so the connection isn't left mid-transaction
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+            return result
+        finally:
+            cursor.close()
+
+    async def read(self, func: Callable[[Any], T]) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._readers or self._writer, self._call, func
+        )
+
+    def execute(self, cursor, sql: str, args: Sequence[Any] = ()):
+        # sqlite3 reuses the compiled statement for any SQL text it has seen before
+        cursor.execute(sql, args)
+
+    def execute_many(self, cursor, sql: str, rows: Sequence[Sequence[Any]]):
+        cursor.executemany(sql, rows)
+
+    async def write(self, func: Callable[[Any], T], transaction: bool = False) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._writer, self._call, func, transaction)
+
+    def close(self):
+        self._writer.shutdown()
+        if self._readers:
+            self._readers.shutdown()
+
+        with self._connections_lock:
+            for conn in self._connections:
+                # Let SQLite update its statistics from the queries this connection
+                # has run
+                try:
+                    conn.execute("PRAGMA optimize")
+                except Exception as e:
+                    logger.warning("Unable to optimize the SQLite database: %s", e)
+                conn.close()
+            self._connections = []
+
+
+class PostgresStatement(object):
+    """A statement translated for Postgres
+
+    Args:
+        sql: The statement, with ? placeholders for its arguments
+    """
+
+    def __init__(self, sql: str):
+        parts = sql.split("?")
+
+        # The statement with psycopg2's placeholders, to run directly
+        self.text = "%s".join(parts)
+
+        # The statement with numbered placeholders, to prepare on the server
+        self.prepare_text = parts[0] + "".join(
+            f"${number}{part}" for number, part in enumerate(parts[1:], 1)
+        )
+
+        # Only these kinds of statement can be prepared
+        words = sql.split(None, 1)
+        self.preparable = bool(words) and words[0].upper() in (
+            "SELECT",
+            "INSERT",
+            "UPDATE",
+            "DELETE",
+        )
+
+        # How many times the statement has been run
+        self.count = 0
+
+        # The prepared versions of the statement, for each combination of parameter
+        # types
+        self.prepared: Dict[Tuple[str, ...], PreparedStatement] = {}
+
+
+class PreparedStatement(object):
+    """A statement prepared on the Postgres server with certain parameter types
+
+    Args:
+        name: The name to prepare the statement as
+        statement: The statement to prepare
+        types: The Postgres type of each parameter
+    """
+
+    def __init__(self, name: str, statement: PostgresStatement, types: Tuple[str, ...]):
+        self.name = name
+
+        # The statements to prepare and to run it
+        if types:
+            self.prepare_text = (
+                f"PREPARE {name} ({', '.join(types)}) AS {statement.prepare_text}"
+            )
+            self.execute_text = f"EXECUTE {name} ({', '.join(['%s'] * len(types))})"
+        else:
+            self.prepare_text = f"PREPARE {name} AS {statement.prepare_text}"
+            self.execute_text = f"EXECUTE {name}"
+
+
+class PostgresDatabase(Database):
+    """A Postgres database accessed through a pool of connections
+
+    Statements that are run often are prepared on the server, so that they are only
+    parsed and planned once per connection.
+
+    Args:
+        connection_string: The connection string to pass to psycopg2
+        min_connections: The number of connections to keep open
+        max_connections: The maximum number of connections to open at once. This is
+            also the maximum number of concurrent queries
+        prepared_statements: Whether to prepare statements that are run often
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        min_connections: int = 1,
+        max_connections: int = 4,
+        prepared_statements: bool = True,
+    ):
+        if min_connections > max_connections:
+            raise ConfigError(
+                "storage.postgres.min_connections must not be greater than "
+                "storage.postgres.max_connections"
+            )
+
+        self.connection_string = connection_string
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.prepared_statements = prepared_statements
+
+        # Every statement that has been run, by its text with ? placeholders
+        self._statements: Dict[str, PostgresStatement] = {}
+        self._statements_lock = threading.Lock()
+
+        # The names of the statements prepared on each connection. Prepared statements
+        # last as long as the connection does
+        self._prepared = weakref.WeakKeyDictionary()
+
+        # How many prepared statements have been named, to keep names unique
+        self._prepared_count = 0
+
+        # The pool is created on first use, as opening connections blocks
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        # There is one thread per connection, so the pool is never exhausted
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="postgres"
+        )
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                self._pool = ThreadedConnectionPool(
+                    self.min_connections, self.max_connections, self.connection_string
+                )
+
+            return self._pool
+
+    def _call(self, func: Callable[[Any], T], transaction: bool = False) -> T:
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            # Autocommit on, unless we've been asked for a transaction
+            conn.autocommit = not transaction
+
+            try:
+                with conn.cursor() as cursor:
+                    result = func(cursor)
+            except BaseException:
+                if transaction:
+                    conn.rollback()
+                raise
+
+            if transaction:
+                conn.commit()
+
+            return result
+        finally:
+            pool.putconn(conn)
+
+    async def read(self, func: Callable[[Any], T]) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._call, func)
+
+    async def write(self, func: Callable[[Any], T], transaction: bool = False) -> T:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, transaction)
+
+    def execute(self, cursor, sql: str, args: Sequence[Any] = ()):
+        statement = self._get_statement(sql)
+
+        prepared_statement = self._get_prepared_statement(statement, args)
+        if prepared_statement is None:
+            if args:
+                cursor.execute(statement.text, args)
+            else:
+                cursor.execute(statement.text)
+            return
+
+        # Each connection is only used by one thread at a time, so its set of prepared
+        # statements can't change while we're using it
+        with self._statements_lock:
+            prepared = self._prepared.setdefault(cursor.connection, set())
+
+        if prepared_statement.name not in prepared:
+            cursor.execute(prepared_statement.prepare_text)
+            prepared.add(prepared_statement.name)
+
+        if args:
+            cursor.execute(prepared_statement.execute_text, args)
+        else:
+            cursor.execute(prepared_statement.execute_text)
+
+    def execute_many(self, cursor, sql: str, rows: Sequence[Sequence[Any]]):
+        from psycopg2.extras import execute_batch
+
+        # Send many statements per round trip
+        execute_batch(cursor, self._get_statement(sql).text, rows)
+
+    def _get_statement(self, sql: str) -> PostgresStatement:
+        """Get the translation of a statement, translating it if it's new"""
+        statement = self._statements.get(sql)
+        if statement is None:
+            with self._statements_lock:
+                statement = self._statements.setdefault(sql, PostgresStatement(sql))
+        return statement
+
+    def _get_prepared_statement(
+        self, statement: PostgresStatement, args: Sequence[Any]
+    ) -> Optional[PreparedStatement]:
+        """Get the prepared version of a statement to run with the given arguments
+
+        Returns:
+            The prepared statement, or None if the statement should be run directly
+        """
+        if not self.prepared_statements or not statement.preparable:
+            return None
+
+        # A statement is prepared separately for each combination of argument types.
+        # Arguments of other types, including floats and NULLs, aren't given a type up
+        # front, so the statement is run directly and the server infers their types
+        try:
+            types = tuple(POSTGRES_PARAMETER_TYPES[type(arg)] for arg in args)
+        except KeyError:
+            return None
+
+        with self._statements_lock:
+            statement.count += 1
+            if statement.count < PREPARE_THRESHOLD:
+                return None
+
+            prepared_statement = statement.prepared.get(types)
+            if prepared_statement is None:
+                self._prepared_count += 1
+                prepared_statement = PreparedStatement(
+                    f"statement_{self._prepared_count}", statement, types
+                )
+                statement.prepared[types] = prepared_statement
+
+        return prepared_statement
+
+    def close(self):
+        self._executor.shutdown()
+
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
@@ -9,6 +9,12 @@ class ConfigError(RuntimeError):
         super(ConfigError, self).__init__("%s" % (msg,))
 
 
+class UnknownTokenError(RuntimeError):
+    """The homeserver no longer recognises our access token, and we need to log in
+    again
+    """
+
+
 class CommandError(RuntimeError):
     """An error encountered while processing a command
 
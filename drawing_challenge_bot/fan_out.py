@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from nio import ErrorResponse, Response
+
+logger = logging.getLogger(__name__)
+
+# How long to back off for when the homeserver rate limits us without saying for how
+# long
+DEFAULT_RETRY_AFTER_MS = 5000
+
+
+class FanOutResult(object):
+    """The outcome of sending something to many rooms
+
+    Attributes:
+        succeeded: The rooms that were sent to successfully
+        failed: The rooms that could not be sent to
+        rate_limited: The rooms that were still being rate limited after all retries
+        rate_limit_count: How many times the homeserver rate limited us
+        elapsed: How long the fan-out took, in seconds
+    """
+
+    def __init__(self):
+        self.succeeded: List[str] = []
+        self.failed: List[str] = []
+        self.rate_limited: List[str] = []
+        self.rate_limit_count = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Rooms sent to successfully per second"""
+        if not self.elapsed:
+            return 0.0
+        return len(self.succeeded) / self.elapsed
+
+
+class FanOut(object):
+    """Sends to many rooms concurrently, while respecting homeserver rate limits
+
+    A pool of workers send to rooms in parallel. When the homeserver responds with
+    M_LIMIT_EXCEEDED, every worker pauses until the requested `retry_after_ms` has
+    passed, and the rate limited room is retried later.
+
+    Args:
+        concurrency: The maximum number of sends to have in flight at once
+        max_retries: How many times to retry a room that was rate limited
+    """
+
+    def __init__(self, concurrency: int = 10, max_retries: int = 5):
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+
+        # The loop time before which no new sends should be started. Shared by all
+        # workers, so that the whole pool slows down together when rate limited
+        self._resume_at = 0.0
+
+    async def run(
+        self,
+        room_ids: Iterable[str],
+        send: Callable[[str], Awaitable[Optional[Response]]],
+        description: str = "message",
+        on_finished: Optional[Callable[[str, bool], Awaitable[None]]] = None,
+    ) -> FanOutResult:
+        """Send to each of the given rooms
+
+        Args:
+            room_ids: The rooms to send to
+            send: A function that sends to a given room and returns the response, or
+                None if sending failed
+            description: What is being sent, for logging
+            on_finished: A function that is called with a room ID and whether the send
+                succeeded once a room has been sent to, or has failed for a reason other
+                than rate limiting
+
+        Returns:
+            Which rooms were sent to successfully and which weren't
+        """
+        result = FanOutResult()
+
+        queue = asyncio.Queue()
+        for room_id in room_ids:
+            queue.put_nowait((room_id, 0))
+
+        room_count = queue.qsize()
+        if not room_count:
+            return result
+
+        start = time.monotonic()
+
+        workers = [
+            asyncio.ensure_future(self._worker(queue, send, result, on_finished))
+            for _ in range(min(self.concurrency, room_count))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        result.elapsed = time.monotonic() - start
+
+        logger.info(
+            "Sent %s to %d/%d rooms in %.2fs (%.1f rooms/s, %d failed, "
+            "%d rate limited, %d rate limit responses)",
+            description,
+            len(result.succeeded),
+            room_count,
+            result.elapsed,
+            result.throughput,
+            len(result.failed),
+            len(result.rate_limited),
+            result.rate_limit_count,
+        )
+
+        return result
+
+    async def _worker(
+        self,
+        queue: asyncio.Queue,
+        send: Callable[[str], Awaitable[Optional[Response]]],
+        result: FanOutResult,
+        on_finished: Optional[Callable[[str, bool], Awaitable[None]]],
+    ):
+        loop = asyncio.get_event_loop()
+
+        while not queue.empty():
+            room_id, attempt = queue.get_nowait()
+
+            # Wait out any rate limiting before sending
+            delay = self._resume_at - loop.time()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._resume_at - loop.time()
+
+            try:
+                response = await send(room_id)
+            except Exception as e:
+                logger.error("Unable to send to room %s: %s", room_id, e)
+                result.failed.append(room_id)
+                if on_finished:
+                    await on_finished(room_id, False)
+                continue
+
+            if response is not None and not isinstance(response, ErrorResponse):
+                result.succeeded.append(room_id)
+                if on_finished:
+                    await on_finished(room_id, True)
+                continue
+
+            if response is None or response.status_code != "M_LIMIT_EXCEEDED":
+                logger.error("Unable to send to room %s: %s", room_id, response)
+                result.failed.append(room_id)
+                if on_finished:
+                    await on_finished(room_id, False)
+                continue
+
+            # We've been rate limited. Back off everyone
+            result.rate_limit_count += 1
+            retry_after_ms = (
+                getattr(response, "retry_after_ms", None) or DEFAULT_RETRY_AFTER_MS
+            )
+            self._resume_at = max(self._resume_at, loop.time() + retry_after_ms / 1000)
+
+            if attempt >= self.max_retries:
+                logger.warning(
+                    "Giving up on room %s after being rate limited %d times",
+                    room_id,
+                    attempt + 1,
+                )
+                result.rate_limited.append(room_id)
+                continue
+
+            logger.debug(
+                "Rate limited while sending to %s, pausing sends for %dms",
+                room_id,
+                retry_after_ms,
+            )
+            queue.put_nowait((room_id, attempt + 1))
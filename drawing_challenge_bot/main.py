@@ -3,31 +3,46 @@
 import asyncio
 import logging
 import sys
-from datetime import datetime, timedelta
-from time import sleep
+import time
 
 import praw
 from aiohttp import ClientConnectionError, ServerDisconnectedError
-from apscheduler.schedulers import SchedulerAlreadyRunningError
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
 from nio import (
     AsyncClient,
     AsyncClientConfig,
+    ErrorResponse,
     InviteMemberEvent,
     LocalProtocolError,
     LoginError,
     RoomMemberEvent,
     RoomMessageText,
+    SyncResponse,
 )
 
+from drawing_challenge_bot.backoff import Backoff
 from drawing_challenge_bot.callbacks import Callbacks
 from drawing_challenge_bot.challenge_poster import ChallengePoster
 from drawing_challenge_bot.config import Config
+from drawing_challenge_bot.credentials import (
+    delete_credentials,
+    load_credentials,
+    save_credentials,
+)
+from drawing_challenge_bot.errors import UnknownTokenError
+from drawing_challenge_bot.metrics import MetricsServer
+from drawing_challenge_bot.profiling import Profiler
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.scheduler import Scheduler
 from drawing_challenge_bot.storage import Storage
+from drawing_challenge_bot.sync_filter import SYNC_FILTER
+from drawing_challenge_bot.watchdog import LoopWatchdog
 
 logger = logging.getLogger(__name__)
 
+# The bounds of how long to wait before reconnecting to the homeserver, in seconds
+RECONNECT_INITIAL_DELAY = 2
+RECONNECT_MAX_DELAY = 300
+
 
 async def main():
     # Read config file
@@ -39,15 +54,36 @@ async def main():
         config_filepath = "config.yaml"
     config = Config(config_filepath)
 
-    # Set up reddit API
-    reddit = praw.Reddit(
-        client_id=config.client_id,
-        client_secret=config.client_secret,
-        user_agent=config.user_agent,
+    # Watch for code that blocks the event loop, if enabled
+    if config.loop_watchdog_enabled:
+        LoopWatchdog(threshold=config.loop_watchdog_threshold).start()
+
+    # Set up reddit API. Requests are made on a separate thread so they don't block
+    # the event loop
+    reddit = AsyncReddit(
+        praw.Reddit(
+            client_id=config.client_id,
+            client_secret=config.client_secret,
+            user_agent=config.user_agent,
+        ),
+        max_workers=config.reddit_max_workers,
     )
 
+    # Profile chosen parts of the bot, if enabled
+    profiler = None
+    if config.profiling_enabled:
+        profiler = Profiler(
+            config.profiling_directory,
+            mode=config.profiling_mode,
+            sample_every=config.profiling_sample_every,
+            max_files=config.profiling_max_files,
+        )
+
     # Configure storage
     store = Storage(config, reddit)
+    if profiler:
+        profiler.wrap_method(store, "_execute")
+    await store.setup()
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -66,87 +102,172 @@ async def main():
         config=client_config,
     )
 
+    # Set up a scheduler
+    scheduler = Scheduler()
+
     # Set up event callbacks
-    callbacks = Callbacks(client, store, config)
+    callbacks = Callbacks(client, store, config, scheduler)
+    if profiler:
+        profiler.wrap_method(callbacks, "message")
+        profiler.wrap_method(callbacks, "invite")
     client.add_event_callback(callbacks.message, (RoomMessageText,))
     client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
     client.add_event_callback(callbacks.member_event, (RoomMemberEvent,))
 
-    # Set up a scheduler
-    scheduler = AsyncIOScheduler()
-
     # Set up a challenge poster
     challenge_poster = ChallengePoster(client, config, store, reddit)
+    if profiler:
+        profiler.wrap_method(challenge_poster, "check_for_challenges")
+        profiler.wrap_method(challenge_poster, "post_due_challenges")
 
-    # Add a job that checks for new challenges every minute
-    trigger = IntervalTrigger(
-        seconds=60, start_date=datetime.now() + timedelta(seconds=2),
-    )
+    # Add jobs that check for new challenges, and post them to rooms when they're due
+    challenge_poster.add_jobs(scheduler, start_at=time.time() + 2)
 
-    # Add the scrape and update job
-    scheduler.add_job(challenge_poster.scrape_and_post, trigger=trigger)
+    # Add database maintenance jobs
+    store.add_jobs(scheduler, start_at=time.time())
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            # Try to login with the configured username/password
-            try:
-                login_response = await client.login(
-                    password=config.user_password, device_name=config.device_name,
-                )
+    # Serve metrics, if enabled
+    if config.metrics_enabled:
+        metrics_server = MetricsServer(config.metrics_bind_address, config.metrics_port)
+        await metrics_server.start()
 
-                # Check if login failed. Usually incorrect password
-                if type(login_response) == LoginError:
-                    logger.error("Failed to login: %s", login_response.message)
-                    logger.warning("Trying again in 15s...")
-
-                    # Sleep so we don't bombard the server with login requests
-                    sleep(15)
-                    continue
-            except LocalProtocolError as e:
-                # There's an edge case here where the user hasn't installed the correct C
-                # dependencies. In that case, a LocalProtocolError is raised on login.
-                logger.fatal(
-                    "Failed to login. Have you installed the correct dependencies? "
-                    "https://github.com/poljar/matrix-nio#installation "
-                    "Error: %s",
-                    e,
-                )
-                return False
+    # Restore our previous login, if we have one, rather than logging in again
+    credentials = load_credentials(config)
+    if credentials:
+        client.restore_login(
+            credentials["user_id"],
+            credentials["device_id"],
+            credentials["access_token"],
+        )
+        logger.info("Restored login for device %s", credentials["device_id"])
 
-            # Login succeeded!
+    # Wait longer and longer between attempts to reconnect, until a sync succeeds
+    backoff = Backoff(initial=RECONNECT_INITIAL_DELAY, maximum=RECONNECT_MAX_DELAY)
 
-            # Sync encryption keys with the server
-            # Required for participating in encrypted rooms
-            if client.should_upload_keys:
-                await client.keys_upload()
+    async def on_sync(response: SyncResponse):
+        backoff.reset()
 
-            logger.info(f"Logged in as {config.user_id}")
-            logger.info("Startup complete")
+    client.add_response_callback(on_sync, SyncResponse)
+    client.add_response_callback(check_access_token, ErrorResponse)
 
-            # Allow jobs to fire
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
             try:
+                if not client.logged_in:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
+
+                        # Check if login failed. Usually incorrect password
+                        if type(login_response) == LoginError:
+                            delay = backoff.next_delay()
+                            logger.error("Failed to login: %s", login_response.message)
+                            logger.warning("Trying again in %.1fs...", delay)
+
+                            # Sleep so we don't bombard the server with login requests
+                            await asyncio.sleep(delay)
+                            continue
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the
+                        # correct C dependencies. In that case, a LocalProtocolError is
+                        # raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct "
+                            "dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
+                        return False
+
+                    # Login succeeded! Save it, so we can restore it next time
+                    save_credentials(
+                        config, client.user_id, client.device_id, client.access_token
+                    )
+
+                    # Sync encryption keys with the server
+                    # Required for participating in encrypted rooms
+                    if client.should_upload_keys:
+                        await check_access_token(await client.keys_upload())
+
+                logger.info(f"Logged in as {config.user_id}")
+                logger.info("Startup complete")
+
+                # Allow jobs to fire
                 scheduler.start()
-            except SchedulerAlreadyRunningError:
-                pass
 
-            await client.sync_forever(timeout=30000, full_state=True)
+                # Only ask for the full state of every room if we don't already have it.
+                # After a reconnect we carry on from where we left off
+                await client.sync_forever(
+                    timeout=30000, sync_filter=SYNC_FILTER, full_state=not client.rooms
+                )
+
+            except UnknownTokenError:
+                # Our saved login has been logged out. Log in again straight away
+                logger.warning("Access token is no longer valid, logging in again...")
+                delete_credentials(config)
+                client.access_token = ""
+            except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
+                delay = backoff.next_delay()
+                logger.warning(
+                    "Unable to connect to homeserver, retrying in %.1fs...", delay
+                )
+
+                # Sleep so we don't bombard the server with requests
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                # Shutting down. Before Python 3.8 this is an Exception too
+                raise
+            except Exception as e:
+                delay = backoff.next_delay()
+                logger.warning("Unknown exception occurred: %s", e)
+                logger.warning("Restarting in %.1fs...", delay)
+
+                # Sleep so we don't bombard the server with requests
+                await asyncio.sleep(delay)
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+    finally:
+        # Stop running jobs, then close what they use. Closing the store also lets
+        # SQLite update its statistics
+        scheduler.stop()
+        if config.sharding_enabled:
+            try:
+                await challenge_poster.leave_shard()
+            except Exception as e:
+                logger.warning("Unable to give up our rooms: %s", e)
+        store.close()
+        reddit.close()
+
+        # Write out any profiling results that haven't been written yet
+        if profiler:
+            profiler.close()
 
-        except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        except Exception as e:
-            logger.warning("Unknown exception occurred: %s", e)
-            logger.warning("Restarting in 15s...")
+async def check_access_token(response: ErrorResponse):
+    """Check whether the homeserver rejected our access token
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+    Raises:
+        UnknownTokenError: If the access token was not recognised
+    """
+    if (
+        isinstance(response, ErrorResponse)
+        and response.status_code == "M_UNKNOWN_TOKEN"
+    ):
+        raise UnknownTokenError()
 
 
 if __name__ == "__main__":
-    asyncio.get_event_loop().run_until_complete(main())
+    loop = asyncio.get_event_loop()
+    main_task = asyncio.ensure_future(main())
+    try:
+        loop.run_until_complete(main_task)
+    except KeyboardInterrupt:
+        # Let the bot shut down cleanly
+        main_task.cancel()
+        loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
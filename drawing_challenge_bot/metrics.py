@@ -0,0 +1,205 @@
+import asyncio
+import functools
+import logging
+from typing import Callable, Optional
+
+from aiohttp import web
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+logger = logging.getLogger(__name__)
+
+# The prefix of every metric name
+NAMESPACE = "drawing_challenge_bot"
+
+# The upper bounds of histogram buckets, in seconds. Scrapes and posting rounds can
+# take far longer than prometheus_client's default buckets allow for
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+)
+
+
+def timed(histogram: Histogram) -> Callable[[Callable], Callable]:
+    """Decorate a function or coroutine function to observe how long each call takes
+    in a histogram, in seconds
+
+    prometheus_client's `Histogram.time()` decorator only times creating the
+    coroutine when used on a coroutine function, so coroutine functions are timed
+    until they return.
+
+    Example:
+
+        @timed(SCRAPE_DURATION)
+        async def scrape(self):
+            ...
+    """
+
+    def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time():
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer(object):
+    """Serves metrics over HTTP at /metrics, on the running event loop
+
+    Args:
+        bind_address: The address to listen on
+        port: The port to listen on
+        registry: The metrics to serve
+    """
+
+    def __init__(
+        self, bind_address: str, port: int, registry: CollectorRegistry = REGISTRY
+    ):
+        self.bind_address = bind_address
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        """Start serving metrics"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, self.bind_address, self.port)
+        await site.start()
+
+        logger.info(
+            "Serving metrics at http://%s:%d/metrics", self.bind_address, self.port
+        )
+
+    async def stop(self):
+        """Stop serving metrics"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=generate_latest(self.registry),
+            headers={"Content-Type": CONTENT_TYPE_LATEST},
+        )
+
+
+# The bot's metrics
+
+SCRAPE_DURATION = Histogram(
+    "scrape_duration_seconds",
+    "Time taken to scrape the subreddit wiki for challenges",
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+UPDATE_ROOMS_DURATION = Histogram(
+    "update_rooms_duration_seconds",
+    "Time taken to post challenges to every room that is due one",
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+MESSAGE_SEND_DURATION = Histogram(
+    "message_send_duration_seconds",
+    "Time taken to send a message to a room",
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+GROUP_SESSION_PRESHARE_DURATION = Histogram(
+    "group_session_preshare_duration_seconds",
+    "Time taken to share an encryption session with an encrypted room ahead of "
+    "posting to it, including loading its members",
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+MESSAGES_SENT = Counter(
+    "messages_sent",
+    "Messages sent to rooms, by result (success, rate_limited or failed)",
+    ["result"],
+    namespace=NAMESPACE,
+)
+STORAGE_DURATION = Histogram(
+    "storage_duration_seconds",
+    "Time taken by Storage methods, including waiting for a database connection",
+    ["method"],
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+REDDIT_REQUESTS = Counter(
+    "reddit_requests",
+    "Requests made to the reddit API",
+    ["request"],
+    namespace=NAMESPACE,
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups",
+    "Cache lookups, by cache and result (hit or miss)",
+    ["cache", "result"],
+    namespace=NAMESPACE,
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a task that was due, when the loop watchdog is enabled",
+    namespace=NAMESPACE,
+    buckets=DEFAULT_BUCKETS,
+)
+EVENT_LOOP_BLOCKED = Counter(
+    "event_loop_blocked",
+    "Times the event loop was blocked for longer than the loop watchdog's threshold, "
+    "by the code that blocked it",
+    ["location"],
+    namespace=NAMESPACE,
+)
+KNOWN_ROOMS = Gauge(
+    "known_rooms", "Rooms that challenges are posted to", namespace=NAMESPACE
+)
+DUE_ROOMS = Gauge(
+    "due_rooms",
+    "Rooms that were due a challenge in the latest posting round",
+    namespace=NAMESPACE,
+)
+SHARD_INSTANCES = Gauge(
+    "shard_instances",
+    "Live instances sharing the rooms, when sharding is enabled",
+    namespace=NAMESPACE,
+)
+OWNED_ROOMS = Gauge(
+    "owned_rooms",
+    "Rooms that this instance has claimed, when sharding is enabled",
+    namespace=NAMESPACE,
+)
@@ -0,0 +1,258 @@
+import asyncio
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from drawing_challenge_bot.errors import ConfigError
+
+logger = logging.getLogger(__name__)
+
+# Profile every call with the cProfile deterministic profiler
+CPROFILE_MODE = "cprofile"
+
+# Only record how long each call took
+TIMING_MODE = "timing"
+
+# How many timing spans to write to each file
+SPANS_PER_FILE = 1000
+
+# The longest time to hold timing spans in memory before writing them, in seconds
+SPAN_FLUSH_INTERVAL = 60
+
+
+class Profiler(object):
+    """Profiles every Nth call of chosen functions, and writes the results to files
+
+    In cprofile mode, each sampled call is run under cProfile and its stats are
+    written to a `.prof` file, which can be read with `python -m pstats`. Note that
+    profiling a coroutine also profiles any other tasks that run on the event loop
+    while it is suspended.
+
+    In timing mode, only the duration of each sampled call is recorded. Timing spans
+    are collected into JSON files.
+
+    Only the newest `max_files` files in the directory are kept.
+
+    Args:
+        directory: The directory to write results to. Created if it doesn't exist
+        mode: Either CPROFILE_MODE or TIMING_MODE
+        sample_every: Profile every Nth call of each function
+        max_files: The maximum number of result files to keep
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        mode: str = TIMING_MODE,
+        sample_every: int = 10,
+        max_files: int = 100,
+    ):
+        if mode not in (CPROFILE_MODE, TIMING_MODE):
+            raise ConfigError(
+                f"profiling.mode must be one of '{CPROFILE_MODE}' or '{TIMING_MODE}'"
+            )
+
+        self.directory = directory
+        self.mode = mode
+        self.sample_every = max(1, sample_every)
+        self.max_files = max_files
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Functions may be called from database threads
+        self._lock = threading.Lock()
+
+        # Only one cProfile profiler can be active on a thread at a time. This tracks
+        # whether one is
+        self._local = threading.local()
+
+        # How many times each function has been called
+        self._call_counts: Dict[str, int] = {}
+
+        # Timing spans that haven't been written yet, and when the oldest was recorded
+        self._spans: List[Dict[str, Any]] = []
+        self._spans_started_at = 0.0
+
+        # Results are written on a background thread, so as not to block the event loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="profiling"
+        )
+
+        # A counter to keep file names unique
+        self._file_count = 0
+
+        logger.info(
+            "Profiling every %d calls in %s mode, writing results to %s",
+            self.sample_every,
+            mode,
+            directory,
+        )
+
+    def wrap_method(self, obj: Any, method_name: str):
+        """Profile calls of a method of an object
+
+        The method is replaced on the object itself, so this must be called before the
+        method is passed anywhere, such as being registered as a callback.
+
+        Args:
+            obj: The object whose method to profile
+            method_name: The name of the method
+        """
+        name = f"{type(obj).__name__}.{method_name}"
+        setattr(obj, method_name, self.wrap(name, getattr(obj, method_name)))
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        """Wrap a function or coroutine function so that every Nth call is profiled
+
+        Args:
+            name: The name to record the function's results under
+            func: The function to wrap
+        """
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not self._should_sample(name):
+                    return await func(*args, **kwargs)
+
+                if self.mode == CPROFILE_MODE:
+                    if self._profiling():
+                        # Already captured by the active profiler
+                        return await func(*args, **kwargs)
+
+                    profile = cProfile.Profile()
+                    self._local.profiling = True
+                    profile.enable()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        profile.disable()
+                        self._local.profiling = False
+                        self._write_profile(name, profile)
+
+                start = time.time()
+                start_perf = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._record_span(name, start, time.perf_counter() - start_perf)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self._should_sample(name):
+                return func(*args, **kwargs)
+
+            if self.mode == CPROFILE_MODE:
+                if self._profiling():
+                    # Already captured by the active profiler
+                    return func(*args, **kwargs)
+
+                profile = cProfile.Profile()
+                self._local.profiling = True
+                try:
+                    return profile.runcall(func, *args, **kwargs)
+                finally:
+                    self._local.profiling = False
+                    self._write_profile(name, profile)
+
+            start = time.time()
+            start_perf = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._record_span(name, start, time.perf_counter() - start_perf)
+
+        return wrapper
+
+    def close(self):
+        """Write any remaining timing spans and wait for all results to be written"""
+        with self._lock:
+            spans = self._take_spans()
+        if spans:
+            self._executor.submit(self._write_spans, spans)
+        self._executor.shutdown(wait=True)
+
+    def _profiling(self) -> bool:
+        """Whether a cProfile profiler is active on the current thread"""
+        return getattr(self._local, "profiling", False)
+
+    def _should_sample(self, name: str) -> bool:
+        with self._lock:
+            count = self._call_counts.get(name, 0)
+            self._call_counts[name] = count + 1
+        return count % self.sample_every == 0
+
+    def _write_profile(self, name: str, profile: cProfile.Profile):
+        path = self._new_path(name, "prof")
+        self._executor.submit(self._write_file, path, profile.dump_stats)
+
+    def _record_span(self, name: str, start: float, duration: float):
+        span = {"name": name, "start": start, "duration": duration}
+
+        with self._lock:
+            if not self._spans:
+                self._spans_started_at = time.monotonic()
+            self._spans.append(span)
+
+            if (
+                len(self._spans) < SPANS_PER_FILE
+                and time.monotonic() - self._spans_started_at < SPAN_FLUSH_INTERVAL
+            ):
+                return
+
+            spans = self._take_spans()
+
+        self._executor.submit(self._write_spans, spans)
+
+    def _take_spans(self) -> List[Dict[str, Any]]:
+        """Take the spans that haven't been written yet. Called with the lock held"""
+        spans = self._spans
+        self._spans = []
+        return spans
+
+    def _write_spans(self, spans: List[Dict[str, Any]]):
+        def dump(path: str):
+            with open(path, "w") as f:
+                json.dump({"spans": spans}, f)
+
+        self._write_file(self._new_path("spans", "json"), dump)
+
+    def _new_path(self, name: str, extension: str) -> str:
+        with self._lock:
+            self._file_count += 1
+            count = self._file_count
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        return os.path.join(
+            self.directory, f"{timestamp}-{os.getpid()}-{count:06d}-{name}.{extension}"
+        )
+
+    def _write_file(self, path: str, write: Callable[[str], None]):
+        """Write a results file, then remove the oldest files if there are too many.
+        Runs on the background thread
+        """
+        try:
+            write(path)
+        except OSError as e:
+            logger.warning("Unable to write profiling results to %s: %s", path, e)
+            return
+
+        try:
+            paths = [
+                os.path.join(self.directory, filename)
+                for filename in os.listdir(self.directory)
+                if filename.endswith((".prof", ".json"))
+            ]
+            paths.sort(key=os.path.getmtime)
+            for old_path in paths[: max(0, len(paths) - self.max_files)]:
+                os.remove(old_path)
+        except OSError as e:
+            logger.warning("Unable to remove old profiling results: %s", e)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, TypeVar
+
+from praw import Reddit
+from praw.models import Subreddit
+from praw.reddit import Submission
+
+from drawing_challenge_bot.metrics import REDDIT_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of fullnames reddit will resolve in a single /api/info request
+INFO_BATCH_SIZE = 100
+
+T = TypeVar("T")
+
+
+def fetch_submissions(
+    reddit: Reddit, submission_ids: Iterable[str]
+) -> Dict[str, Submission]:
+    """Fetch many submissions from reddit, in as few requests as possible
+
+    Submissions are requested in batches of up to INFO_BATCH_SIZE using reddit's
+    info endpoint, rather than one request per submission.
+
+    Args:
+        reddit: The reddit instance to make requests with
+        submission_ids: The IDs of the submissions to fetch
+
+    Returns:
+        A dictionary of submission ID to fetched submission. Submissions that could
+        not be found (for instance, because they were deleted) are omitted
+    """
+    # Deduplicate while keeping the given order
+    submission_ids = list(dict.fromkeys(submission_ids))
+
+    submissions = {}
+    for i in range(0, len(submission_ids), INFO_BATCH_SIZE):
+        batch = submission_ids[i : i + INFO_BATCH_SIZE]
+        logger.debug("Fetching a batch of %d submissions from reddit", len(batch))
+
+        fullnames = [f"t3_{submission_id}" for submission_id in batch]
+        REDDIT_REQUESTS.labels("info").inc()
+        for submission in reddit.info(fullnames=fullnames):
+            submissions[submission.id] = submission
+
+    missing = len(submission_ids) - len(submissions)
+    if missing:
+        logger.warning("Unable to find %d submissions on reddit", missing)
+
+    return submissions
+
+
+class AsyncReddit(object):
+    """Runs blocking praw calls on a bounded thread pool, so that slow reddit requests
+    never block the event loop
+
+    Args:
+        reddit: The praw instance to make requests with
+        max_workers: The maximum number of reddit requests to have in flight at once.
+            praw is not thread safe, so this should usually be left at 1
+    """
+
+    def __init__(self, reddit: Reddit, max_workers: int = 1):
+        self.praw = reddit
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="reddit"
+        )
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Run a blocking function that makes reddit requests in the thread pool
+
+        Args:
+            func: The function to run
+            *args: Arguments to pass to the function
+
+        Returns:
+            The return value of the function
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        """Stop the thread pool. Requests that are already in flight aren't waited
+        for
+        """
+        self._executor.shutdown(wait=False)
+
+    def subreddit(self, display_name: str) -> Subreddit:
+        """Get a lazy subreddit object. No request is made until one of its attributes
+        is accessed
+        """
+        return self.praw.subreddit(display_name)
+
+    async def fetch_submissions(
+        self, submission_ids: Iterable[str]
+    ) -> Dict[str, Submission]:
+        """Fetch many submissions from reddit without blocking the event loop
+
+        See `fetch_submissions`.
+        """
+        return await self.run(fetch_submissions, self.praw, list(submission_ids))
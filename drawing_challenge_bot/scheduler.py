@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before retrying a job that raised an exception and didn't say when
+# it should next run
+FAILED_JOB_RETRY_SECONDS = 60
+
+
+class Job(object):
+    """A job run by the Scheduler
+
+    Args:
+        name: A unique name for the job
+        func: The coroutine function to run. It returns the timestamp at which the job
+            should next run, or None to wait until the job is woken
+        interval: If set, the job is run at least this often, in seconds
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Optional[float]]],
+        interval: Optional[float] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.interval = interval
+
+        # When the job should next run. None if it isn't scheduled
+        self.next_run_at: Optional[float] = None
+
+        # Whether the job is currently running
+        self.running = False
+
+
+class Scheduler(object):
+    """Runs jobs at deadlines, sleeping until the earliest one is due
+
+    Rather than waking up at a fixed interval, each job says when it next needs to
+    run. Jobs can also be woken early, for instance when something they depend on
+    changes.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, Job] = {}
+
+        # A min-heap of (run at, sequence number, job name). Entries are left in the
+        # heap when a job is rescheduled, and skipped if they no longer match the
+        # job's next run time
+        self._heap: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable[Optional[float]]],
+        run_at: Optional[float] = None,
+        interval: Optional[float] = None,
+    ):
+        """Add a job to the scheduler
+
+        Args:
+            name: A unique name for the job
+            func: The coroutine function to run. It returns the timestamp at which the
+                job should next run, or None to wait until it is woken (or until
+                `interval` has passed, if set)
+            run_at: When to first run the job. Defaults to now
+            interval: If set, the job is run at least this often, in seconds
+        """
+        self._jobs[name] = Job(name, func, interval)
+        self.schedule(name, run_at if run_at is not None else time.time())
+
+    def schedule(self, name: str, run_at: float):
+        """Schedule a job to run at the given time, if that is earlier than it is
+        already scheduled to run
+
+        Args:
+            name: The name of the job
+            run_at: The timestamp to run the job at
+        """
+        job = self._jobs[name]
+        if job.next_run_at is not None and job.next_run_at <= run_at:
+            return
+
+        job.next_run_at = run_at
+        self._sequence += 1
+        heapq.heappush(self._heap, (run_at, self._sequence, name))
+
+        # Re-evaluate how long to sleep for
+        self._wakeup.set()
+
+    def wake(self, name: str):
+        """Run a job as soon as possible
+
+        If the job is currently running, it will be run again once it finishes.
+
+        Args:
+            name: The name of the job
+        """
+        self.schedule(name, time.time())
+
+    def start(self):
+        """Start running jobs. Does nothing if the scheduler is already running"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop running jobs"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                run_at, _, name = heapq.heappop(self._heap)
+                job = self._jobs[name]
+
+                if job.next_run_at != run_at or job.running:
+                    # This entry is stale, or the job will be rescheduled once it
+                    # finishes running
+                    continue
+
+                job.next_run_at = None
+                asyncio.ensure_future(self._run_job(job))
+
+            # Drop stale entries so that we don't wake up for them
+            while (
+                self._heap
+                and self._heap[0][0] != self._jobs[self._heap[0][2]].next_run_at
+            ):
+                heapq.heappop(self._heap)
+
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, self._heap[0][0] - time.time())
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job: Job):
+        job.running = True
+        start = time.time()
+        try:
+            next_run_at = await job.func()
+        except Exception:
+            logger.exception("Error running job %s", job.name)
+            next_run_at = start + (job.interval or FAILED_JOB_RETRY_SECONDS)
+        finally:
+            job.running = False
+
+        if job.interval is not None:
+            periodic_run_at = start + job.interval
+            if next_run_at is None or periodic_run_at < next_run_at:
+                next_run_at = periodic_run_at
+
+        logger.debug(
+            "Job %s finished in %.3fs, next run at %s",
+            job.name,
+            time.time() - start,
+            next_run_at,
+        )
+
+        # The job may have been woken while it was running
+        requested_run_at = job.next_run_at
+        job.next_run_at = None
+        if requested_run_at is not None and (
+            next_run_at is None or requested_run_at < next_run_at
+        ):
+            next_run_at = requested_run_at
+
+        if next_run_at is not None:
+            self.schedule(job.name, next_run_at)
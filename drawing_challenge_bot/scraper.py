@@ -1,55 +1,298 @@
+import bisect
+import hashlib
 import logging
-import re
-from typing import List
+from collections import Counter
+from typing import Dict, List, Optional, Set
 
-from praw import Reddit
+from praw.models import WikiPage
 from praw.reddit import Submission
+from prawcore.exceptions import Forbidden, NotFound
 
+from drawing_challenge_bot.challenge import Challenge
+from drawing_challenge_bot.challenge_cache import ChallengeCache
+from drawing_challenge_bot.challenge_links import (
+    iter_challenge_links,
+    iter_link_segments,
+)
 from drawing_challenge_bot.config import Config
-from drawing_challenge_bot.storage import Storage
+from drawing_challenge_bot.metrics import (
+    CACHE_LOOKUPS,
+    REDDIT_REQUESTS,
+    SCRAPE_DURATION,
+    timed,
+)
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.source import Source
 
 logger = logging.getLogger(__name__)
 
 
 class Scraper:
-    def __init__(self, config: Config, store: Storage, reddit: Reddit):
+    """Scrapes the challenges linked to from the wiki page of a source
+
+    Args:
+        config: Bot configuration parameters
+        source: The source to scrape
+        reddit: The reddit instance to make requests with. Shared by every source
+        challenge_cache: Looks up the challenges that are linked to. Shared by every
+            source
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        source: Source,
+        reddit: AsyncReddit,
+        challenge_cache: ChallengeCache,
+    ):
         self.config = config
-        self.store = store
+        self.source = source
         self.reddit = reddit
+        self.challenge_cache = challenge_cache
 
-        self.subreddit = self.reddit.subreddit("mlpdrawingschool")
+        self.subreddit = self.reddit.subreddit(source.subreddit)
 
-        self.challenge_regex = re.compile(
-            r'.*href="(http[^"]+)".*>.*Drawing Challenge.*<'
-        )
+        # Whether we're allowed to view the wiki page's revision history. If not, we
+        # fall back to comparing a hash of the page's content
+        self._revisions_available = True
+
+        # The wiki revision (or content hash) that the cached challenges were parsed
+        # from, and the cached challenges themselves, sorted by post date, along with
+        # their post dates for searching the list
+        self._wiki_version: Optional[str] = None
+        self._challenges: List[Challenge] = []
+        self._created_utcs: List[float] = []
+        self._challenges_by_id: Dict[str, Challenge] = {}
+
+        # The segments of the last wiki page that was parsed, with how many times each
+        # appears, and the IDs of the challenges linked to from each segment that has
+        # any challenge links
+        self._segments: Counter = Counter()
+        self._segment_challenge_ids: Dict[str, List[str]] = {}
+
+        # How many times each challenge is linked to on the wiki page
+        self._challenge_link_counts: Dict[str, int] = {}
 
-    def scrape(self) -> List[Submission]:
-        """Scrapes the subreddit wiki for any new challenges
+        # The IDs of challenges that are linked to, but couldn't be found on reddit
+        self._unresolved_ids: Set[str] = set()
+
+        # How many scrapes could reuse the cached challenges, and how many had to
+        # parse the wiki page
+        self.wiki_cache_hits = 0
+        self.wiki_cache_misses = 0
+
+    @timed(SCRAPE_DURATION)
+    async def scrape(self) -> List[Challenge]:
+        """Scrapes the source's wiki page for any new challenges
+
+        If the wiki page hasn't changed since the last scrape, the challenges from the
+        last scrape are returned without parsing the page again, along with any
+        challenges that couldn't be found before but can be now. Otherwise only the
+        parts of the page that changed are parsed, and challenges that were added to
+        the page are read from the database cache where possible. Only challenges that
+        we haven't seen before are fetched from reddit.
 
         Returns:
             A list of challenges sorted from oldest post date to newest
         """
-        logger.debug("Starting scrape")
+        logger.debug("Starting scrape of %s", self.source.name)
+
+        wiki = self.subreddit.wiki[self.source.wiki_page]
+
+        # Check whether the wiki page has changed, ideally without downloading it
+        wiki_version = await self.reddit.run(self._get_wiki_revision, wiki)
+        wiki_html = None
+        if wiki_version is None:
+            # Fall back to hashing the page content
+            wiki_html = await self._get_wiki_html(wiki)
+            wiki_version = "sha256:" + hashlib.sha256(wiki_html.encode()).hexdigest()
+
+        if wiki_version == self._wiki_version:
+            self.wiki_cache_hits += 1
+            CACHE_LOOKUPS.labels("wiki", "hit").inc()
+            logger.debug(
+                "Wiki page of %s unchanged. Reusing %d challenges (hits: %d, "
+                "misses: %d)",
+                self.source.name,
+                len(self._challenges),
+                self.wiki_cache_hits,
+                self.wiki_cache_misses,
+            )
+
+            # Challenges that couldn't be found last time may be found now, for
+            # instance if looking them up failed
+            if self._unresolved_ids:
+                self._add_challenges(
+                    await self.challenge_cache.get_challenges(
+                        list(self._unresolved_ids)
+                    )
+                )
+
+            return list(self._challenges)
+
+        self.wiki_cache_misses += 1
+        CACHE_LOOKUPS.labels("wiki", "miss").inc()
+
+        # Download the page, if we haven't already
+        if wiki_html is None:
+            wiki_html = await self._get_wiki_html(wiki)
+
+        challenges = await self._parse_wiki(wiki_html)
+
+        self._wiki_version = wiki_version
+
+        return list(challenges)
+
+    def _get_wiki_revision(self, wiki: WikiPage) -> Optional[str]:
+        """Get the ID of the latest revision of a wiki page
+
+        Fetching a single entry of the page's revision history is much cheaper than
+        fetching the page itself.
+
+        Returns:
+            The revision ID, or None if the revision history is not available
+        """
+        if not self._revisions_available:
+            return None
 
-        challenges = []
+        REDDIT_REQUESTS.labels("wiki_revisions").inc()
+        try:
+            revision = next(iter(wiki.revisions(limit=1)), None)
+        except (Forbidden, NotFound) as e:
+            logger.info(
+                "Unable to view the revision history of wiki page %s, falling back to "
+                "content hashing: %s",
+                wiki,
+                e,
+            )
+            self._revisions_available = False
+            return None
 
-        # Get wiki page HTML
-        wiki = self.subreddit.wiki["biweekly"]
-        wiki_html_lines = wiki.content_html.split("\n")
+        if revision is None:
+            return None
 
-        # Parse HTML for submissions
-        for line in wiki_html_lines:
-            match = self.challenge_regex.match(line)
-            if match:
-                # We found a challenge URL! Create a challenge Submission from it
-                url = match.group(1)
+        return f"revision:{revision['id']}"
 
-                challenge = Submission(reddit=self.reddit, url=url)
-                challenges.append(challenge)
+    async def _get_wiki_html(self, wiki: WikiPage) -> str:
+        """Download the HTML content of a wiki page"""
+        REDDIT_REQUESTS.labels("wiki_page").inc()
+        return await self.reddit.run(getattr, wiki, "content_html")
 
-        logger.debug("Scraping complete. Got %s challenges", len(challenges))
+    async def _parse_wiki(self, wiki_html: str) -> List[Challenge]:
+        """Extract challenges from the HTML of the wiki page
+
+        The page is compared segment by segment (see `iter_link_segments`) with the
+        last page that was parsed. Only segments that were added are searched for
+        challenge links, and only challenges that were added or removed from the page
+        are looked up, so the work done is proportional to the size of the change
+        rather than the size of the page.
+
+        Args:
+            wiki_html: The HTML content of the wiki page
+
+        Returns:
+            A list of challenges sorted from oldest post date to newest
+        """
+        segments = Counter(iter_link_segments(wiki_html))
+        added_segments = segments - self._segments
+        removed_segments = self._segments - segments
+
+        # The change in how many times each challenge is linked to
+        link_changes: Counter = Counter()
+
+        # The challenge IDs linked to from each added segment
+        segment_challenge_ids: Dict[str, List[str]] = {}
+
+        for segment, count in added_segments.items():
+            challenge_ids = self._segment_challenge_ids.get(segment)
+            if challenge_ids is None:
+                # We found challenge URLs! Extract the submission IDs from them
+                challenge_ids = [
+                    Submission.id_from_url(url)
+                    for url in iter_challenge_links(segment, self.source.link_pattern)
+                ]
+            segment_challenge_ids[segment] = challenge_ids
+
+            for challenge_id in challenge_ids:
+                link_changes[challenge_id] += count
+
+        for segment, count in removed_segments.items():
+            for challenge_id in self._segment_challenge_ids.get(segment, ()):
+                link_changes[challenge_id] -= count
+
+        added_ids = []
+        removed_ids = []
+        for challenge_id, change in link_changes.items():
+            link_count = self._challenge_link_counts.get(challenge_id, 0)
+            if link_count == 0 and change > 0:
+                added_ids.append(challenge_id)
+            elif link_count > 0 and link_count + change <= 0:
+                removed_ids.append(challenge_id)
+
+        # Also retry challenges that couldn't be found last time
+        new_challenges = await self.challenge_cache.get_challenges(
+            added_ids + list(self._unresolved_ids - set(removed_ids))
+        )
+
+        # Now that nothing can fail, remember what this page contained
+        self._segments = segments
+        for segment in removed_segments:
+            if segment not in segments:
+                self._segment_challenge_ids.pop(segment, None)
+        for segment, challenge_ids in segment_challenge_ids.items():
+            if challenge_ids:
+                self._segment_challenge_ids[segment] = challenge_ids
+
+        for challenge_id, change in link_changes.items():
+            link_count = self._challenge_link_counts.get(challenge_id, 0) + change
+            if link_count > 0:
+                self._challenge_link_counts[challenge_id] = link_count
+            else:
+                self._challenge_link_counts.pop(challenge_id, None)
+
+        # Update the sorted list of challenges in place
+        for challenge_id in removed_ids:
+            self._unresolved_ids.discard(challenge_id)
+            challenge = self._challenges_by_id.pop(challenge_id, None)
+            if challenge is not None:
+                self._remove_challenge(challenge)
+
+        self._unresolved_ids.update(added_ids)
+        self._add_challenges(new_challenges)
+
+        logger.debug(
+            "Scraping %s complete. %d of %d page segments changed, %d challenges "
+            "added and %d removed. Got %d challenges",
+            self.source.name,
+            len(added_segments),
+            len(segments),
+            len(new_challenges),
+            len(removed_ids),
+            len(self._challenges),
+        )
+
+        return self._challenges
+
+    def _add_challenges(self, challenges: List[Challenge]):
+        """Add challenges that were looked up to the cached challenges, and stop
+        treating them as unresolved
+        """
+        for challenge in challenges:
+            self._unresolved_ids.discard(challenge.id)
+            if challenge.id not in self._challenges_by_id:
+                self._challenges_by_id[challenge.id] = challenge
+                self._insert_challenge(challenge)
 
-        # Sort submissions from oldest to newest
-        challenges.sort(key=lambda c: c.created_utc)
+    def _insert_challenge(self, challenge: Challenge):
+        """Insert a challenge into the list of challenges, keeping it sorted"""
+        index = bisect.bisect_right(self._created_utcs, challenge.created_utc)
+        self._challenges.insert(index, challenge)
+        self._created_utcs.insert(index, challenge.created_utc)
 
-        return challenges
+    def _remove_challenge(self, challenge: Challenge):
+        """Remove a challenge from the sorted list of challenges"""
+        index = bisect.bisect_left(self._created_utcs, challenge.created_utc)
+        while self._challenges[index] is not challenge:
+            index += 1
+        del self._challenges[index]
+        del self._created_utcs[index]
@@ -0,0 +1,31 @@
+from typing import Pattern
+
+
+class Source(object):
+    """A subreddit wiki page that links to challenges, which rooms can subscribe to
+
+    Args:
+        name: The unique name that rooms subscribe to the source by
+        subreddit: The name of the subreddit, without the leading /r/
+        wiki_page: The name of the wiki page that links to the challenges
+        poll_interval: How often to check the wiki page for new challenges, in seconds
+        link_pattern: A regex that the text of a link must match for the link to be
+            a link to a challenge
+    """
+
+    def __init__(
+        self,
+        name: str,
+        subreddit: str,
+        wiki_page: str,
+        poll_interval: float,
+        link_pattern: Pattern[str],
+    ):
+        self.name = name
+        self.subreddit = subreddit
+        self.wiki_page = wiki_page
+        self.poll_interval = poll_interval
+        self.link_pattern = link_pattern
+
+    def __repr__(self):
+        return f"<Source {self.name} /r/{self.subreddit}/wiki/{self.wiki_page}>"
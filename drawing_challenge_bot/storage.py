@@ -1,22 +1,120 @@
+import functools
 import logging
-from datetime import datetime
-from typing import Dict, Optional, Union
-
-from praw.reddit import Reddit, Submission
+import math
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+from drawing_challenge_bot.challenge import Challenge
 from drawing_challenge_bot.config import Config
+from drawing_challenge_bot.database import Database, PostgresDatabase, SqliteDatabase
+from drawing_challenge_bot.metrics import STORAGE_DURATION
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.scheduler import Scheduler
+
+# How long to wait between posting challenges to a room
+ONE_WEEK_IN_SECONDS = 60 * 60 * 24 * 7
+
+# The names of the scheduler jobs that maintain a SQLite database
+SQLITE_CHECKPOINT_JOB = "sqlite_checkpoint"
+SQLITE_OPTIMIZE_JOB = "sqlite_optimize"
 
-latest_migration_version = 1
+# How many challenges to look up on reddit between progress updates when migrating
+MIGRATION_LOOKUP_BATCH_SIZE = 1000
+
+# The maximum number of parameters to bind in a single `IN (...)` query.
+# SQLite's default limit is 999
+MAX_QUERY_PARAMETERS = 500
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+def _timestamp(value: Optional[float] = None) -> int:
+    """Convert a time.time() timestamp, or the current time if not given, to whole
+    seconds, the type of every timestamp column
+
+    Timestamps are always stored and compared as integers. Compared with a float,
+    Postgres would convert the column for every row, and couldn't use an index on it.
+    """
+    return int(time.time() if value is None else value)
+
+
+def _reader(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Decorates a Storage method that reads from the database
+
+    The method is run on a pooled database thread and given a cursor as its first
+    argument after self. The decorated method becomes a coroutine function.
+    """
+    duration = STORAGE_DURATION.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with duration.time():
+            return await self.db.read(
+                lambda cursor: func(self, cursor, *args, **kwargs)
+            )
+
+    return wrapper
+
+
+def _writer(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Decorates a Storage method that writes to the database
+
+    The method is run on a pooled database thread and given a cursor as its first
+    argument after self. The decorated method becomes a coroutine function.
+    """
+    duration = STORAGE_DURATION.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with duration.time():
+            return await self.db.write(
+                lambda cursor: func(self, cursor, *args, **kwargs)
+            )
+
+    return wrapper
+
+
+def _transaction(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Decorates a Storage method that writes to the database in a single transaction
+
+    Like `_writer`, but all statements made by the method are committed together, or
+    not at all.
+    """
+    duration = STORAGE_DURATION.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with duration.time():
+            return await self.db.write(
+                lambda cursor: func(self, cursor, *args, **kwargs), transaction=True
+            )
+
+    return wrapper
+
 
 class Storage(object):
-    def __init__(self, config: Config, reddit: Reddit):
+    def __init__(self, config: Config, reddit: AsyncReddit):
         """Setup the database
 
-        Runs an initial setup or migrations depending on whether a database file has already
-        been created
+        Storage must be set up with `setup` before it is used.
+
+        Database calls are made on pooled background threads, so that slow queries
+        never block the event loop. Public methods are coroutines.
 
         Args:
             config: The bot config. config.database must be a dictionary containing
@@ -24,69 +122,144 @@ class Storage(object):
                     * type: A string, one of "sqlite" or "postgres"
                     * connection_string: A string, featuring a connection string that
                         be fed to each respective db library's `connect` method
+                    * read_connections: For sqlite, the number of connections to read
+                        from the database with
+                    * min_connections, max_connections: For postgres, the bounds of
+                        the connection pool
+            reddit: The reddit instance to use for migrations
         """
         self.config = config
         self.reddit = reddit
+        self.db_type = config.database["type"]
 
-        # Check which type of database has been configured
-        self.conn = self._get_database_connection(
-            config.database["type"], config.database["connection_string"]
+        # The instance that this one shares rooms with others as, if sharding. Only
+        # rooms that this instance has claimed are returned as due
+        self.instance_id: Optional[str] = (
+            config.sharding_instance_id if config.sharding_enabled else None
         )
-        self.cursor = self.conn.cursor()
-        self.db_type = config.database["type"]
 
-        # Try to check the current migration version
-        migration_level = 0
-        try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
-            migration_level = row[0]
-        except Exception:
-            self._initial_db_setup()
-        finally:
-            if migration_level < latest_migration_version:
-                self._run_db_migrations(migration_level)
+        # Check which type of database has been configured
+        self.db = self._get_database(config.database)
+
+    async def setup(self):
+        """Connect to the database
+
+        Runs an initial setup or migrations depending on whether a database file has already
+        been created
+        """
+        migration_level = await self.db.write(self._get_migration_version)
+        if migration_level < latest_migration_version:
+            await self._run_db_migrations(migration_level)
 
         logger.info(f"Database initialization of type '{self.db_type}' complete")
 
-    def _get_database_connection(self, database_type: str, connection_string: str):
-        if database_type == "sqlite":
-            import sqlite3
+    def close(self):
+        """Close all database connections"""
+        self.db.close()
+
+    def add_jobs(self, scheduler: Scheduler, start_at: float):
+        """Schedule database maintenance
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
-        elif database_type == "postgres":
-            import psycopg2
+        For SQLite, the write-ahead log is checkpointed and the query planner's
+        statistics are updated periodically.
 
-            conn = psycopg2.connect(connection_string)
+        Args:
+            scheduler: The scheduler to add jobs to
+            start_at: The timestamp from which to count the jobs' intervals
+        """
+        if self.db_type != "sqlite":
+            return
 
-            # Autocommit on
-            conn.set_isolation_level(0)
+        checkpoint_interval = self.config.database["checkpoint_interval"]
+        if checkpoint_interval > 0 and self.db.pragmas.get("journal_mode") == "wal":
+            scheduler.add_job(
+                SQLITE_CHECKPOINT_JOB,
+                self._checkpoint,
+                run_at=start_at + checkpoint_interval,
+                interval=checkpoint_interval,
+            )
 
-            return conn
+        optimize_interval = self.config.database["optimize_interval"]
+        if optimize_interval > 0:
+            scheduler.add_job(
+                SQLITE_OPTIMIZE_JOB,
+                self._optimize,
+                run_at=start_at + optimize_interval,
+                interval=optimize_interval,
+            )
 
-    def _execute(self, *args):
-        """A wrapper around cursor.execute that transforms ?'s to %s for postgres"""
-        if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
-        else:
-            self.cursor.execute(*args)
+    @_writer
+    def _checkpoint(self, cursor):
+        """Copy as much of the SQLite write-ahead log back into the database as can be
+        done without waiting for readers, so that the log doesn't grow unbounded
+        """
+        self._execute(cursor, "PRAGMA wal_checkpoint(PASSIVE)")
+        busy, log_pages, checkpointed_pages = cursor.fetchone()
+        logger.debug(
+            "Checkpointed %d/%d pages of the SQLite write-ahead log%s",
+            checkpointed_pages,
+            log_pages,
+            " (blocked by readers)" if busy else "",
+        )
+
+    @_writer
+    def _optimize(self, cursor):
+        """Let SQLite update its query planner statistics where they'd help"""
+        self._execute(cursor, "PRAGMA optimize")
+
+    def _get_database(self, database_config: Dict[str, Any]) -> Database:
+        if database_config["type"] == "sqlite":
+            return SqliteDatabase(
+                database_config["connection_string"],
+                read_connections=database_config["read_connections"],
+                pragmas=database_config["pragmas"],
+            )
+        elif database_config["type"] == "postgres":
+            return PostgresDatabase(
+                database_config["connection_string"],
+                min_connections=database_config["min_connections"],
+                max_connections=database_config["max_connections"],
+                prepared_statements=database_config["prepared_statements"],
+            )
+
+    def _get_migration_version(self, cursor) -> int:
+        """Get the current migration version, performing initial setup if necessary
+
+        Returns:
+            The current migration version of the database
+        """
+        # Try to check the current migration version
+        try:
+            self._execute(cursor, "SELECT version FROM migration_version")
+            row = cursor.fetchone()
+            return row[0]
+        except Exception:
+            self._initial_db_setup(cursor)
+            return 0
 
-    def _initial_db_setup(self):
+    def _execute(self, cursor, sql: str, args: Sequence[Any] = ()):
+        """Run a statement with ? placeholders on either database. See
+        `Database.execute`
+        """
+        self.db.execute(cursor, sql, args)
+
+    def _initial_db_setup(self, cursor):
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
 
         # Set up the migration_version table
         self._execute(
+            cursor,
             """
             CREATE TABLE migration_version (
                 version INTEGER PRIMARY KEY
             )
-        """
+        """,
         )
 
         # Initially set the migration version to 0
         self._execute(
+            cursor,
             """
             INSERT INTO migration_version (
                 version
@@ -96,6 +269,7 @@ class Storage(object):
         )
 
         self._execute(
+            cursor,
             """
             CREATE TABLE room_post (
                 -- The ID of the Matrix room that this was posted in
@@ -105,131 +279,1014 @@ class Storage(object):
                 -- When the challenge was posted to the room
                 posted_timestamp BIGINT
             )
-        """
+        """,
         )
 
         self._execute(
+            cursor,
             """
             CREATE UNIQUE INDEX room_id
             ON room_post(room_id)
-        """
+        """,
         )
 
-    def _run_db_migrations(self, current_migration_version: int):
+    async def _run_db_migrations(self, current_migration_version: int):
         """Execute database migrations. Migrates the database to the
         `latest_migration_version`
 
+        Each migration is committed on its own, along with the version it migrates
+        to. If migrating is interrupted, the database is left at the last version
+        that was fully migrated to, and migrating resumes from there next time.
+
         Args:
             current_migration_version: The migration version that the database is
                 currently at
         """
         logger.debug("Checking for necessary database migrations...")
 
-        if current_migration_version < 1:
-            logger.info("Migrating the database from v0 to v1...")
+        for migration in MIGRATIONS:
+            if migration.version > current_migration_version:
+                await self._run_db_migration(migration)
 
-            # There was a bug that preventing any challenges other than the first from being
-            # posted.
-            # https://github.com/anoadragon453/drawing-challenge-bot/issues/1
-            self._execute(
-                """
-                ALTER TABLE room_post
-                ADD COLUMN
-                reddit_posted_timestamp BIGINT
+    async def _run_db_migration(self, migration: "Migration"):
+        """Migrate the database to the version of a migration, from the version before
+
+        Args:
+            migration: The migration to run
+        """
+        logger.info(
+            "Migrating the database from v%d to v%d: %s...",
+            migration.version - 1,
+            migration.version,
+            migration.description,
+        )
+        start = time.monotonic()
+
+        args = ()
+        if migration.prepare:
+            args = (await migration.prepare(self),)
+
+        await self.db.write(
+            lambda cursor: self._apply_db_migration(cursor, migration, args),
+            transaction=True,
+        )
+
+        logger.info(
+            "Database migrated to v%d in %.1fs",
+            migration.version,
+            time.monotonic() - start,
+        )
+
+    def _apply_db_migration(self, cursor, migration: "Migration", args: Tuple):
+        """Run a migration's changes and record the new version. Called in a
+        transaction
+        """
+        migration.migrate(self, cursor, *args)
+
+        self._execute(
+            cursor,
+            """
+             UPDATE migration_version SET version = ?
+        """,
+            (migration.version,),
+        )
+
+    def _execute_values(self, cursor, sql: str, rows: List[Tuple]):
+        """Run an INSERT statement for many rows at once
+
+        Args:
+            sql: The statement to run, with `VALUES {}` in place of the values
+            rows: The values of each row. Every row must have the same length
+        """
+        if not rows:
+            return
+
+        if self.db_type == "postgres":
+            from psycopg2.extras import execute_values
+
+            # Send many rows per statement
+            execute_values(cursor, sql.format("%s"), rows)
+        else:
+            placeholders = ", ".join("?" * len(rows[0]))
+            cursor.executemany(sql.format(f"({placeholders})"), rows)
+
+    async def _prepare_v1_migration(self) -> Dict[str, float]:
+        """Look up when each challenge that has been posted to a room was posted to
+        reddit
+
+        Returns:
+            A dictionary of challenge ID to when it was posted to reddit
+        """
+        challenge_ids = await self.db.read(
+            lambda cursor: self._get_posted_challenge_ids(cursor)
+        )
+
+        # Look up the posts in batches, in as few requests as possible
+        created_utcs = {}
+        for i in range(0, len(challenge_ids), MIGRATION_LOOKUP_BATCH_SIZE):
+            batch = challenge_ids[i : i + MIGRATION_LOOKUP_BATCH_SIZE]
+            posts = await self.reddit.fetch_submissions(batch)
+            created_utcs.update(
+                (post_id, post.created_utc) for post_id, post in posts.items()
+            )
+
+            logger.info(
+                "Looked up %d/%d posted challenges on reddit",
+                i + len(batch),
+                len(challenge_ids),
+            )
+
+        return created_utcs
+
+    def _get_posted_challenge_ids(self, cursor) -> List[str]:
+        """Get the IDs of the challenges that have been posted to rooms"""
+        self._execute(
+            cursor,
+            """
+            SELECT DISTINCT last_challenge_id FROM room_post
+            WHERE last_challenge_id IS NOT NULL
+        """,
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def _migrate_to_v1(self, cursor, created_utcs: Dict[str, float]):
+        """Add the reddit_posted_timestamp column to room_post
+
+        Args:
+            created_utcs: A dictionary of challenge ID to when it was posted to reddit
+        """
+        # There was a bug that preventing any challenges other than the first from being
+        # posted.
+        # https://github.com/anoadragon453/drawing-challenge-bot/issues/1
+        self._execute(
+            cursor,
             """
+            ALTER TABLE room_post
+            ADD COLUMN
+            reddit_posted_timestamp BIGINT
+        """,
+        )
+
+        # Fill in the timestamps of every room with a single statement, by joining
+        # against a temporary table of them
+        self._execute(
+            cursor,
+            """
+            CREATE TEMPORARY TABLE migration_challenge_created_utc (
+                id TEXT PRIMARY KEY,
+                created_utc BIGINT NOT NULL
             )
+        """,
+        )
+        self._execute_values(
+            cursor,
+            """
+            INSERT INTO migration_challenge_created_utc (id, created_utc) VALUES {}
+        """,
+            list(created_utcs.items()),
+        )
 
-            # Get the date of when each post in the database was created on reddit
-            self._execute(
-                """
-                SELECT last_challenge_id FROM room_post
-                """
+        self._execute(
+            cursor,
+            """
+            UPDATE room_post SET reddit_posted_timestamp = (
+                SELECT created_utc FROM migration_challenge_created_utc
+                WHERE migration_challenge_created_utc.id = room_post.last_challenge_id
             )
-            post_ids = [row[0] for row in self.cursor.fetchall()]
+            WHERE last_challenge_id IN (SELECT id FROM migration_challenge_created_utc)
+        """,
+        )
+        logger.info("Updated %d rooms", cursor.rowcount)
 
-            # Deduplicate post IDs and iterate through each
-            for post_id in set(post_ids):
-                # Lookup the post
-                post = self.reddit.submission(id=post_id)
+        self._execute(cursor, "DROP TABLE migration_challenge_created_utc")
 
-                # Save the creation timestamp
-                self._execute(
-                    """
-                    UPDATE room_post SET reddit_posted_timestamp = ? WHERE last_challenge_id = ?
-                """,
-                    (post.created_utc, post_id),
-                )
+    def _migrate_to_v2(self, cursor):
+        """Add the challenge table"""
+        # Cache challenge submissions so that we don't need to fetch each of them
+        # from reddit every time we scrape the wiki
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE challenge (
+                -- The reddit ID of the challenge submission
+                id TEXT PRIMARY KEY,
+                -- When the challenge was posted to reddit
+                created_utc BIGINT NOT NULL,
+                title TEXT NOT NULL,
+                selftext TEXT NOT NULL,
+                url TEXT NOT NULL,
+                -- When we fetched the challenge from reddit
+                fetched_at BIGINT NOT NULL
+            )
+        """,
+        )
 
-            self._execute(
-                """
-                 UPDATE migration_version SET version = 1
+    def _migrate_to_v3(self, cursor):
+        """Add the next_due_timestamp column to room_post"""
+        # Track when each room is next due a challenge, so that we can look up due
+        # rooms with an index instead of checking every room
+        self._execute(
+            cursor,
+            """
+            ALTER TABLE room_post
+            ADD COLUMN
+            next_due_timestamp BIGINT NOT NULL DEFAULT 0
+        """,
+        )
+
+        # Rooms we've posted to are due a week after the last post. Rooms we haven't
+        # posted to yet are due straight away
+        self._execute(
+            cursor,
+            """
+            UPDATE room_post SET next_due_timestamp = posted_timestamp + ?
+            WHERE posted_timestamp IS NOT NULL
+        """,
+            (ONE_WEEK_IN_SECONDS,),
+        )
+        logger.info("Updated %d rooms", cursor.rowcount)
+
+        self._execute(
+            cursor,
+            """
+            CREATE INDEX room_post_next_due_timestamp
+            ON room_post(next_due_timestamp, room_id)
+        """,
+        )
+
+    def _migrate_to_v4(self, cursor):
+        """Add the bot_instance table and the lease_owner column to room_post"""
+        # Instances of the bot that share rooms between them register themselves,
+        # and keep their registration alive with heartbeats
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE bot_instance (
+                instance_id TEXT PRIMARY KEY,
+                -- When the instance first registered itself
+                started_at BIGINT NOT NULL,
+                -- When the instance last said it was still alive
+                heartbeat_at BIGINT NOT NULL
+            )
+        """,
+        )
+
+        # The instance that has claimed each room, if any
+        self._execute(
+            cursor,
+            """
+            ALTER TABLE room_post
+            ADD COLUMN
+            lease_owner TEXT
+        """,
+        )
+
+        # Look up an instance's due rooms, or the unclaimed rooms, in order of when
+        # they're due
+        self._execute(
+            cursor,
+            """
+            CREATE INDEX room_post_lease_owner
+            ON room_post(lease_owner, next_due_timestamp, room_id)
+        """,
+        )
+
+    def _migrate_to_v5(self, cursor):
+        """Add the room table, and key room_post by room and source"""
+        # Rooms that we're in. Which instance handles a room is tracked per room,
+        # whichever sources it's subscribed to
+        self._execute(
+            cursor,
             """
+            CREATE TABLE room (
+                room_id TEXT PRIMARY KEY,
+                -- The instance that has claimed the room, if any
+                lease_owner TEXT
             )
-            logger.info("Database migrated to v1")
+        """,
+        )
+        self._execute(
+            cursor,
+            """
+            INSERT INTO room (room_id, lease_owner)
+            SELECT room_id, lease_owner FROM room_post
+        """,
+        )
+        self._execute(
+            cursor,
+            """
+            CREATE INDEX room_lease_owner ON room(lease_owner)
+        """,
+        )
 
-    def get_rooms(self) -> Dict[str, Dict[str, Union[str, int, int]]]:
-        """Get the last post information for each known room"""
+        # Rebuild room_post, as SQLite can't change a table's primary key. Every room
+        # so far has been posted challenges from the first source
+        self._execute(
+            cursor,
+            """
+            CREATE TABLE room_subscription (
+                room_id TEXT NOT NULL,
+                -- The name of the source that the room is subscribed to
+                source TEXT NOT NULL,
+                last_challenge_id TEXT,
+                posted_timestamp BIGINT,
+                reddit_posted_timestamp BIGINT,
+                next_due_timestamp BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (room_id, source)
+            )
+        """,
+        )
         self._execute(
+            cursor,
             """
-            SELECT room_id, last_challenge_id, posted_timestamp, reddit_posted_timestamp
+            INSERT INTO room_subscription
+                (room_id, source, last_challenge_id, posted_timestamp,
+                reddit_posted_timestamp, next_due_timestamp)
+            SELECT room_id, ?, last_challenge_id, posted_timestamp,
+                reddit_posted_timestamp, next_due_timestamp
             FROM room_post
-        """
+        """,
+            (self.config.sources[0].name,),
+        )
+        logger.info(
+            "Subscribed %d rooms to source %s",
+            cursor.rowcount,
+            self.config.sources[0].name,
         )
 
-        # Return dictionary of room_id to challenge information
-        return {
-            row[0]: {
-                "last_challenge_id": row[1],
-                "posted_timestamp": row[2],
-                "reddit_posted_timestamp": row[3],
+        self._execute(cursor, "DROP TABLE room_post")
+        self._execute(cursor, "ALTER TABLE room_subscription RENAME TO room_post")
+
+        # Look up the due rooms of a source in order of when they're due
+        self._execute(
+            cursor,
+            """
+            CREATE INDEX room_post_source_next_due_timestamp
+            ON room_post(source, next_due_timestamp, room_id)
+        """,
+        )
+
+        # The rebuilt tables have no statistics yet, without which the query planner
+        # sorts every due room rather than reading them in order from the index
+        self._execute(cursor, "ANALYZE room")
+        self._execute(cursor, "ANALYZE room_post")
+
+    async def get_due_rooms(
+        self,
+        source: str,
+        now: float,
+        limit: int = 1000,
+        newer_than: Optional[float] = None,
+    ) -> AsyncIterator[Dict[str, Dict[str, Union[str, int, int]]]]:
+        """Get the last post information for each room that is due a challenge from
+        a source
+
+        Rooms are returned in pages, in order of when they became due. Rooms whose
+        state changes while iterating are not returned twice. When sharding, only
+        rooms that this instance has claimed are returned.
+
+        Args:
+            source: The name of the source
+            now: The current timestamp. Rooms that became due at or before this are
+                returned
+            limit: The maximum number of rooms to return in each page
+            newer_than: If set, only return rooms whose last posted challenge was posted
+                to reddit before this timestamp. Rooms that have never been posted to
+                are always returned
+
+        Returns:
+            An async iterator of dictionaries of room_id to challenge information
+        """
+        after = None
+        while True:
+            with STORAGE_DURATION.labels("get_due_rooms").time():
+                rows = await self.db.read(
+                    lambda cursor: self._get_due_rooms_page(
+                        cursor, source, now, limit, after, newer_than
+                    )
+                )
+            if not rows:
+                return
+
+            yield {
+                row[0]: {
+                    "last_challenge_id": row[1],
+                    "posted_timestamp": row[2],
+                    "reddit_posted_timestamp": row[3],
+                }
+                for row in rows
             }
-            for row in self.cursor.fetchall()
-        }
 
-    def upsert_challenge_for_room(
-        self, room_id: str, challenge: Optional[Submission] = None
-    ):
-        """Upsert latest challenge for a given room
+            if len(rows) < limit:
+                return
+
+            # Continue after the last row we've seen
+            after = (rows[-1][4], rows[-1][0])
+
+    def _get_due_rooms_page(
+        self,
+        cursor,
+        source: str,
+        now: float,
+        limit: int,
+        after: Optional[Tuple[float, str]],
+        newer_than: Optional[float],
+    ) -> List[tuple]:
+        """Get a page of due rooms. See `get_due_rooms`
+
+        Args:
+            after: The next_due_timestamp and room_id of the last row of the previous
+                page, if any
+        """
+        conditions = ["source = ?", "next_due_timestamp <= ?"]
+        args = [source, _timestamp(now)]
+
+        if after is not None:
+            conditions.append(
+                "(next_due_timestamp > ? OR (next_due_timestamp = ? AND room_id > ?))"
+            )
+            args.extend((_timestamp(after[0]), _timestamp(after[0]), after[1]))
+
+        if newer_than is not None:
+            conditions.append(
+                "(reddit_posted_timestamp IS NULL OR reddit_posted_timestamp < ?)"
+            )
+            args.append(_timestamp(newer_than))
+
+        if self.instance_id is not None:
+            conditions.append(
+                "room_id IN (SELECT room_id FROM room WHERE lease_owner = ?)"
+            )
+            args.append(self.instance_id)
+
+        self._execute(
+            cursor,
+            f"""
+            SELECT room_id, last_challenge_id, posted_timestamp, reddit_posted_timestamp,
+                next_due_timestamp
+            FROM room_post
+            WHERE {" AND ".join(conditions)}
+            ORDER BY next_due_timestamp, room_id
+            LIMIT ?
+        """,
+            args + [limit],
+        )
+
+        return cursor.fetchall()
+
+    @_reader
+    def get_next_due_timestamp(
+        self, cursor, sources: Iterable[str], after: float
+    ) -> Optional[float]:
+        """Get when the next room is due a challenge from any of the given sources.
+        When sharding, only rooms that this instance has claimed are considered
 
         Args:
-            room_id: The id of the room to modify
-            challenge: The challenge submission to use the details of. If None, a row will
-                be created for the room with no challenge details. We would do this if the
-                bot is in the room, but hasn't posted a challenge yet.
+            sources: The names of the sources
+            after: Only consider rooms that become due after this timestamp
+
+        Returns:
+            The earliest due timestamp after `after`, or None if there isn't one
         """
-        last_challenge_id = challenge.id if challenge else None
-        posted_timestamp = datetime.utcnow().timestamp() if challenge else None
-        reddit_posted_timestamp = challenge.created_utc if challenge else None
+        conditions = ["source = ?", "next_due_timestamp > ?"]
+        if self.instance_id is not None:
+            conditions.append(
+                "room_id IN (SELECT room_id FROM room WHERE lease_owner = ?)"
+            )
+
+        # Look up each source on its own, so that each lookup can use the index
+        next_due = None
+        for source in sources:
+            args = [source, _timestamp(after)]
+            if self.instance_id is not None:
+                args.append(self.instance_id)
+
+            self._execute(
+                cursor,
+                f"""
+                SELECT MIN(next_due_timestamp) FROM room_post
+                WHERE {" AND ".join(conditions)}
+            """,
+                args,
+            )
+            timestamp = cursor.fetchone()[0]
+            if timestamp is not None and (next_due is None or timestamp < next_due):
+                next_due = timestamp
+
+        return next_due
 
+    @_reader
+    def get_room_count(self, cursor) -> int:
+        """Get the number of rooms that we're in"""
         self._execute(
+            cursor,
             """
-            INSERT INTO room_post
-                (room_id, last_challenge_id, posted_timestamp, reddit_posted_timestamp)
-                VALUES (?, ?, ?, ?)
-            ON CONFLICT(room_id) DO
+            SELECT COUNT(*) FROM room
+        """,
+        )
+        return cursor.fetchone()[0]
+
+    @_reader
+    def get_challenges(
+        self, cursor, challenge_ids: Iterable[str]
+    ) -> Dict[str, Challenge]:
+        """Get cached challenges by their submission IDs
+
+        Args:
+            challenge_ids: The IDs of the challenges to look up
+
+        Returns:
+            A dictionary of challenge ID to challenge. IDs that are not cached are
+            omitted
+        """
+        challenge_ids = list(challenge_ids)
+
+        challenges = {}
+        for i in range(0, len(challenge_ids), MAX_QUERY_PARAMETERS):
+            batch = challenge_ids[i : i + MAX_QUERY_PARAMETERS]
+            self._execute(
+                cursor,
+                f"""
+                SELECT id, created_utc, title, selftext, url FROM challenge
+                WHERE id IN ({", ".join("?" * len(batch))})
+            """,
+                batch,
+            )
+
+            for row in cursor.fetchall():
+                challenges[row[0]] = Challenge(*row)
+
+        return challenges
+
+    @_transaction
+    def store_challenges(self, cursor, challenges: List[Challenge]):
+        """Cache challenges fetched from reddit
+
+        Args:
+            challenges: The challenges to store. Existing entries are overwritten
+        """
+        fetched_at = _timestamp()
+
+        self.db.execute_many(
+            cursor,
+            """
+            INSERT INTO challenge
+                (id, created_utc, title, selftext, url, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO
                 UPDATE SET
-                    last_challenge_id = ?,
-                    posted_timestamp = ?,
-                    reddit_posted_timestamp = ?
-                WHERE room_id = ?
+                    created_utc = excluded.created_utc,
+                    title = excluded.title,
+                    selftext = excluded.selftext,
+                    url = excluded.url,
+                    fetched_at = excluded.fetched_at
         """,
-            (
-                room_id,
-                last_challenge_id,
-                posted_timestamp,
-                reddit_posted_timestamp,
-                last_challenge_id,
-                posted_timestamp,
-                reddit_posted_timestamp,
+            [
+                (
+                    challenge.id,
+                    challenge.created_utc,
+                    challenge.title,
+                    challenge.selftext,
+                    challenge.url,
+                    fetched_at,
+                )
+                for challenge in challenges
+            ],
+        )
+
+    @_transaction
+    def upsert_challenges_for_rooms(
+        self,
+        cursor,
+        source: str,
+        room_challenges: List[Tuple[str, Optional[Challenge]]],
+    ):
+        """Upsert the latest challenge from a source for many rooms at once, in a
+        single transaction
+
+        Args:
+            source: The name of the source that the challenges are from
+            room_challenges: A list of room ID and challenge pairs. A challenge of
+                None creates a row for a room with no challenge details, for a room
+                that has subscribed to the source but hasn't been posted a challenge
+                from it yet
+        """
+        self._upsert_room_posts(cursor, source, room_challenges)
+
+    def _upsert_room_posts(
+        self,
+        cursor,
+        source: str,
+        room_challenges: List[Tuple[str, Optional[Challenge]]],
+    ):
+        """Upsert rows in the room_post table
+
+        Args:
+            source: The name of the source that the challenges are from
+            room_challenges: A list of room ID and challenge pairs
+        """
+        now = _timestamp()
+
+        # A row may only be upserted once per statement, so the last entry for each
+        # room wins
+        rows = {}
+        for room_id, challenge in room_challenges:
+            rows[room_id] = (
                 room_id,
-            ),
+                source,
+                challenge.id if challenge else None,
+                now if challenge else None,
+                _timestamp(challenge.created_utc) if challenge else None,
+                # Rooms we haven't posted to yet are due straight away
+                now + ONE_WEEK_IN_SECONDS if challenge else 0,
+            )
+
+        self._execute_values(
+            cursor,
+            """
+            INSERT INTO room_post
+                (room_id, source, last_challenge_id, posted_timestamp,
+                reddit_posted_timestamp, next_due_timestamp)
+                VALUES {}
+            ON CONFLICT(room_id, source) DO
+                UPDATE SET
+                    last_challenge_id = excluded.last_challenge_id,
+                    posted_timestamp = excluded.posted_timestamp,
+                    reddit_posted_timestamp = excluded.reddit_posted_timestamp,
+                    next_due_timestamp = excluded.next_due_timestamp
+        """,
+            list(rows.values()),
         )
 
-    def delete_room_entry(self, room_id: str):
-        """Delete an entry in the room_post table"""
+    @_transaction
+    def delete_room_entry(self, cursor, room_id: str):
+        """Forget a room, and every source it's subscribed to"""
         self._execute(
+            cursor,
             """
             DELETE FROM room_post WHERE room_id = ?
         """,
             (room_id,),
         )
+        self._execute(
+            cursor,
+            """
+            DELETE FROM room WHERE room_id = ?
+        """,
+            (room_id,),
+        )
+
+    @_transaction
+    def add_room(self, cursor, room_id: str, source: str) -> bool:
+        """Add a room that we've joined, and subscribe it to a source
+
+        When sharding, every instance is told about the room. The first of them to add
+        it claims it, unless it's already claimed by another live instance.
+
+        Args:
+            room_id: The ID of the room
+            source: The name of the source to subscribe the room to. If the room is
+                already subscribed, it starts again from the source's first challenge
+
+        Returns:
+            Whether this instance handles the room, and so should greet it
+        """
+        if self.instance_id is None:
+            self._execute(
+                cursor,
+                """
+                INSERT INTO room (room_id) VALUES (?)
+                ON CONFLICT(room_id) DO NOTHING
+            """,
+                (room_id,),
+            )
+        else:
+            self._execute(
+                cursor,
+                """
+                INSERT INTO room (room_id, lease_owner) VALUES (?, ?)
+                ON CONFLICT(room_id) DO
+                    UPDATE SET lease_owner = excluded.lease_owner
+                    WHERE room.lease_owner IS NULL
+                        OR room.lease_owner = excluded.lease_owner
+                        OR room.lease_owner NOT IN (SELECT instance_id FROM bot_instance)
+                RETURNING room_id
+            """,
+                (room_id, self.instance_id),
+            )
+            if cursor.fetchone() is None:
+                return False
+
+        self._upsert_room_posts(cursor, source, [(room_id, None)])
+        return True
+
+    @_transaction
+    def subscribe(self, cursor, room_id: str, source: str) -> bool:
+        """Subscribe a room that we're in to a source. The room is due the source's
+        first challenge straight away
+
+        Args:
+            room_id: The ID of the room
+            source: The name of the source
+
+        Returns:
+            Whether the room was subscribed. False if it already was
+        """
+        self._execute(
+            cursor,
+            """
+            INSERT INTO room (room_id) VALUES (?)
+            ON CONFLICT(room_id) DO NOTHING
+        """,
+            (room_id,),
+        )
+        self._execute(
+            cursor,
+            """
+            INSERT INTO room_post (room_id, source, next_due_timestamp)
+                VALUES (?, ?, 0)
+            ON CONFLICT(room_id, source) DO NOTHING
+        """,
+            (room_id, source),
+        )
+        return cursor.rowcount > 0
+
+    @_writer
+    def unsubscribe(self, cursor, room_id: str, source: str) -> bool:
+        """Unsubscribe a room from a source
+
+        Args:
+            room_id: The ID of the room
+            source: The name of the source
+
+        Returns:
+            Whether the room was unsubscribed. False if it wasn't subscribed
+        """
+        self._execute(
+            cursor,
+            """
+            DELETE FROM room_post WHERE room_id = ? AND source = ?
+        """,
+            (room_id, source),
+        )
+        return cursor.rowcount > 0
+
+    @_reader
+    def get_subscriptions(self, cursor, room_id: str) -> List[str]:
+        """Get the names of the sources that a room is subscribed to"""
+        self._execute(
+            cursor,
+            """
+            SELECT source FROM room_post WHERE room_id = ? ORDER BY source
+        """,
+            (room_id,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    async def owns_room(self, room_id: str) -> bool:
+        """Whether this instance handles a room. Always true unless sharding"""
+        if self.instance_id is None:
+            return True
+        return await self._get_room_owner(room_id) == self.instance_id
+
+    @_reader
+    def _get_room_owner(self, cursor, room_id: str) -> Optional[str]:
+        """Get the ID of the instance that has claimed a room, if any"""
+        self._execute(
+            cursor,
+            """
+            SELECT lease_owner FROM room WHERE room_id = ?
+        """,
+            (room_id,),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @_transaction
+    def heartbeat(
+        self, cursor, claim: bool = True, release: bool = True
+    ) -> "ShardState":
+        """Tell the other instances that this one is still alive, and even out the
+        rooms between the instances that are
+
+        Instances that haven't sent a heartbeat within the instance timeout are
+        unregistered, and their rooms are released. Each live instance then holds an
+        equal share of the rooms. This instance releases the rooms it holds beyond its
+        share, and claims released rooms up to its share. Rooms are claimed with
+        `FOR UPDATE SKIP LOCKED`, so instances claiming at the same time never wait for
+        each other or claim the same room.
+
+        Args:
+            claim: Whether to claim or release rooms. If False, this instance is only
+                registered
+            release: Whether to release rooms beyond this instance's share. Pass False
+                while this instance is posting, so that a room isn't posted to by both
+                this instance and the one that claims it
+
+        Returns:
+            The state of the shard after the heartbeat
+        """
+        now = _timestamp()
+
+        self._execute(
+            cursor,
+            """
+            INSERT INTO bot_instance (instance_id, started_at, heartbeat_at)
+                VALUES (?, ?, ?)
+            ON CONFLICT(instance_id) DO
+                UPDATE SET heartbeat_at = excluded.heartbeat_at
+        """,
+            (self.instance_id, now, now),
+        )
+
+        # Unregister instances that have stopped, and release their rooms
+        self._execute(
+            cursor,
+            """
+            DELETE FROM bot_instance WHERE heartbeat_at < ?
+            RETURNING instance_id
+        """,
+            (_timestamp(now - self.config.sharding_instance_timeout),),
+        )
+        stopped_instance_ids = [row[0] for row in cursor.fetchall()]
+
+        orphaned = 0
+        if stopped_instance_ids:
+            self._execute(
+                cursor,
+                f"""
+                UPDATE room SET lease_owner = NULL
+                WHERE lease_owner IN ({", ".join("?" * len(stopped_instance_ids))})
+            """,
+                stopped_instance_ids,
+            )
+            orphaned = cursor.rowcount
+
+        self._execute(cursor, "SELECT COUNT(*) FROM bot_instance")
+        instances = cursor.fetchone()[0]
+
+        self._execute(
+            cursor,
+            """
+            SELECT COUNT(*), COUNT(CASE WHEN lease_owner = ? THEN 1 END) FROM room
+        """,
+            (self.instance_id,),
+        )
+        rooms, owned = cursor.fetchone()
+        share = math.ceil(rooms / instances)
+
+        claimed = 0
+        released = 0
+        if claim and release and owned > share:
+            # Any of our rooms may be given up, whether or not it is due. Rooms that
+            # have been sent every challenge stay due until a new one is posted, so
+            # only giving up rooms that aren't due could keep them from ever being
+            # shared out
+            self._execute(
+                cursor,
+                """
+                UPDATE room SET lease_owner = NULL
+                WHERE room_id IN (
+                    SELECT room_id FROM room WHERE lease_owner = ? LIMIT ?
+                )
+            """,
+                (self.instance_id, owned - share),
+            )
+            released = cursor.rowcount
+        elif claim and owned < share:
+            self._execute(
+                cursor,
+                """
+                UPDATE room SET lease_owner = ?
+                WHERE room_id IN (
+                    SELECT room_id FROM room
+                    WHERE lease_owner IS NULL
+                    LIMIT ?
+                    FOR UPDATE SKIP LOCKED
+                )
+            """,
+                (self.instance_id, share - owned),
+            )
+            claimed = cursor.rowcount
+
+        return ShardState(
+            instances=instances,
+            rooms=rooms,
+            owned=owned + claimed - released,
+            claimed=claimed,
+            released=released,
+            stopped_instance_ids=stopped_instance_ids,
+            orphaned=orphaned,
+        )
+
+    @_transaction
+    def leave_shard(self, cursor) -> int:
+        """Stop sharing rooms with the other instances, giving up every room this
+        instance holds so that they can be claimed straight away, rather than once
+        this instance's heartbeat has timed out
+
+        Returns:
+            The number of rooms given up
+        """
+        self._execute(
+            cursor,
+            "UPDATE room SET lease_owner = NULL WHERE lease_owner = ?",
+            (self.instance_id,),
+        )
+        released = cursor.rowcount
+
+        self._execute(
+            cursor,
+            "DELETE FROM bot_instance WHERE instance_id = ?",
+            (self.instance_id,),
+        )
+
+        return released
+
+
+class Migration(object):
+    """A step that migrates the database from the version before `version` to
+    `version`
+
+    Args:
+        version: The version that the database is at once migrated
+        description: What the migration changes, for logging
+        migrate: A Storage method that makes the migration's changes, given a cursor.
+            It is run in a single transaction, which also records the new version
+        prepare: An optional Storage coroutine method that gathers anything the
+            migration needs from outside the database, such as from reddit, before
+            the transaction is started. Its result is passed to `migrate`
+    """
+
+    def __init__(
+        self,
+        version: int,
+        description: str,
+        migrate: Callable[..., None],
+        prepare: Optional[Callable[[Storage], Awaitable[Any]]] = None,
+    ):
+        self.version = version
+        self.description = description
+        self.migrate = migrate
+        self.prepare = prepare
+
+
+class ShardState(object):
+    """What an instance knows about the rooms shared between instances, as of its
+    latest heartbeat
+
+    Args:
+        instances: The number of live instances, including this one
+        rooms: The number of rooms shared between the instances
+        owned: The number of rooms that this instance has claimed
+        claimed: How many rooms this instance claimed in the heartbeat
+        released: How many rooms this instance gave up in the heartbeat
+        stopped_instance_ids: The instances that were found to have stopped, and
+            were unregistered
+        orphaned: How many rooms were released from the stopped instances
+    """
+
+    def __init__(
+        self,
+        instances: int,
+        rooms: int,
+        owned: int,
+        claimed: int,
+        released: int,
+        stopped_instance_ids: List[str],
+        orphaned: int,
+    ):
+        self.instances = instances
+        self.rooms = rooms
+        self.owned = owned
+        self.claimed = claimed
+        self.released = released
+        self.stopped_instance_ids = stopped_instance_ids
+        self.orphaned = orphaned
+
+
+# Every migration, in order
+MIGRATIONS = [
+    Migration(
+        1,
+        "Add the reddit_posted_timestamp column to room_post",
+        Storage._migrate_to_v1,
+        prepare=Storage._prepare_v1_migration,
+    ),
+    Migration(2, "Add the challenge table", Storage._migrate_to_v2),
+    Migration(
+        3, "Add the next_due_timestamp column to room_post", Storage._migrate_to_v3
+    ),
+    Migration(
+        4,
+        "Add the bot_instance table and the lease_owner column to room_post",
+        Storage._migrate_to_v4,
+    ),
+    Migration(
+        5,
+        "Add the room table, and key room_post by room and source",
+        Storage._migrate_to_v5,
+    ),
+]
+
+latest_migration_version = MIGRATIONS[-1].version
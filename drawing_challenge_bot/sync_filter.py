@@ -0,0 +1,17 @@
+# The maximum number of timeline events to receive per room in each sync. The bot only
+# reads recent commands, so there's no need to catch up on long conversations
+TIMELINE_LIMIT = 10
+
+# The filter to sync with. Room members are lazy-loaded, so that the member list of
+# every room isn't downloaded and held in memory. The bot never reads presence, typing
+# notifications, receipts or account data, so those are dropped entirely
+SYNC_FILTER = {
+    "presence": {"not_types": ["*"]},
+    "account_data": {"not_types": ["*"]},
+    "room": {
+        "state": {"lazy_load_members": True},
+        "timeline": {"limit": TIMELINE_LIMIT, "lazy_load_members": True},
+        "ephemeral": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+    },
+}
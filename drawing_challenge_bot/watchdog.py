@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Optional
+
+from drawing_challenge_bot.metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+# How often the event loop records that it is still running, in seconds
+HEARTBEAT_INTERVAL = 0.05
+
+# The directory containing the bot's code, for finding the bot's own frames in a stack
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class LoopWatchdog(object):
+    """Detects code that blocks the event loop, and logs where it was blocked
+
+    A task on the event loop records a heartbeat every HEARTBEAT_INTERVAL. A helper
+    thread checks the heartbeat, and when the loop hasn't run for longer than
+    `threshold`, it captures the stack of the thread running the loop. Once the loop
+    is running again, the stack is logged with how long the loop was blocked for.
+
+    Args:
+        threshold: How long the loop may go without running, in seconds, before it is
+            considered blocked
+    """
+
+    def __init__(self, threshold: float = 0.5):
+        self.threshold = threshold
+
+        # When the event loop last ran, from time.monotonic()
+        self._heartbeat = time.monotonic()
+
+        # The ID of the thread running the event loop
+        self._loop_thread_id: Optional[int] = None
+
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching the running event loop"""
+        if self._task is not None:
+            return
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+
+        self._task = asyncio.ensure_future(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+        logger.info("Watching for event loop blocks longer than %.3fs", self.threshold)
+
+    def stop(self):
+        """Stop watching the event loop"""
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        self._task = None
+        self._stopped.set()
+        self._thread = None
+
+    async def _beat(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            self._heartbeat = time.monotonic()
+
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+            EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - HEARTBEAT_INTERVAL))
+
+    def _watch(self):
+        """Runs on the helper thread"""
+        check_interval = min(HEARTBEAT_INTERVAL, self.threshold / 2)
+
+        # The heartbeat that the loop was blocked after, and the stack captured at
+        # the time
+        blocked_heartbeat = None
+        blocked_stack = None
+        blocked_location = None
+
+        while not self._stopped.wait(check_interval):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat
+
+            if blocked_heartbeat is not None and heartbeat != blocked_heartbeat:
+                # The loop is running again. Report how long it was blocked for. The
+                # block ended at most one heartbeat interval before this heartbeat
+                duration = heartbeat - blocked_heartbeat - HEARTBEAT_INTERVAL
+                EVENT_LOOP_BLOCKED.labels(blocked_location).inc()
+                logger.warning(
+                    "Event loop was blocked for %.3fs at %s. Stack:\n%s",
+                    duration,
+                    blocked_location,
+                    blocked_stack,
+                )
+                blocked_heartbeat = None
+                continue
+
+            if blocked_heartbeat is None and blocked_for > self.threshold:
+                # The loop is blocked. Capture what it's doing now
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+
+                blocked_heartbeat = heartbeat
+                blocked_stack = "".join(traceback.format_stack(frame))
+                blocked_location = self._describe_location(frame)
+
+    def _describe_location(self, frame: FrameType) -> str:
+        """Describe where a stack is blocked
+
+        The innermost frame in the bot's own code is used if there is one, as that is
+        the code that made the blocking call. Otherwise the innermost frame is used.
+        """
+        innermost = frame
+        while frame is not None:
+            if frame.f_code.co_filename.startswith(PACKAGE_DIR):
+                filename = os.path.relpath(
+                    frame.f_code.co_filename, os.path.dirname(PACKAGE_DIR)
+                )
+                break
+            frame = frame.f_back
+        else:
+            frame = innermost
+            filename = frame.f_code.co_filename
+
+        return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
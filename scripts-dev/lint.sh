@@ -11,7 +11,7 @@ if [ $# -ge 1 ]
 then
     files=$*
   else
-    files="drawing_challenge_bot drawing-challenge-bot"
+    files="drawing_challenge_bot drawing-challenge-bot benchmarks tests"
 fi
 
 echo "Linting these locations: $files"
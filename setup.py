@@ -29,17 +29,17 @@ setup(
     version=version,
     url="https://github.com/anoadragon453/drawing-challenge-bot",
     description="A matrix bot to help you improve your art",
-    packages=find_packages(exclude=["tests", "tests.*"]),
+    packages=find_packages(exclude=["tests", "tests.*", "benchmarks", "benchmarks.*"]),
     install_requires=[
         "matrix-nio[e2e]>=0.10.0",
         "Markdown>=3.1.1",
         "PyYAML>=5.1.2",
-        "apscheduler>=3.6.3",
         "praw>=7.0.0",
+        "prometheus_client>=0.8.0",
     ],
     extras_require={
         "postgres": ["psycopg2>=2.8.5"],
-        "dev": ["isort==4.3.21", "flake8==3.8.3", "black==19.10b0"],
+        "dev": ["isort==4.3.21", "flake8==3.8.3", "black==19.10b0", "pytest>=5.4.3"],
     },
     classifiers=[
         "License :: OSI Approved :: Apache Software License",
@@ -0,0 +1,76 @@
+import re
+
+from drawing_challenge_bot.challenge_links import (
+    iter_challenge_links,
+    iter_link_segments,
+)
+
+WIKI_HTML = """<div class="md wiki">
+<h1>Challenges</h1>
+<p><a href="https://redd.it/a1">Drawing Challenge #1</a> and
+<a href='https://redd.it/a2'><strong>Drawing</strong>
+Challenge</a> #2</p>
+<p><a href=https://redd.it/a3?x=1&amp;y=2>Drawing&nbsp;Challenge #3</a></p>
+<p><a href="/r/MLPDrawingSchool">Drawing Challenge archive</a></p>
+<p><a href="https://redd.it/b1">Another link</a><a href="https://redd.it/a4">
+Drawing
+Challenge #4
+</a></p>
+</div>"""
+
+CHALLENGE_URLS = [
+    "https://redd.it/a1",
+    "https://redd.it/a2",
+    "https://redd.it/a3?x=1&y=2",
+    "https://redd.it/a4",
+]
+
+
+def test_finds_challenge_links():
+    # Links are found across lines, beside other links, with formatting or entities
+    # in their text, and whatever their href is quoted with. Relative links and links
+    # with other text are skipped
+    assert list(iter_challenge_links(WIKI_HTML)) == CHALLENGE_URLS
+
+
+def test_finds_links_matching_a_custom_pattern():
+    pattern = re.compile("Another")
+
+    assert list(iter_challenge_links(WIKI_HTML, pattern)) == ["https://redd.it/b1"]
+
+
+def test_unclosed_link_ends_at_the_next_link():
+    wiki_html = (
+        '<a href="https://redd.it/a1">Drawing Challenge #1'
+        '<a href="https://redd.it/a2">Drawing Challenge #2</a>'
+    )
+
+    assert list(iter_challenge_links(wiki_html)) == [
+        "https://redd.it/a1",
+        "https://redd.it/a2",
+    ]
+
+
+def test_segments_are_lines_unless_a_link_spans_lines():
+    lines = WIKI_HTML.split("\n")
+    segments = list(iter_link_segments(WIKI_HTML))
+
+    assert segments == [
+        *lines[:3],
+        # The link to the second challenge is broken over two lines
+        "\n".join(lines[3:5]),
+        *lines[5:7],
+        # The link to the fourth challenge is broken over four lines
+        "\n".join(lines[7:11]),
+        lines[11],
+    ]
+
+
+def test_each_link_is_found_in_exactly_one_segment():
+    links = [
+        url
+        for segment in iter_link_segments(WIKI_HTML)
+        for url in iter_challenge_links(segment)
+    ]
+
+    assert links == CHALLENGE_URLS
@@ -0,0 +1,32 @@
+import os
+import stat
+import tempfile
+from types import SimpleNamespace
+
+from drawing_challenge_bot.credentials import (
+    CREDENTIALS_FILENAME,
+    load_credentials,
+    save_credentials,
+)
+
+
+def test_saved_credentials_are_only_readable_by_us():
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        config = SimpleNamespace(
+            store_path=directory,
+            homeserver_url="https://example.com",
+            user_id="@bot:example.com",
+            device_id="DEVICE",
+        )
+
+        # A login saved with a looser mode, for instance by an older version
+        path = os.path.join(directory, CREDENTIALS_FILENAME)
+        with open(path, "w") as f:
+            f.write("{}")
+        os.chmod(path, 0o644)
+
+        save_credentials(config, config.user_id, config.device_id, "secret")
+
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert load_credentials(config)["access_token"] == "secret"
+        assert os.listdir(directory) == [CREDENTIALS_FILENAME]
@@ -0,0 +1,33 @@
+from drawing_challenge_bot.database import (
+    PREPARE_THRESHOLD,
+    PostgresDatabase,
+    PostgresStatement,
+)
+
+SQL = "SELECT room_id FROM room_post WHERE next_due_timestamp <= ?"
+
+
+def prepare(args):
+    """Run a statement through the checks for preparing it enough times to be
+    prepared, and return its prepared version, if any
+    """
+    # No connections are opened until a query is run
+    db = PostgresDatabase("postgres://example.invalid/db")
+    statement = PostgresStatement(SQL)
+    prepared = None
+    for _ in range(PREPARE_THRESHOLD):
+        prepared = db._get_prepared_statement(statement, args)
+    return prepared
+
+
+def test_integer_arguments_are_prepared_as_bigint():
+    prepared = prepare([1600000000])
+
+    assert prepared is not None
+    assert prepared.prepare_text.startswith(f"PREPARE {prepared.name} (bigint) AS ")
+
+
+def test_float_arguments_are_not_prepared():
+    # A double precision parameter would stop an index on the integer column being
+    # used, so statements with float arguments are run directly
+    assert prepare([1600000000.5]) is None
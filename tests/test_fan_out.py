@@ -0,0 +1,116 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from nio import Response, RoomSendError, RoomSendResponse
+
+from benchmarks.fakes import FakeAsyncClient
+from drawing_challenge_bot.fan_out import FanOut, FanOutResult
+
+# How long each fake send takes, in seconds
+SEND_LATENCY = 0.01
+
+# How long the fake homeserver asks us to wait when rate limiting us, in milliseconds
+RETRY_AFTER_MS = 200
+
+ROOM_IDS = [f"!room{index}:example.com" for index in range(20)]
+
+
+def rate_limited(room_id: str) -> RoomSendError:
+    return RoomSendError(
+        "Too Many Requests", "M_LIMIT_EXCEEDED", RETRY_AFTER_MS, False, room_id
+    )
+
+
+def test_concurrency_is_limited():
+    client = FakeAsyncClient(latency=SEND_LATENCY)
+
+    async def send(room_id: str) -> Optional[Response]:
+        return await client.room_send(room_id, "m.room.message", {})
+
+    result = asyncio.run(FanOut(concurrency=3).run(ROOM_IDS, send))
+
+    assert sorted(result.succeeded) == sorted(ROOM_IDS)
+    assert client.peak_in_flight == 3
+
+
+def test_every_worker_pauses_when_rate_limited():
+    concurrency = 4
+    limited_room_id = ROOM_IDS[0]
+
+    # The loop time at which each send started, and the time at which the homeserver
+    # rate limited us, in the order they happened
+    events: List[Tuple[str, float]] = []
+
+    async def send(room_id: str) -> Optional[Response]:
+        loop = asyncio.get_event_loop()
+        events.append((room_id, loop.time()))
+
+        # Rate limit the first send, while the other workers' sends are in flight
+        if room_id == limited_room_id and len(events) == 1:
+            await asyncio.sleep(0)
+            events.append(("limited", loop.time()))
+            return rate_limited(room_id)
+
+        await asyncio.sleep(SEND_LATENCY)
+        return RoomSendResponse("$event", room_id)
+
+    result = asyncio.run(FanOut(concurrency=concurrency).run(ROOM_IDS, send))
+
+    assert sorted(result.succeeded) == sorted(ROOM_IDS)
+    assert result.rate_limit_count == 1
+
+    # Sends already in flight finish, but no worker starts another one until the
+    # homeserver's retry_after_ms has passed. That includes retrying the limited room
+    limited_index = [name for name, _ in events].index("limited")
+    limited_at = events[limited_index][1]
+    later_events = events[limited_index + 1 :]
+
+    assert limited_index == concurrency
+    assert len(later_events) == len(ROOM_IDS) - concurrency + 1
+    assert min(start for _, start in later_events) >= limited_at + RETRY_AFTER_MS / 1000
+    assert [room_id for room_id, _ in later_events].count(limited_room_id) == 1
+
+
+def test_failed_rooms_are_reported():
+    raising_room_id, unsent_room_id, forbidden_room_id, limited_room_id = ROOM_IDS[:4]
+    sends: Dict[str, int] = {}
+    finished: Dict[str, bool] = {}
+
+    async def send(room_id: str) -> Optional[Response]:
+        sends[room_id] = sends.get(room_id, 0) + 1
+        if room_id == raising_room_id:
+            raise RuntimeError("Connection reset")
+        if room_id == unsent_room_id:
+            return None
+        if room_id == forbidden_room_id:
+            return RoomSendError("Forbidden", "M_FORBIDDEN", None, False, room_id)
+        if room_id == limited_room_id:
+            return RoomSendError("Too Many Requests", "M_LIMIT_EXCEEDED", 1, False)
+        return RoomSendResponse("$event", room_id)
+
+    async def on_finished(room_id: str, succeeded: bool):
+        finished[room_id] = succeeded
+
+    result: FanOutResult = asyncio.run(
+        FanOut(concurrency=4, max_retries=2).run(
+            ROOM_IDS, send, on_finished=on_finished
+        )
+    )
+
+    assert sorted(result.failed) == sorted(
+        [raising_room_id, unsent_room_id, forbidden_room_id]
+    )
+    assert sorted(result.succeeded) == sorted(ROOM_IDS[4:])
+
+    # A room that is still rate limited after every retry is given up on, and left
+    # to be tried again later rather than reported as finished
+    assert result.rate_limited == [limited_room_id]
+    assert result.rate_limit_count == 3
+    assert sends[limited_room_id] == 3
+    assert limited_room_id not in finished
+
+    assert finished == {
+        room_id: room_id in result.succeeded
+        for room_id in ROOM_IDS
+        if room_id != limited_room_id
+    }
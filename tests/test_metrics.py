@@ -0,0 +1,64 @@
+import asyncio
+import socket
+
+from aiohttp import ClientSession
+from prometheus_client import CollectorRegistry, Counter, Histogram
+
+from drawing_challenge_bot.metrics import CONTENT_TYPE_LATEST, MetricsServer, timed
+
+
+def test_timed_coroutine_function_observes_until_it_returns():
+    registry = CollectorRegistry()
+    duration = Histogram("test_duration_seconds", "Test", registry=registry)
+
+    @timed(duration)
+    async def sleep():
+        await asyncio.sleep(0.1)
+        return "done"
+
+    # The wrapper is still a coroutine function, so that the profiler wraps it as one
+    assert asyncio.iscoroutinefunction(sleep)
+    assert asyncio.run(sleep()) == "done"
+
+    assert registry.get_sample_value("test_duration_seconds_count") == 1
+    assert registry.get_sample_value("test_duration_seconds_sum") >= 0.1
+
+
+def test_timed_function():
+    registry = CollectorRegistry()
+    duration = Histogram("test_duration_seconds", "Test", registry=registry)
+
+    @timed(duration)
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3
+    assert registry.get_sample_value("test_duration_seconds_count") == 1
+
+
+def test_server_serves_metrics():
+    registry = CollectorRegistry()
+    sent = Counter(
+        "messages_sent", "Test", ["result"], namespace="test", registry=registry
+    )
+    sent.labels("success").inc(3)
+
+    # Find a free port to serve on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    async def fetch():
+        server = MetricsServer("127.0.0.1", port, registry=registry)
+        await server.start()
+        try:
+            async with ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    return response.headers["Content-Type"], await response.text()
+        finally:
+            await server.stop()
+
+    content_type, body = asyncio.run(fetch())
+
+    assert content_type == CONTENT_TYPE_LATEST
+    assert 'test_messages_sent_total{result="success"} 3.0' in body.splitlines()
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import List
+
+import pytest
+
+from drawing_challenge_bot.scheduler import FAILED_JOB_RETRY_SECONDS, Scheduler
+
+# How long a job waits before it next runs, when it shouldn't run again during a test
+LATER_SECONDS = 60
+
+# How long to give the scheduler to run jobs that are due, in seconds
+SETTLE_SECONDS = 0.1
+
+
+def test_job_is_woken_early():
+    async def test() -> List[float]:
+        runs: List[float] = []
+
+        async def job():
+            runs.append(time.time())
+            return time.time() + LATER_SECONDS
+
+        scheduler = Scheduler()
+        scheduler.add_job("job", job)
+        scheduler.start()
+        try:
+            await asyncio.sleep(SETTLE_SECONDS)
+            scheduler.wake("job")
+            await asyncio.sleep(SETTLE_SECONDS)
+        finally:
+            scheduler.stop()
+        return runs
+
+    runs = asyncio.run(test())
+
+    assert len(runs) == 2
+    assert runs[1] - runs[0] < LATER_SECONDS
+
+
+def test_job_woken_while_running_runs_again_once_finished():
+    async def test():
+        release = asyncio.Event()
+        runs = 0
+        running = 0
+        max_running = 0
+
+        async def job():
+            nonlocal runs, running, max_running
+            runs += 1
+            running += 1
+            max_running = max(max_running, running)
+            try:
+                if runs == 1:
+                    await release.wait()
+            finally:
+                running -= 1
+            return time.time() + LATER_SECONDS
+
+        scheduler = Scheduler()
+        scheduler.add_job("job", job)
+        scheduler.start()
+        try:
+            await asyncio.sleep(SETTLE_SECONDS)
+            scheduler.wake("job")
+            await asyncio.sleep(SETTLE_SECONDS)
+            runs_while_running = runs
+
+            release.set()
+            await asyncio.sleep(SETTLE_SECONDS)
+        finally:
+            scheduler.stop()
+        return runs_while_running, runs, max_running
+
+    runs_while_running, runs, max_running = asyncio.run(test())
+
+    assert runs_while_running == 1
+    assert runs == 2
+    assert max_running == 1
+
+
+def test_failed_job_is_retried_at_its_interval():
+    interval = 0.2
+
+    async def test():
+        runs: List[float] = []
+
+        async def job():
+            runs.append(time.time())
+            if len(runs) == 1:
+                raise RuntimeError("Job failed")
+            return time.time() + LATER_SECONDS
+
+        async def job_without_interval():
+            raise RuntimeError("Job failed")
+
+        scheduler = Scheduler()
+        scheduler.add_job("job", job, interval=interval)
+        start = time.time()
+        scheduler.add_job("job_without_interval", job_without_interval)
+        scheduler.start()
+        try:
+            await asyncio.sleep(interval + SETTLE_SECONDS)
+            retry_at = scheduler._jobs["job_without_interval"].next_run_at
+        finally:
+            scheduler.stop()
+        return runs, start, retry_at
+
+    runs, start, retry_at = asyncio.run(test())
+
+    assert len(runs) == 2
+    assert interval <= runs[1] - runs[0] < interval + SETTLE_SECONDS
+
+    # Jobs without an interval are retried after a fixed delay
+    assert retry_at - start == pytest.approx(
+        FAILED_JOB_RETRY_SECONDS, abs=SETTLE_SECONDS
+    )
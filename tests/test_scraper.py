@@ -0,0 +1,243 @@
+import asyncio
+import tempfile
+import time
+from typing import List, Tuple
+
+from benchmarks.fakes import FakeReddit, FakeSubmission
+from benchmarks.run import (
+    LOOP_LAG_SAMPLE_INTERVAL,
+    LoopLagMonitor,
+    database_url,
+    write_config,
+)
+from drawing_challenge_bot.challenge_cache import ChallengeCache
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.scraper import Scraper
+from drawing_challenge_bot.storage import Storage
+
+# How long each request to the fake reddit blocks for, in seconds
+REDDIT_LATENCY = 0.2
+
+# How late the event loop may wake up while reddit is being scraped, in seconds. Well
+# under REDDIT_LATENCY, so that a single request made on the loop would exceed it
+MAX_LOOP_LAG = 0.05
+
+
+async def scrape_with_slow_reddit(directory: str):
+    """Scrape a slow fake reddit while measuring the event loop's lag
+
+    Returns:
+        The scraped challenges, how long the scrape took in seconds, and the maximum
+        loop lag in seconds
+    """
+    with database_url(directory, None) as database:
+        config = write_config(
+            directory,
+            database,
+            {"concurrency": 10, "max_rate_limit_retries": 5, "log_level": "WARNING"},
+        )
+        reddit = AsyncReddit(FakeReddit(20, latency=REDDIT_LATENCY), max_workers=1)
+        store = Storage(config, reddit)
+        try:
+            await store.setup()
+            scraper = Scraper(
+                config, config.sources[0], reddit, ChallengeCache(store, reddit)
+            )
+
+            # Let the monitor start sampling before the scrape begins, and take a last
+            # sample after it ends, so that blocking anywhere in the scrape is seen
+            monitor = LoopLagMonitor()
+            monitor.start()
+            try:
+                await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL)
+                start = time.perf_counter()
+                challenges = await scraper.scrape()
+                elapsed = time.perf_counter() - start
+                await asyncio.sleep(2 * LOOP_LAG_SAMPLE_INTERVAL)
+            finally:
+                monitor.stop()
+
+            return challenges, elapsed, monitor.max_lag
+        finally:
+            store.close()
+
+
+def test_scrape_does_not_block_event_loop():
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        challenges, elapsed, max_lag = asyncio.run(scrape_with_slow_reddit(directory))
+
+    assert len(challenges) == 20
+
+    # The wiki revision, the wiki page and the challenges are each fetched, so the
+    # scrape must have waited on reddit several times
+    assert elapsed >= 3 * REDDIT_LATENCY
+    assert max_lag < MAX_LOOP_LAG
+
+
+def test_unresolved_challenges_are_retried_while_the_wiki_is_unchanged():
+    async def scrape_while_reddit_misses_a_challenge(directory: str):
+        with database_url(directory, None) as database:
+            config = write_config(
+                directory,
+                database,
+                {
+                    "concurrency": 10,
+                    "max_rate_limit_retries": 5,
+                    "log_level": "WARNING",
+                },
+            )
+            fake_reddit = FakeReddit(3)
+            reddit = AsyncReddit(fake_reddit)
+            store = Storage(config, reddit)
+            try:
+                await store.setup()
+                scraper = Scraper(
+                    config, config.sources[0], reddit, ChallengeCache(store, reddit)
+                )
+
+                # Reddit doesn't return the newest challenge the first time
+                missing = fake_reddit.submissions[-1]
+                del fake_reddit._submissions_by_id[missing.id]
+                first = await scraper.scrape()
+
+                fake_reddit._submissions_by_id[missing.id] = missing
+                second = await scraper.scrape()
+
+                info_requests = fake_reddit.requests["info"]
+                third = await scraper.scrape()
+
+                return (
+                    [len(challenges) for challenges in (first, second, third)],
+                    fake_reddit.requests["info"] - info_requests,
+                    scraper.wiki_cache_hits,
+                )
+            finally:
+                store.close()
+
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        counts, info_requests, cache_hits = asyncio.run(
+            scrape_while_reddit_misses_a_challenge(directory)
+        )
+
+    assert counts == [2, 3, 3]
+    assert cache_hits == 2
+
+    # Once every challenge is found, an unchanged wiki needs no lookups
+    assert info_requests == 0
+
+
+class RecordingChallengeCache(ChallengeCache):
+    """A challenge cache that records the IDs of every lookup"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups: List[List[str]] = []
+
+    async def get_challenges(self, challenge_ids: List[str]):
+        self.lookups.append(list(challenge_ids))
+        return await super().get_challenges(challenge_ids)
+
+
+def wiki_line(*indexes: int) -> str:
+    """A line of a wiki page linking to the fake challenges with the given indexes"""
+    links = " ".join(
+        f'<a href="{FakeSubmission(index).url}">Drawing Challenge #{index}</a>'
+        for index in indexes
+    )
+    return f"<li>{links}</li>"
+
+
+def wiki_page(*lines: str) -> str:
+    return "\n".join(["<ul>", *lines, "</ul>"])
+
+
+def challenge_ids(*indexes: int) -> List[str]:
+    return [FakeSubmission(index).id for index in indexes]
+
+
+async def parse_pages(
+    directory: str, pages: List[str]
+) -> List[Tuple[list, list, list]]:
+    """Parse each version of a wiki page in turn with one scraper, and each on its
+    own with a new scraper
+
+    Returns:
+        For each version, the IDs of the challenges that the scraper found, the IDs
+        it looked up, and the IDs found by parsing that version from scratch
+    """
+    with database_url(directory, None) as database:
+        config = write_config(
+            directory,
+            database,
+            {"concurrency": 10, "max_rate_limit_retries": 5, "log_level": "WARNING"},
+        )
+        reddit = AsyncReddit(FakeReddit(10))
+        store = Storage(config, reddit)
+        try:
+            await store.setup()
+            cache = ChallengeCache(store, reddit)
+            recording_cache = RecordingChallengeCache(store, reddit)
+            scraper = Scraper(config, config.sources[0], reddit, recording_cache)
+
+            results = []
+            for page in pages:
+                fresh_scraper = Scraper(config, config.sources[0], reddit, cache)
+                recording_cache.lookups.clear()
+                found = [c.id for c in await scraper._parse_wiki(page)]
+                looked_up = sorted(
+                    challenge_id
+                    for lookup in recording_cache.lookups
+                    for challenge_id in lookup
+                )
+                from_scratch = [c.id for c in await fresh_scraper._parse_wiki(page)]
+                results.append((found, looked_up, from_scratch))
+            return results
+        finally:
+            store.close()
+
+
+def test_wiki_page_is_parsed_incrementally():
+    pages = [
+        wiki_page(wiki_line(0), wiki_line(1), wiki_line(2)),
+        # Added
+        wiki_page(wiki_line(0), wiki_line(1), wiki_line(2), wiki_line(3)),
+        # Linked to twice, on identical lines and on a line with another link
+        wiki_page(
+            wiki_line(0),
+            wiki_line(1),
+            wiki_line(2),
+            wiki_line(3),
+            wiki_line(3),
+            wiki_line(1, 4),
+        ),
+        # One of the duplicate lines removed
+        wiki_page(wiki_line(0), wiki_line(1), wiki_line(2), wiki_line(3), wiki_line(1)),
+        # Every link to a challenge removed
+        wiki_page(wiki_line(0), wiki_line(2), wiki_line(3)),
+        # Moved, both to another line and onto a line with another link
+        wiki_page(wiki_line(3), wiki_line(2, 0)),
+        # Removed, then added back
+        wiki_page(wiki_line(3)),
+        wiki_page(wiki_line(3), wiki_line(2, 0)),
+    ]
+    # The challenges found in each version, and the ones that had to be looked up
+    expected = [
+        (challenge_ids(0, 1, 2), challenge_ids(0, 1, 2)),
+        (challenge_ids(0, 1, 2, 3), challenge_ids(3)),
+        (challenge_ids(0, 1, 2, 3, 4), challenge_ids(4)),
+        (challenge_ids(0, 1, 2, 3), []),
+        (challenge_ids(0, 2, 3), []),
+        (challenge_ids(0, 2, 3), []),
+        (challenge_ids(3), []),
+        (challenge_ids(0, 2, 3), challenge_ids(0, 2)),
+    ]
+
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        results = asyncio.run(parse_pages(directory, pages))
+
+    for (found, looked_up, from_scratch), (expected_ids, expected_lookups) in zip(
+        results, expected
+    ):
+        assert found == expected_ids
+        assert looked_up == sorted(expected_lookups)
+        assert from_scratch == expected_ids
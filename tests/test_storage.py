@@ -0,0 +1,206 @@
+import asyncio
+import os
+import tempfile
+import time
+from typing import Any, List, Optional, Sequence, Tuple
+
+import pytest
+
+from benchmarks.fakes import FakeReddit, FakeSubmission
+from benchmarks.run import add_rooms, database_url, write_config
+from benchmarks.sharding import instance_config
+from drawing_challenge_bot.challenge import Challenge
+from drawing_challenge_bot.database import POSTGRES_PARAMETER_TYPES, PostgresStatement
+from drawing_challenge_bot.reddit_api import AsyncReddit
+from drawing_challenge_bot.storage import ONE_WEEK_IN_SECONDS, Storage
+
+# A Postgres connection string to run the Postgres tests against. Their tables are
+# created in a temporary schema
+POSTGRES = os.environ.get("DRAWING_CHALLENGE_BOT_TEST_POSTGRES")
+
+requires_postgres = pytest.mark.skipif(
+    not POSTGRES, reason="DRAWING_CHALLENGE_BOT_TEST_POSTGRES is not set"
+)
+
+# How many rooms to fill the database with, so that the query planner prefers indexes
+ROOM_COUNT = 10000
+
+SOURCE = "mlpdrawingschool"
+
+# The benchmark options to write the bot's config with
+OPTIONS = {"concurrency": 10, "max_rate_limit_retries": 5, "log_level": "WARNING"}
+
+
+class RecordingStorage(Storage):
+    """Storage that records every statement it runs, and the arguments bound to it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements: List[Tuple[str, Tuple[Any, ...]]] = []
+
+    def _execute(self, cursor, sql: str, args: Sequence[Any] = ()):
+        self.statements.append((sql, tuple(args)))
+        super()._execute(cursor, sql, args)
+
+
+async def with_store(postgres: Optional[str], test):
+    """Run a test coroutine function against a store full of rooms"""
+    with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+        with database_url(directory, postgres) as database:
+            config = write_config(directory, database, OPTIONS)
+            store = RecordingStorage(config, AsyncReddit(FakeReddit(0)))
+            try:
+                await store.setup()
+
+                challenge = Challenge.from_submission(FakeSubmission(0))
+                await add_rooms(
+                    store,
+                    SOURCE,
+                    [
+                        (f"!room{index}:example.com", challenge if index % 2 else None)
+                        for index in range(ROOM_COUNT)
+                    ],
+                )
+                await store.db.write(
+                    lambda cursor: store._execute(cursor, "ANALYZE"), transaction=True
+                )
+
+                store.statements.clear()
+                return await test(store)
+            finally:
+                store.close()
+
+
+async def run_hot_queries(store: Storage):
+    """Run the queries that look up due rooms, with timestamps from the clock. Two
+    pages of due rooms are read, so that the query for a following page is run too
+    """
+    now = time.time()
+    pages = 0
+    async for _ in store.get_due_rooms(
+        SOURCE, now + 0.5, limit=10, newer_than=now - 0.5
+    ):
+        pages += 1
+        if pages == 2:
+            break
+    await store.get_next_due_timestamp([SOURCE], after=now + 0.5)
+
+
+def timestamp_statements(store: RecordingStorage) -> List[Tuple[str, Tuple]]:
+    return [
+        (sql, args)
+        for sql, args in store.statements
+        if "next_due_timestamp" in sql and sql.lstrip().startswith("SELECT")
+    ]
+
+
+def test_timestamps_are_bound_as_integers():
+    async def test(store: RecordingStorage):
+        await run_hot_queries(store)
+        await store.upsert_challenges_for_rooms(
+            SOURCE,
+            [("!room0:example.com", Challenge.from_submission(FakeSubmission(1)))],
+        )
+        return store.statements
+
+    statements = asyncio.run(with_store(None, test))
+
+    assert statements
+    for sql, args in statements:
+        assert not any(isinstance(arg, float) for arg in args), sql
+
+
+@requires_postgres
+def test_due_room_lookups_use_index_on_postgres():
+    async def test(store: RecordingStorage):
+        await run_hot_queries(store)
+
+        def explain(cursor):
+            plans = []
+            for number, (sql, args) in enumerate(timestamp_statements(store)):
+                # Plan the statement as it is prepared on the server. A generic plan
+                # doesn't depend on the arguments' values, only their types
+                statement = PostgresStatement(sql)
+                types = ", ".join(POSTGRES_PARAMETER_TYPES[type(arg)] for arg in args)
+                cursor.execute(
+                    f"PREPARE plan_test_{number} ({types}) AS {statement.prepare_text}"
+                )
+                cursor.execute("SET plan_cache_mode = force_generic_plan")
+                cursor.execute(
+                    f"EXPLAIN EXECUTE plan_test_{number} "
+                    f"({', '.join(['%s'] * len(args))})",
+                    args,
+                )
+                plans.append("\n".join(row[0] for row in cursor.fetchall()))
+            return plans
+
+        return await store.db.read(explain)
+
+    plans = asyncio.run(with_store(POSTGRES, test))
+
+    assert len(plans) == 3
+    for plan in plans:
+        # The timestamp must be part of the index condition, rather than the column
+        # being converted to the argument's type and compared row by row
+        index_conditions = [line for line in plan.splitlines() if "Index Cond:" in line]
+        assert "room_post_source_next_due_timestamp" in plan, plan
+        assert any("next_due_timestamp" in line for line in index_conditions), plan
+        assert "(next_due_timestamp)::" not in plan, plan
+
+
+@requires_postgres
+def test_caught_up_rooms_are_shared_out_and_given_up_when_leaving():
+    async def test():
+        with tempfile.TemporaryDirectory(prefix="drawing-challenge-bot-") as directory:
+            with database_url(directory, POSTGRES) as database:
+                first, second = (
+                    Storage(
+                        instance_config(directory, database, instance_id, OPTIONS),
+                        AsyncReddit(FakeReddit(0)),
+                    )
+                    for instance_id in ("first", "second")
+                )
+                try:
+                    await first.setup()
+
+                    # Every room has been sent the newest challenge, a week ago. The
+                    # rooms stay due until a newer challenge is posted
+                    challenge = Challenge.from_submission(FakeSubmission(0))
+                    await add_rooms(
+                        first,
+                        SOURCE,
+                        [
+                            (f"!room{index}:example.com", challenge)
+                            for index in range(20)
+                        ],
+                    )
+                    await first.db.write(
+                        lambda cursor: first._execute(
+                            cursor,
+                            "UPDATE room_post SET next_due_timestamp = ?",
+                            (int(time.time()) - ONE_WEEK_IN_SECONDS,),
+                        )
+                    )
+
+                    await first.heartbeat(claim=False)
+                    assert (await first.heartbeat()).claimed == 20
+
+                    await second.heartbeat(claim=False)
+
+                    # Rooms aren't given up while the first instance is posting
+                    state = await first.heartbeat(release=False)
+                    assert (state.instances, state.released) == (2, 0)
+
+                    assert (await first.heartbeat()).released == 10
+                    assert (await second.heartbeat()).claimed == 10
+
+                    # Rooms can be claimed straight away from an instance that stops
+                    assert await first.leave_shard() == 10
+                    state = await second.heartbeat()
+                    assert (state.instances, state.claimed) == (1, 10)
+                    assert state.stopped_instance_ids == []
+                finally:
+                    first.close()
+                    second.close()
+
+    asyncio.run(test())